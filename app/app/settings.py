@@ -11,9 +11,12 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
 import os
+import sys
 from datetime import timedelta
 from pathlib import Path
 
+from celery.schedules import crontab
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -153,8 +156,112 @@ CELERY_BROKER_URL = "redis://redis:6379"
 
 CELERY_RESULT_BACKEND = "redis://redis:6379"
 
+# The cache is shared by every web and Celery worker process through Redis,
+# next to the Celery broker. An empty CACHE_REDIS_URL keeps a cache local to
+# each process instead. Connections are pooled per process; values larger
+# than a few bytes are compressed; if Redis is down, cache reads miss and
+# writes are dropped (and logged) instead of failing the request.
+CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL", "redis://redis:6379/1")
+
+# The test suite keeps a cache of its own, so that it neither depends on nor
+# flushes the Redis cache of the running app
+if sys.argv[1:2] == ["test"]:
+    CACHE_REDIS_URL = ""
+
+if CACHE_REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django_redis.cache.RedisCache",
+            "LOCATION": CACHE_REDIS_URL,
+            "KEY_PREFIX": os.environ.get("CACHE_KEY_PREFIX", "ta_investments"),
+            "OPTIONS": {
+                "CLIENT_CLASS": "django_redis.client.DefaultClient",
+                "CONNECTION_POOL_KWARGS": {
+                    "max_connections": int(
+                        os.environ.get("CACHE_MAX_CONNECTIONS", 50)),
+                    "retry_on_timeout": True,
+                },
+                "SOCKET_CONNECT_TIMEOUT": 1,
+                "SOCKET_TIMEOUT": 1,
+                "COMPRESSOR": "django_redis.compressors.zlib.ZlibCompressor",
+                "IGNORE_EXCEPTIONS": True,
+            },
+        }
+    }
+    DJANGO_REDIS_LOG_IGNORED_EXCEPTIONS = True
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+# Snapshot the investment statistics of the day that just ended
+CELERY_BEAT_SCHEDULE = {
+    "take-statistics-snapshots": {
+        "task": "ta_investments.tasks.take_statistics_snapshots",
+        "schedule": crontab(minute=5, hour=0),
+    },
+}
+
 INVESTMENT_STATISTICS_CACHE_KEY = "investment_statistics"
 
+# The cached investment statistics are fresh for the soft timeout, or until a
+# write invalidates them. Stale statistics are still served while a single
+# worker refreshes them, until they are evicted after the hard timeout. The
+# refresh lock expires after the lock timeout in case a refresh is lost.
+INVESTMENT_STATISTICS_CACHE_SOFT_TIMEOUT = int(
+    os.environ.get("INVESTMENT_STATISTICS_CACHE_SOFT_TIMEOUT", 300))
+INVESTMENT_STATISTICS_CACHE_HARD_TIMEOUT = int(
+    os.environ.get("INVESTMENT_STATISTICS_CACHE_HARD_TIMEOUT", 24 * 3600))
+INVESTMENT_STATISTICS_CACHE_LOCK_TIMEOUT = int(
+    os.environ.get("INVESTMENT_STATISTICS_CACHE_LOCK_TIMEOUT", 60))
+
+# Responses of the list and statistics endpoints are cached for this many
+# seconds (0 disables the cache), under the data version every loan and cash
+# flow write bumps
+RESPONSE_CACHE_TIMEOUT = int(os.environ.get("RESPONSE_CACHE_TIMEOUT", 3600))
+RESPONSE_CACHE_KEY_PREFIX = "response"
+RESPONSE_CACHE_VERSION_KEY = "data_version"
+
+# Hit and miss counters of the statistics and response caches, shared by all
+# processes, are kept under this prefix
+CACHE_STATS_KEY_PREFIX = "cache_stats"
+
+# Portfolio IRRs are cached per filter hash under this prefix, until a write
+# invalidates the investment statistics
+PORTFOLIO_IRR_CACHE_KEY_PREFIX = "portfolio_irr"
+
+# Number of rows written per INSERT statement by the CSV import tasks
+CSV_IMPORT_BATCH_SIZE = int(os.environ.get("CSV_IMPORT_BATCH_SIZE", 1000))
+
+# Default import backend: "orm" (bulk_create) or "copy" (PostgreSQL COPY)
+CSV_IMPORT_BACKEND = os.environ.get("CSV_IMPORT_BACKEND", "orm")
+
+# Default import mode: "insert" new rows only, or "upsert" to merge re-uploaded
+# files and only rewrite rows whose content changed
+CSV_IMPORT_MODE = os.environ.get("CSV_IMPORT_MODE", "insert")
+
+# Number of rows per chunk when an import is fanned out across the workers
+CSV_IMPORT_CHUNK_ROWS = int(os.environ.get("CSV_IMPORT_CHUNK_ROWS", 50000))
+
+# Uploaded import files are spooled here and read back by the Celery workers,
+# so it must be shared between the web and worker containers
+CSV_UPLOAD_ROOT = os.environ.get("CSV_UPLOAD_ROOT", BASE_DIR / "uploads")
+
+# Recompute the calculated loan fields in a debounced Celery task instead of
+# synchronously on every cash flow write, and the debounce window in seconds
+LOAN_RECOMPUTE_ASYNC = os.environ.get("LOAN_RECOMPUTE_ASYNC") == "1"
+LOAN_RECOMPUTE_DEBOUNCE = int(os.environ.get("LOAN_RECOMPUTE_DEBOUNCE", 5))
+
+LOAN_RECOMPUTE_SCHEDULED_CACHE_KEY = "loan_recompute_scheduled"
+
+# Realized IRRs are memoised by cash flow set: up to XIRR_CACHE_SIZE results
+# per process, in front of the shared cache where they live this many seconds
+XIRR_CACHE_SIZE = int(os.environ.get("XIRR_CACHE_SIZE", 10000))
+XIRR_CACHE_TIMEOUT = int(os.environ.get("XIRR_CACHE_TIMEOUT", 7 * 24 * 3600))
+XIRR_CACHE_KEY_PREFIX = "xirr"
+
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=60),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1),
@@ -0,0 +1,270 @@
+"""
+Stale-while-revalidate caching: a stale value keeps being served while a
+single worker recomputes it in the background. And a response cache keyed
+by a data version that every write bumps
+"""
+import functools
+import hashlib
+import json
+import logging
+import time
+from typing import Any, Callable, Dict, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+from rest_framework.renderers import JSONRenderer
+
+logger = logging.getLogger(__name__)
+
+# counters of the hits and misses, kept in the shared cache so that they
+# add up over every web and worker process
+STATS = ("hits", "stale_hits", "misses")
+RESPONSE_STATS = ("hits", "misses")
+
+
+def get_or_refresh(
+        key: str, compute: Callable[[], Any], refresh: Callable[[], Any],
+        soft_timeout: int, hard_timeout: int, lock_timeout: int) -> Any:
+    """
+    Return the value cached under ``key``.
+
+    A value stored less than ``soft_timeout`` seconds ago, and not
+    invalidated since it was computed, is fresh. A stale value is returned
+    all the same, and only the caller that claims the refresh lock calls
+    ``refresh`` to recompute it in the background. The lock expires after
+    ``lock_timeout`` seconds in case the refresh never stores its result,
+    and is released at once if ``refresh`` fails, e.g. when the broker is
+    down.
+
+    Values are evicted ``hard_timeout`` seconds after they were stored;
+    the value is then ``compute``d and stored inline.
+    """
+    entry, fresh = _lookup(key, soft_timeout)
+    if entry is None:
+        _count("misses")
+        computed_at = time.time()
+        value = compute()
+        store(key, value, computed_at, hard_timeout)
+        return value
+
+    if fresh:
+        _count("hits")
+    else:
+        _count("stale_hits")
+        if cache.add(_lock_key(key), True, timeout=lock_timeout):
+            try:
+                refresh()
+            except Exception:
+                logger.exception(f"Could not schedule the refresh of {key}")
+                cache.delete(_lock_key(key))
+    return entry[0]
+
+
+def get_or_compute(
+        key: str, compute: Callable[[], Any], timeout: int,
+        invalidated_by: str = None) -> Any:
+    """
+    Return the value cached under ``key``, or ``compute`` and cache it for
+    ``timeout`` seconds. The value is recomputed once invalidated, with the
+    value of ``invalidated_by`` when given: any number of keys derived from
+    the same data are then invalidated with a single cache write.
+    """
+    marker = _invalidated_key(invalidated_by or key)
+    entries = _get_many([key, marker])
+    entry = entries.get(key)
+    if entry is not None and entry[1] > entries.get(marker, 0):
+        return entry[0]
+
+    computed_at = time.time()
+    value = compute()
+    cache.set(key, (value, computed_at), timeout=timeout)
+    return value
+
+
+def store(key: str, value: Any, computed_at: float, hard_timeout: int):
+    """
+    Cache ``value`` under ``key`` and release the refresh lock.
+    ``computed_at`` is when the computation started, so that invalidations
+    during the computation leave the value stale.
+    """
+    cache.set(key, (value, computed_at), timeout=hard_timeout)
+    cache.delete(_lock_key(key))
+
+
+def invalidate(key: str, hard_timeout: int):
+    """
+    Mark the value cached under ``key`` stale, without evicting it, with a
+    single cache write.
+    """
+    cache.set(_invalidated_key(key), time.time(), timeout=hard_timeout)
+
+
+def is_stale(key: str, soft_timeout: int) -> bool:
+    """Whether the value cached under ``key`` is missing or stale."""
+    return not _lookup(key, soft_timeout)[1]
+
+
+def cache_stats() -> Dict[str, int]:
+    """Fresh hit, stale hit and miss counters of ``get_or_refresh``."""
+    return _read_stats("refresh", STATS)
+
+
+def clear_cache_stats():
+    cache.delete_many([_stats_key("refresh", name) for name in STATS])
+
+
+def data_version() -> Optional[int]:
+    """
+    The current version of the loans and cash flows, which responses are
+    cached under, or None if the cache cannot hold it.
+    """
+    version = cache.get(settings.RESPONSE_CACHE_VERSION_KEY)
+    if version is None:
+        cache.add(
+            settings.RESPONSE_CACHE_VERSION_KEY, _fresh_version(),
+            timeout=None)
+        version = cache.get(settings.RESPONSE_CACHE_VERSION_KEY)
+    return version
+
+
+def invalidate_responses():
+    """
+    Bump the data version, which leaves every cached response behind with
+    a single atomic cache increment. It is bumped again once the current
+    transaction commits, so that responses cached from data read before
+    the commit are not served either.
+    """
+    _bump_data_version()
+    transaction.on_commit(_bump_data_version)
+
+
+def cache_response(view_method):
+    """
+    Cache the successful responses of a ``GET`` view method for
+    ``RESPONSE_CACHE_TIMEOUT`` seconds, per path, query parameters, user
+    groups, media type and data version. Cached responses are served
+    already rendered.
+
+    Only JSON responses are cached: the pages of the browsable API carry
+    the email and CSRF token of the user they were rendered for.
+    """
+    @functools.wraps(view_method)
+    def wrapper(view, request, *args, **kwargs):
+        if (not settings.RESPONSE_CACHE_TIMEOUT
+                or not isinstance(request.accepted_renderer, JSONRenderer)):
+            return view_method(view, request, *args, **kwargs)
+        version = data_version()
+        if version is None:
+            return view_method(view, request, *args, **kwargs)
+
+        key = _response_key(request, version)
+        cached = cache.get(key)
+        if cached is not None:
+            _count_response("hits")
+            content, status, content_type = cached
+            return HttpResponse(
+                content, status=status, content_type=content_type)
+
+        _count_response("misses")
+        response = view_method(view, request, *args, **kwargs)
+        if response.status_code == 200:
+            response.add_post_render_callback(
+                lambda rendered: cache.set(
+                    key,
+                    (rendered.content, rendered.status_code,
+                     rendered["Content-Type"]),
+                    timeout=settings.RESPONSE_CACHE_TIMEOUT,
+                ))
+        return response
+
+    return wrapper
+
+
+def response_cache_stats() -> Dict[str, int]:
+    """Hit and miss counters of ``cache_response``."""
+    return _read_stats("response", RESPONSE_STATS)
+
+
+def clear_response_cache_stats():
+    cache.delete_many(
+        [_stats_key("response", name) for name in RESPONSE_STATS])
+
+
+def _fresh_version():
+    # never below a version handed out before the counter was evicted
+    return time.time_ns()
+
+
+def _bump_data_version():
+    try:
+        cache.incr(settings.RESPONSE_CACHE_VERSION_KEY)
+    except ValueError:
+        cache.add(
+            settings.RESPONSE_CACHE_VERSION_KEY, _fresh_version(),
+            timeout=None)
+
+
+def _response_key(request, version):
+    params = sorted(
+        (name, sorted(values))
+        for name, values in request.query_params.lists())
+    groups = sorted(request.user.groups.values_list("name", flat=True))
+    payload = json.dumps(
+        [request.path, params, groups, request.accepted_media_type])
+    digest = hashlib.sha1(payload.encode("utf-8")).hexdigest()
+    return f"{settings.RESPONSE_CACHE_KEY_PREFIX}:{version}:{digest}"
+
+
+def _count_response(name):
+    _increment(_stats_key("response", name))
+
+
+def _lookup(key, soft_timeout):
+    # the (value, computed_at) entry of key, or None, and whether it is fresh
+    entries = _get_many([key, _invalidated_key(key)])
+    entry = entries.get(key)
+    if entry is None:
+        return None, False
+    computed_at = entry[1]
+    fresh = (computed_at > entries.get(_invalidated_key(key), 0)
+             and time.time() < computed_at + soft_timeout)
+    return entry, fresh
+
+
+def _get_many(keys):
+    # a cache that is down (with its errors ignored) returns None
+    return cache.get_many(keys) or {}
+
+
+def _invalidated_key(key):
+    return f"{key}:invalidated"
+
+
+def _lock_key(key):
+    return f"{key}:refreshing"
+
+
+def _count(name):
+    _increment(_stats_key("refresh", name))
+
+
+def _increment(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # the first count, or the counter was evicted
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+def _read_stats(group, names):
+    counts = _get_many([_stats_key(group, name) for name in names])
+    return {
+        name: counts.get(_stats_key(group, name), 0) for name in names
+    }
+
+
+def _stats_key(group, name):
+    return f"{settings.CACHE_STATS_KEY_PREFIX}:{group}:{name}"
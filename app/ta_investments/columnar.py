@@ -0,0 +1,230 @@
+"""
+Parquet readers feeding the bulk import engines with typed columns
+"""
+import logging
+import time
+from typing import Dict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .importers import (CASHFLOW_CSV_FIELDS, LOAN_CSV_FIELDS, _report,
+                        resolve_mode, write_cashflows, write_loans)
+from .models import Cashflow, Loan
+from .validation import CASHFLOW_VALIDATORS, LOAN_VALIDATORS
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+
+def parquet_available() -> bool:
+    """Whether pyarrow is installed to read Parquet files."""
+    return pa is not None
+
+
+def _arrow_type(model, name):
+    field = model._meta.get_field(name)
+    internal_type = field.get_internal_type()
+    if internal_type == "DecimalField":
+        return pa.decimal128(field.max_digits, field.decimal_places)
+    if internal_type == "DateField":
+        return pa.date32()
+    if internal_type == "IntegerField":
+        return pa.int32()
+    return pa.string()
+
+
+def load_loans_parquet(
+        source, backend=None, batch_size=None, mode=None, progress=None,
+        rejects=None) -> Dict:
+    """
+    Import loans from a Parquet file, one record batch at a time.
+
+    The typed columns skip the text staging of the COPY backend, so the
+    batches are always written by ``write_loans`` whatever ``backend``.
+    """
+    return _load_parquet(
+        source,
+        Loan,
+        LOAN_CSV_FIELDS,
+        LOAN_VALIDATORS,
+        _build_loans,
+        write_loans,
+        "loans",
+        batch_size=batch_size,
+        mode=mode,
+        progress=progress,
+        rejects=rejects,
+    )
+
+
+def load_cashflows_parquet(
+        source, backend=None, batch_size=None, recompute=True, mode=None,
+        progress=None, rejects=None) -> Dict:
+    """
+    Import cash flows from a Parquet file, one record batch at a time,
+    written by ``write_cashflows`` whatever ``backend``.
+    """
+    return _load_parquet(
+        source,
+        Cashflow,
+        CASHFLOW_CSV_FIELDS,
+        CASHFLOW_VALIDATORS,
+        _build_cashflows,
+        write_cashflows,
+        "cash flows",
+        batch_size=batch_size,
+        recompute=recompute,
+        mode=mode,
+        progress=progress,
+        rejects=rejects,
+    )
+
+
+def _load_parquet(
+        source, model, fields, validators, build, write, kind, batch_size,
+        mode, **options) -> Dict:
+    if pa is None:
+        raise ImproperlyConfigured("Parquet imports require pyarrow")
+
+    batch_size = batch_size or settings.CSV_IMPORT_BATCH_SIZE
+    parquet_file = pq.ParquetFile(source)
+    if not set(fields) <= set(parquet_file.schema_arrow.names):
+        logger.warning(f"Wrong fields in {kind} Parquet file")
+        return _report(kind, time.monotonic())
+
+    types = {field: _arrow_type(model, field) for field in fields}
+    batches = (
+        _validate_batch(batch, fields, types, validators, build)
+        for batch in parquet_file.iter_batches(
+            batch_size=batch_size, columns=fields)
+    )
+    return write(
+        batches,
+        batch_size=batch_size,
+        mode=resolve_mode(mode),
+        **options,
+    )
+
+
+def _validate_batch(batch, fields, types, validators, build):
+    """
+    Cast and check a record batch column by column and build model
+    instances from the valid rows, returning ``(rows_read, instances,
+    rejected)`` as the write engines expect.
+    """
+    columns, masks = [], []
+    for field in fields:
+        column, valid = _clean_column(
+            batch.column(field), types[field], validators[field], field)
+        columns.append(column)
+        masks.append(valid)
+
+    valid = masks[0]
+    for mask in masks[1:]:
+        valid = pc.and_(valid, mask)
+
+    table = pa.Table.from_arrays(columns, names=fields).filter(valid)
+    instances = build(*(table.column(field).to_pylist() for field in fields))
+
+    rejected = []
+    invalid = pc.invert(valid)
+    if pc.any(invalid).as_py():
+        rows = batch.filter(invalid).to_pylist()
+        row_masks = [mask.filter(invalid).to_pylist() for mask in masks]
+        for index, row in enumerate(rows):
+            field = next(
+                field for field, mask in zip(fields, row_masks)
+                if not mask[index])
+            rejected.append((row, f"invalid {field}: {row[field]!r}"))
+
+    return batch.num_rows, instances, rejected
+
+
+def _clean_column(column, arrow_type, validator, field):
+    """
+    Cast a column to its model type in one go, checking constraints with
+    compute kernels. Columns that cannot be cast as a whole (mixed or
+    out-of-range values) fall back to the per-value CSV validator.
+    """
+    if pa.types.is_dictionary(column.type):
+        column = column.dictionary_decode()
+    if pa.types.is_string(column.type) or pa.types.is_large_string(
+            column.type):
+        column = pc.utf8_trim_whitespace(column)
+        if field == "type":
+            column = pc.utf8_upper(column)
+    try:
+        column = pc.cast(column, arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return _validate_values(column, arrow_type, validator)
+
+    valid = pc.fill_null(_check(column, field), False)
+    return column, valid
+
+
+def _check(column, field):
+    if field in ("identifier", "loan_identifier"):
+        length = pc.utf8_length(column)
+        max_length = Loan._meta.get_field("identifier").max_length
+        return pc.and_(
+            pc.greater(length, 0), pc.less_equal(length, max_length))
+    if field == "rating":
+        return pc.and_(
+            pc.greater_equal(column, 1), pc.less_equal(column, 9))
+    if field == "type":
+        return pc.is_in(
+            column, value_set=pa.array([key for key, _ in Cashflow.TYPES]))
+    return pc.is_valid(column)
+
+
+def _validate_values(column, arrow_type, validator):
+    values, valid = [], []
+    for value in column.to_pylist():
+        try:
+            values.append(validator(
+                value if value is None or isinstance(value, str)
+                else str(value)))
+            valid.append(True)
+        except (ValueError, TypeError, ArithmeticError):
+            values.append(None)
+            valid.append(False)
+    return pa.array(values, type=arrow_type), pa.array(valid)
+
+
+def _build_loans(
+        identifiers, issue_dates, total_amounts, ratings, maturity_dates,
+        total_expected_interest_amounts):
+    return [
+        Loan(
+            identifier=identifier,
+            issue_date=issue_date,
+            total_amount=total_amount,
+            rating=rating,
+            maturity_date=maturity_date,
+            total_expected_interest_amount=total_expected_interest_amount,
+        )
+        for (identifier, issue_date, total_amount, rating, maturity_date,
+             total_expected_interest_amount) in zip(
+            identifiers, issue_dates, total_amounts, ratings,
+            maturity_dates, total_expected_interest_amounts)
+    ]
+
+
+def _build_cashflows(loan_identifiers, reference_dates, types, amounts):
+    return [
+        Cashflow(
+            loan_identifier_id=loan_identifier,
+            reference_date=reference_date,
+            type=cashflow_type,
+            amount=amount,
+        )
+        for loan_identifier, reference_date, cashflow_type, amount in zip(
+            loan_identifiers, reference_dates, types, amounts)
+    ]
@@ -1,6 +1,6 @@
 import django_filters
 
-from .models import Cashflow, Loan
+from .models import Cashflow, Loan, StatisticsRollup
 
 
 class LoanFilter(django_filters.FilterSet):
@@ -44,3 +44,29 @@ class CashFlowFilter(django_filters.FilterSet):
             "amount": ["exact", "lt", "gt", "lte", "gte"],
             "type": ["exact"],
         }
+
+
+class StatisticsRollupFilter(django_filters.FilterSet):
+    class Meta:
+        model = StatisticsRollup
+        fields = {
+            "rating": ["exact", "in", "lte", "gte"],
+            "issue_month": [
+                "exact",
+                "lte",
+                "gte",
+                "year",
+            ],
+            "is_closed": ["exact"],
+        }
+
+
+class PortfolioFilter(django_filters.FilterSet):
+    vintage = django_filters.NumberFilter(
+        field_name="issue_date", lookup_expr="year")
+
+    class Meta:
+        model = Loan
+        fields = {
+            "rating": ["exact", "in"],
+        }
@@ -0,0 +1,839 @@
+"""
+Bulk import engines for loan and cash flow files
+"""
+import csv
+import logging
+import time
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+
+from . import caching
+from .metrics import recompute_chunk
+from .models import (Cashflow, Loan, PortfolioStatistics, StatisticsRollup,
+                     record_loan_changes, rollup_delta, statistics_delta)
+from .validation import CASHFLOW_VALIDATORS, LOAN_VALIDATORS, validate_rows
+
+logger = logging.getLogger(__name__)
+
+LOAN_CSV_FIELDS = [
+    "identifier",
+    "issue_date",
+    "total_amount",
+    "rating",
+    "maturity_date",
+    "total_expected_interest_amount",
+]
+
+CASHFLOW_CSV_FIELDS = [
+    "loan_identifier",
+    "reference_date",
+    "type",
+    "amount",
+]
+
+# Loan fields taken from the file, as opposed to the calculated ones
+LOAN_CONTENT_FIELDS = LOAN_CSV_FIELDS[1:]
+
+# Cash flows are matched on these fields when importing in upsert mode
+CASHFLOW_NATURAL_KEY = ["loan_identifier", "type", "reference_date"]
+
+# reason upserted cash flows sharing the natural key of an earlier row of
+# the file are rejected with, as they cannot be told apart from it
+DUPLICATE_CASHFLOW = (
+    "duplicate loan_identifier, type and reference_date of an earlier row")
+
+IMPORT_BACKENDS = ("orm", "copy")
+
+IMPORT_MODES = ("insert", "upsert")
+
+# Regular expressions used to reject malformed staging rows before casting
+DATE_PATTERN = r"^[0-9]{4}-(0[1-9]|1[0-2])-(0[1-9]|[12][0-9]|3[01])$"
+DECIMAL_PATTERN = r"^-?[0-9]{1,8}(\.[0-9]{1,2})?$"
+
+IDENTIFIER_MAX_LENGTH = Loan._meta.get_field("identifier").max_length
+
+# Casts a staging value to a date without aborting the transaction, so that
+# impossible dates such as 2021-02-30 are rejected like any other bad row
+IS_DATE_FUNCTION = """
+    CREATE OR REPLACE FUNCTION pg_temp.is_date(value text) RETURNS boolean
+    LANGUAGE plpgsql STABLE AS $$
+    BEGIN
+        PERFORM value::date;
+        RETURN true;
+    EXCEPTION WHEN others THEN
+        RETURN false;
+    END
+    $$
+"""
+
+
+def _invalid_date(column):
+    return (f"coalesce({column}, '') !~ '{DATE_PATTERN}' "
+            f"OR NOT pg_temp.is_date({column})")
+
+
+def _invalid_identifier(column):
+    return (f"coalesce({column}, '') = '' "
+            f"OR length({column}) > {IDENTIFIER_MAX_LENGTH}")
+
+
+# (column, condition, reason) checks run against the COPY staging tables,
+# mirroring LOAN_VALIDATORS and CASHFLOW_VALIDATORS
+LOAN_STAGING_CHECKS = [
+    ("identifier", _invalid_identifier("identifier"), "invalid"),
+    ("issue_date", _invalid_date("issue_date"), "invalid"),
+    ("total_amount", f"coalesce(total_amount, '') !~ '{DECIMAL_PATTERN}'",
+     "invalid"),
+    ("rating", "coalesce(rating, '') !~ '^[1-9]$'", "invalid"),
+    ("maturity_date", _invalid_date("maturity_date"), "invalid"),
+    ("total_expected_interest_amount",
+     f"coalesce(total_expected_interest_amount, '') !~ '{DECIMAL_PATTERN}'",
+     "invalid"),
+]
+# checks of the valid staging loans in insert mode, which rejects the loans
+# that already exist or repeat an earlier row of the file, as write_loans does
+LOAN_INSERT_CHECKS = [
+    ("identifier",
+     f"EXISTS (SELECT 1 FROM {Loan._meta.db_table} AS l "
+     "WHERE l.identifier = loan_staging.identifier)",
+     "existing"),
+    ("identifier",
+     "EXISTS (SELECT 1 FROM loan_staging AS b "
+     "WHERE b.identifier = loan_staging.identifier "
+     "AND b.ctid < loan_staging.ctid)",
+     "duplicate"),
+]
+CASHFLOW_STAGING_CHECKS = [
+    ("loan_identifier", _invalid_identifier("loan_identifier"), "invalid"),
+    ("reference_date", _invalid_date("reference_date"), "invalid"),
+    ("type", "upper(coalesce(type, '')) NOT IN ({})".format(
+        ", ".join(f"'{key}'" for key, _ in Cashflow.TYPES)), "invalid"),
+    ("amount", f"coalesce(amount, '') !~ '{DECIMAL_PATTERN}'", "invalid"),
+    ("loan_identifier",
+     f"NOT EXISTS (SELECT 1 FROM {Loan._meta.db_table} AS l "
+     "WHERE l.identifier = cashflow_staging.loan_identifier)",
+     "unknown"),
+]
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    """
+    Yield successive lists of at most ``size`` items from ``iterable``.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def invalidate_statistics_cache():
+    caching.invalidate(
+        settings.INVESTMENT_STATISTICS_CACHE_KEY,
+        settings.INVESTMENT_STATISTICS_CACHE_HARD_TIMEOUT,
+    )
+    caching.invalidate_responses()
+
+
+def import_loans(
+        rows, fieldnames, batch_size=None, mode="insert", progress=None,
+        rejects=None) -> Dict:
+    """
+    Write loans from parsed CSV rows in batches of ``batch_size``.
+
+    Every batch is validated column by column first; invalid rows are
+    skipped and streamed with their reason to the optional ``rejects``
+    writer. The valid rows are written by ``write_loans``.
+    """
+    batch_size = batch_size or settings.CSV_IMPORT_BATCH_SIZE
+    if list(fieldnames or []) != LOAN_CSV_FIELDS:
+        logger.warning("Wrong fields in loans CSV file")
+        return _report("loans", time.monotonic())
+
+    return write_loans(
+        _validated_batches(rows, batch_size, LOAN_VALIDATORS, _build_loan),
+        batch_size=batch_size,
+        mode=mode,
+        progress=progress,
+        rejects=rejects,
+    )
+
+
+def import_cashflows(
+        rows, fieldnames, batch_size=None, recompute=True, mode="insert",
+        progress=None, rejects=None) -> Dict:
+    """
+    Write cash flows from parsed CSV rows in batches of ``batch_size``.
+
+    Batches are validated as in ``import_loans`` and the valid rows are
+    written by ``write_cashflows``.
+    """
+    batch_size = batch_size or settings.CSV_IMPORT_BATCH_SIZE
+    if list(fieldnames or []) != CASHFLOW_CSV_FIELDS:
+        logger.warning("Wrong fields in cash flows CSV file")
+        return _report("cash flows", time.monotonic())
+
+    return write_cashflows(
+        _validated_batches(
+            rows, batch_size, CASHFLOW_VALIDATORS, _build_cashflow),
+        batch_size=batch_size,
+        recompute=recompute,
+        mode=mode,
+        progress=progress,
+        rejects=rejects,
+    )
+
+
+def write_loans(
+        batches, batch_size=None, mode="insert", progress=None,
+        rejects=None) -> Dict:
+    """
+    Write batches of ``(rows_read, loans, rejected)`` produced by a reader.
+
+    In ``insert`` mode every loan is inserted. In ``upsert`` mode loans are
+    merged on ``identifier``: new loans are inserted, loans whose content
+    changed are updated (and their calculated fields recomputed) and
+    unchanged loans are not written at all.
+
+    The rejected rows of every batch are streamed to the optional
+    ``rejects`` writer. Each batch is written in its own transaction and
+    reported to the optional ``progress`` callback. The statistics cache is
+    invalidated once at the end instead of once per row.
+    """
+    batch_size = batch_size or settings.CSV_IMPORT_BATCH_SIZE
+    started = time.monotonic()
+    counts = {
+        "rows_read": 0,
+        "rows_inserted": 0,
+        "rows_updated": 0,
+        "rows_rejected": 0,
+    }
+    updated_identifiers = set()
+    seen_identifiers = set()
+
+    for rows_read, loans, rejected in batches:
+        if mode != "upsert":
+            loans = _reject_existing_loans(loans, seen_identifiers, rejected)
+        _reject(rejects, rejected)
+        with transaction.atomic():
+            if mode == "upsert":
+                new_loans, changed_loans = _merge_loans(loans)
+            else:
+                new_loans, changed_loans = loans, []
+            new_loans = Loan.objects.bulk_create(
+                new_loans, batch_size=batch_size)
+            Loan.objects.bulk_update(
+                changed_loans, LOAN_CONTENT_FIELDS, batch_size=batch_size)
+            record_loan_changes(
+                [loan.saved_contributions() for loan in changed_loans],
+                [loan.contributions() for loan in new_loans + changed_loans],
+            )
+        updated_identifiers.update(loan.identifier for loan in changed_loans)
+        batch_counts = {
+            "rows_read": rows_read,
+            "rows_inserted": len(new_loans),
+            "rows_updated": len(changed_loans),
+            "rows_rejected": len(rejected),
+        }
+        _count(counts, batch_counts)
+        _notify(progress, **batch_counts)
+
+    recompute_loans(updated_identifiers, batch_size=batch_size)
+    invalidate_statistics_cache()
+
+    return _report("loans", started, **counts)
+
+
+def write_cashflows(
+        batches, batch_size=None, recompute=True, mode="insert",
+        progress=None, rejects=None) -> Dict:
+    """
+    Write batches of ``(rows_read, cashflows, rejected)`` produced by a
+    reader.
+
+    Loan identifiers are resolved with one ``IN`` query per batch (only for
+    identifiers not seen before); cash flows of unknown loans are rejected.
+    The calculated fields of every touched loan are recomputed once after
+    all cash flows have been written. With ``recompute=False`` the
+    recompute is left to the caller and the touched identifiers are
+    returned under ``loan_identifiers``.
+
+    In ``upsert`` mode cash flows are merged on the
+    ``CASHFLOW_NATURAL_KEY``: only new cash flows and changed amounts are
+    written, and only loans with such changes count as touched. Rows
+    repeating the natural key of an earlier row are rejected rather than
+    merged into it. Batches are committed and reported as in
+    ``write_loans``.
+    """
+    batch_size = batch_size or settings.CSV_IMPORT_BATCH_SIZE
+    started = time.monotonic()
+    counts = {
+        "rows_read": 0,
+        "rows_inserted": 0,
+        "rows_updated": 0,
+        "rows_rejected": 0,
+    }
+    known_identifiers = set()
+    missing_identifiers = set()
+    touched_identifiers = set()
+    seen_keys = set()
+
+    for rows_read, cashflows, rejected in batches:
+        unresolved = {
+            cashflow.loan_identifier_id for cashflow in cashflows
+        } - known_identifiers - missing_identifiers
+        if unresolved:
+            found = set(
+                Loan.objects.filter(identifier__in=unresolved)
+                .values_list("identifier", flat=True))
+            known_identifiers |= found
+            missing_identifiers |= unresolved - found
+
+        accepted = []
+        for cashflow in cashflows:
+            if cashflow.loan_identifier_id not in known_identifiers:
+                rejected.append((
+                    _cashflow_row(cashflow),
+                    "unknown loan_identifier: "
+                    f"{cashflow.loan_identifier_id!r}"))
+            elif mode != "upsert":
+                accepted.append(cashflow)
+            elif _natural_key(cashflow) in seen_keys:
+                rejected.append((_cashflow_row(cashflow), DUPLICATE_CASHFLOW))
+            else:
+                seen_keys.add(_natural_key(cashflow))
+                accepted.append(cashflow)
+        _reject(rejects, rejected)
+
+        with transaction.atomic():
+            if mode == "upsert":
+                new_cashflows, changed_cashflows, replaced = (
+                    _merge_cashflows(accepted))
+            else:
+                new_cashflows, changed_cashflows, replaced = accepted, [], []
+            Cashflow.objects.bulk_create(new_cashflows, batch_size=batch_size)
+            Cashflow.objects.bulk_update(
+                changed_cashflows, ["amount"], batch_size=batch_size)
+            PortfolioStatistics.add(
+                statistics_delta(
+                    replaced,
+                    [cashflow.statistics()
+                     for cashflow in new_cashflows + changed_cashflows],
+                ),
+                since=min(
+                    (cashflow.dated()
+                     for cashflow in new_cashflows + changed_cashflows),
+                    default=None,
+                ),
+            )
+        touched_identifiers.update(
+            cashflow.loan_identifier_id
+            for cashflow in new_cashflows + changed_cashflows)
+        batch_counts = {
+            "rows_read": rows_read,
+            "rows_inserted": len(new_cashflows),
+            "rows_updated": len(changed_cashflows),
+            "rows_rejected": len(rejected),
+        }
+        _count(counts, batch_counts)
+        _notify(progress, **batch_counts)
+
+    if recompute:
+        recompute_loans(touched_identifiers, batch_size=batch_size)
+
+    invalidate_statistics_cache()
+
+    report = _report("cash flows", started, **counts)
+    if not recompute:
+        report["loan_identifiers"] = sorted(touched_identifiers)
+    return report
+
+
+def _validated_batches(rows, batch_size, validators, build):
+    """
+    Validate parsed CSV rows in batches and build model instances from the
+    valid ones, yielding ``(rows_read, instances, rejected)``.
+    """
+    for chunk in chunked(rows, batch_size):
+        valid, rejected = validate_rows(chunk, validators)
+        yield len(chunk), [build(row) for row in valid], rejected
+
+
+def _build_loan(row) -> Loan:
+    return Loan(**{field: row[field] for field in LOAN_CSV_FIELDS})
+
+
+def _build_cashflow(row) -> Cashflow:
+    return Cashflow(
+        loan_identifier_id=row["loan_identifier"],
+        reference_date=row["reference_date"],
+        type=row["type"],
+        amount=row["amount"],
+    )
+
+
+def _cashflow_row(cashflow) -> Dict:
+    return {
+        "loan_identifier": cashflow.loan_identifier_id,
+        "reference_date": cashflow.reference_date,
+        "type": cashflow.type,
+        "amount": cashflow.amount,
+    }
+
+
+def _reject_existing_loans(loans, seen_identifiers, rejected):
+    """
+    Move to ``rejected`` the loans whose identifier already exists, or came
+    with an earlier row of the file, and return the others.
+    """
+    existing = set(
+        Loan.objects.filter(identifier__in=[loan.identifier for loan in loans])
+        .values_list("identifier", flat=True))
+    accepted = []
+    for loan in loans:
+        if loan.identifier in existing:
+            reason = "existing"
+        elif loan.identifier in seen_identifiers:
+            reason = "duplicate"
+        else:
+            seen_identifiers.add(loan.identifier)
+            accepted.append(loan)
+            continue
+        rejected.append((
+            _loan_row(loan), f"{reason} identifier: {loan.identifier!r}"))
+    return accepted
+
+
+def _loan_row(loan) -> Dict:
+    return {field: getattr(loan, field) for field in LOAN_CSV_FIELDS}
+
+
+def _merge_loans(loans):
+    """
+    Split a batch of loans into new loans and existing loans whose content
+    changed, the latter updated in memory. Later loans win over earlier
+    loans with the same identifier.
+    """
+    incoming = {loan.identifier: loan for loan in loans}
+    existing = Loan.objects.in_bulk(list(incoming), field_name="identifier")
+    new_loans, changed_loans = [], []
+    for identifier, loan in incoming.items():
+        current = existing.get(identifier)
+        if current is None:
+            new_loans.append(loan)
+        elif _assign_changed(current, loan, LOAN_CONTENT_FIELDS):
+            changed_loans.append(current)
+    return new_loans, changed_loans
+
+
+def _merge_cashflows(cashflows):
+    """
+    Split cash flows into new cash flows and existing cash flows whose
+    amount changed, matching them on ``CASHFLOW_NATURAL_KEY``, along with
+    the statistics contributions the changed cash flows replace.
+    """
+    incoming = {_natural_key(cashflow): cashflow for cashflow in cashflows}
+
+    existing = {}
+    for cashflow in Cashflow.objects.filter(
+            loan_identifier__in={key[0] for key in incoming}):
+        existing.setdefault(_natural_key(cashflow), cashflow)
+
+    new_cashflows, changed_cashflows, replaced = [], [], []
+    for key, cashflow in incoming.items():
+        current = existing.get(key)
+        if current is None:
+            new_cashflows.append(cashflow)
+        elif current.amount != cashflow.amount:
+            replaced.append(current.statistics())
+            current.amount = cashflow.amount
+            changed_cashflows.append(current)
+    return new_cashflows, changed_cashflows, replaced
+
+
+def _natural_key(cashflow):
+    return tuple(
+        getattr(cashflow, Cashflow._meta.get_field(field).attname)
+        for field in CASHFLOW_NATURAL_KEY)
+
+
+def _assign_changed(instance, source, fields) -> bool:
+    changed = False
+    for field_name in fields:
+        value = getattr(source, field_name)
+        if getattr(instance, field_name) != value:
+            setattr(instance, field_name, value)
+            changed = True
+    return changed
+
+
+def _reject(rejects, rejected):
+    for row, reason in rejected:
+        logger.warning(f"Rejected row {row}: {reason}")
+    if rejects is not None:
+        rejects.write(rejected)
+
+
+def resolve_backend(backend=None) -> str:
+    """
+    Return the import backend to use, falling back to the ORM when the COPY
+    backend is requested on a database other than PostgreSQL.
+    """
+    backend = backend or settings.CSV_IMPORT_BACKEND
+    if backend not in IMPORT_BACKENDS:
+        raise ValueError(f"Unknown import backend {backend!r}")
+    if backend == "copy" and connection.vendor != "postgresql":
+        logger.warning(
+            f"COPY import is not supported on {connection.vendor}, "
+            "falling back to the ORM backend")
+        return "orm"
+    return backend
+
+
+def resolve_mode(mode=None) -> str:
+    mode = mode or settings.CSV_IMPORT_MODE
+    if mode not in IMPORT_MODES:
+        raise ValueError(f"Unknown import mode {mode!r}")
+    return mode
+
+
+def load_loans(
+        stream, backend=None, batch_size=None, mode=None, progress=None,
+        rejects=None) -> Dict:
+    """
+    Import loans from a CSV text stream with the selected backend and mode.
+    """
+    mode = resolve_mode(mode)
+    if resolve_backend(backend) == "copy":
+        return copy_loans(
+            stream,
+            batch_size=batch_size,
+            mode=mode,
+            progress=progress,
+            rejects=rejects,
+        )
+    csv_data = csv.DictReader(stream)
+    return import_loans(
+        csv_data,
+        csv_data.fieldnames,
+        batch_size=batch_size,
+        mode=mode,
+        progress=progress,
+        rejects=rejects,
+    )
+
+
+def load_cashflows(
+        stream, backend=None, batch_size=None, recompute=True, mode=None,
+        progress=None, rejects=None) -> Dict:
+    """
+    Import cash flows from a CSV text stream with the selected backend and
+    mode.
+    """
+    mode = resolve_mode(mode)
+    if resolve_backend(backend) == "copy":
+        return copy_cashflows(
+            stream,
+            batch_size=batch_size,
+            recompute=recompute,
+            mode=mode,
+            progress=progress,
+            rejects=rejects,
+        )
+    csv_data = csv.DictReader(stream)
+    return import_cashflows(
+        csv_data,
+        csv_data.fieldnames,
+        batch_size=batch_size,
+        recompute=recompute,
+        mode=mode,
+        progress=progress,
+        rejects=rejects,
+    )
+
+
+def copy_loans(
+        stream, batch_size=None, mode="insert", progress=None,
+        rejects=None) -> Dict:
+    """
+    Load loans into a staging table with ``COPY FROM STDIN`` and merge the
+    valid rows into the loans table with set-based SQL (PostgreSQL only).
+
+    Malformed rows are deleted from the staging table and streamed to the
+    optional ``rejects`` writer. Identifiers that already exist are
+    rejected in ``insert`` mode and updated, if their content changed, in
+    ``upsert`` mode.
+    """
+    started = time.monotonic()
+    if not _read_header(stream, LOAN_CSV_FIELDS):
+        logger.warning("Wrong fields in loans CSV file")
+        return _report("loans", started)
+
+    # the loans of the file, once staged; their rollup cells are compared
+    # before and after the merge
+    staged = Loan.objects.filter(
+        identifier__in=RawSQL("SELECT identifier FROM loan_staging", []))
+    with transaction.atomic(), connection.cursor() as cursor:
+        rows_read = _copy_to_staging(
+            cursor, "loan_staging", LOAN_CSV_FIELDS, stream)
+        rows_rejected = _reject_staging_rows(
+            cursor, "loan_staging", LOAN_CSV_FIELDS, LOAN_STAGING_CHECKS,
+            rejects)
+        if mode != "upsert":
+            rows_rejected += _reject_staging_rows(
+                cursor, "loan_staging", LOAN_CSV_FIELDS, LOAN_INSERT_CHECKS,
+                rejects)
+        rollup_before = StatisticsRollup.of_loans(staged)
+        if mode == "upsert":
+            # Later rows win over earlier rows with the same identifier
+            cursor.execute(
+                """
+                DELETE FROM loan_staging AS a
+                USING loan_staging AS b
+                WHERE a.identifier = b.identifier AND a.ctid < b.ctid
+                """
+            )
+            conflict = f"""
+                DO UPDATE SET {", ".join(
+                    f"{field} = EXCLUDED.{field}"
+                    for field in LOAN_CONTENT_FIELDS)}
+                WHERE ({", ".join(
+                    f"t.{field}" for field in LOAN_CONTENT_FIELDS)})
+                IS DISTINCT FROM ({", ".join(
+                    f"EXCLUDED.{field}" for field in LOAN_CONTENT_FIELDS)})
+            """
+        else:
+            # only loans inserted concurrently are left to conflict
+            conflict = "DO NOTHING"
+        cursor.execute(
+            f"""
+            INSERT INTO {Loan._meta.db_table} AS t (
+                identifier, issue_date, total_amount, rating,
+                maturity_date, total_expected_interest_amount, is_closed,
+                total_repaid, repayment_count, needs_recompute
+            )
+            SELECT identifier, issue_date::date, total_amount::numeric,
+                   rating::integer, maturity_date::date,
+                   total_expected_interest_amount::numeric, false, 0, 0,
+                   false
+            FROM loan_staging
+            ON CONFLICT (identifier) {conflict}
+            RETURNING identifier, xmax = 0
+            """
+        )
+        written = cursor.fetchall()
+        StatisticsRollup.add(rollup_delta(
+            rollup_before.items(), StatisticsRollup.of_loans(staged).items()))
+
+    updated_identifiers = [
+        identifier for identifier, inserted in written if not inserted]
+    counts = {
+        "rows_read": rows_read,
+        "rows_inserted": len(written) - len(updated_identifiers),
+        "rows_updated": len(updated_identifiers),
+        "rows_rejected": rows_rejected,
+    }
+    _notify(progress, **counts)
+    recompute_loans(updated_identifiers, batch_size=batch_size)
+    invalidate_statistics_cache()
+
+    return _report("loans", started, **counts)
+
+
+def copy_cashflows(
+        stream, batch_size=None, recompute=True, mode="insert",
+        progress=None, rejects=None) -> Dict:
+    """
+    Load cash flows into a staging table with ``COPY FROM STDIN`` and merge
+    the valid rows of known loans into the cash flows table with set-based
+    SQL (PostgreSQL only). Rejected rows, upsert mode and the recompute of
+    touched loans behave as in ``copy_loans`` and ``import_cashflows``.
+    """
+    started = time.monotonic()
+    if not _read_header(stream, CASHFLOW_CSV_FIELDS):
+        logger.warning("Wrong fields in cash flows CSV file")
+        return _report("cash flows", started)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        rows_read = _copy_to_staging(
+            cursor, "cashflow_staging", CASHFLOW_CSV_FIELDS, stream)
+        rows_rejected = _reject_staging_rows(
+            cursor, "cashflow_staging", CASHFLOW_CSV_FIELDS,
+            CASHFLOW_STAGING_CHECKS, rejects)
+        updated = []
+        if mode == "upsert":
+            # Rows repeating the natural key of an earlier row are
+            # rejected; the staging rows were never updated, so their ctid
+            # is still the order of the file
+            columns = ", ".join(
+                f"a.{column}" for column in CASHFLOW_CSV_FIELDS)
+            cursor.execute(
+                f"""
+                DELETE FROM cashflow_staging AS a
+                USING cashflow_staging AS b
+                WHERE a.loan_identifier = b.loan_identifier
+                  AND upper(a.type) = upper(b.type)
+                  AND a.reference_date::date = b.reference_date::date
+                  AND a.ctid > b.ctid
+                RETURNING {columns}
+                """
+            )
+            duplicates = [
+                (dict(zip(CASHFLOW_CSV_FIELDS, row)), DUPLICATE_CASHFLOW)
+                for row in cursor.fetchall()]
+            _reject(rejects, duplicates)
+            rows_rejected += len(duplicates)
+            # the self join returns the amount each update replaced
+            cursor.execute(
+                f"""
+                UPDATE {Cashflow._meta.db_table} AS c
+                SET amount = s.amount::numeric
+                FROM cashflow_staging AS s, {Cashflow._meta.db_table} AS old
+                WHERE c.loan_identifier_id = s.loan_identifier
+                  AND c.type = upper(s.type)
+                  AND c.reference_date = s.reference_date::date
+                  AND c.amount <> s.amount::numeric
+                  AND old.id = c.id
+                RETURNING c.loan_identifier_id, c.type, old.amount, c.amount,
+                          c.reference_date
+                """
+            )
+            updated = cursor.fetchall()
+            cursor.execute(
+                f"""
+                DELETE FROM cashflow_staging AS s
+                USING {Cashflow._meta.db_table} AS c
+                WHERE c.loan_identifier_id = s.loan_identifier
+                  AND c.type = upper(s.type)
+                  AND c.reference_date = s.reference_date::date
+                """
+            )
+        cursor.execute(
+            f"""
+            INSERT INTO {Cashflow._meta.db_table} (
+                loan_identifier_id, reference_date, type, amount
+            )
+            SELECT loan_identifier, reference_date::date, upper(type),
+                   amount::numeric
+            FROM cashflow_staging
+            RETURNING loan_identifier_id, type, amount, reference_date
+            """
+        )
+        inserted = cursor.fetchall()
+        PortfolioStatistics.add(
+            statistics_delta(
+                [Cashflow(type=kind, amount=old).statistics()
+                 for _, kind, old, _, _ in updated],
+                [Cashflow(type=kind, amount=new).statistics()
+                 for _, kind, _, new, _ in updated]
+                + [Cashflow(type=kind, amount=amount).statistics()
+                   for _, kind, amount, _ in inserted],
+            ),
+            since=min((row[-1] for row in inserted + updated), default=None),
+        )
+
+    identifiers = {row[0] for row in inserted + updated}
+    counts = {
+        "rows_read": rows_read,
+        "rows_inserted": len(inserted),
+        "rows_updated": len(updated),
+        "rows_rejected": rows_rejected,
+    }
+    _notify(progress, **counts)
+    if recompute:
+        recompute_loans(identifiers, batch_size=batch_size)
+
+    invalidate_statistics_cache()
+
+    report = _report("cash flows", started, **counts)
+    if not recompute:
+        report["loan_identifiers"] = sorted(identifiers)
+    return report
+
+
+def _read_header(stream, expected_fields) -> bool:
+    header = next(csv.reader([stream.readline()]), [])
+    return header == expected_fields
+
+
+def _reject_staging_rows(cursor, table, columns, checks, rejects) -> int:
+    """
+    Delete the staging rows failing any of ``checks`` and stream them with
+    the reason of their first failing check to ``rejects``.
+    """
+    reasons = " ".join(
+        f"WHEN {condition} THEN format('{reason} {column}: %L', {column})"
+        for column, condition, reason in checks)
+    cursor.execute(
+        f"""
+        DELETE FROM {table}
+        WHERE {" OR ".join(f"({condition})" for _, condition, _ in checks)}
+        RETURNING {", ".join(columns)}, CASE {reasons} END
+        """
+    )
+    rejected = [
+        (dict(zip(columns, row[:-1])), row[-1]) for row in cursor.fetchall()]
+    _reject(rejects, rejected)
+    return len(rejected)
+
+
+def _copy_to_staging(cursor, table, columns, stream):
+    column_list = ", ".join(columns)
+    cursor.execute(IS_DATE_FUNCTION)
+    cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    cursor.execute(
+        f"CREATE TEMPORARY TABLE {table} "
+        f"({', '.join(f'{column} text' for column in columns)}) "
+        "ON COMMIT DROP")
+    cursor.cursor.copy_expert(
+        f"COPY {table} ({column_list}) FROM STDIN WITH (FORMAT csv)",
+        stream,
+    )
+    cursor.execute(f"SELECT count(*) FROM {table}")
+    return cursor.fetchone()[0]
+
+
+def recompute_loans(identifiers, batch_size=None):
+    """
+    Recompute and store the calculated fields of the given loans, once each.
+    """
+    batch_size = batch_size or settings.CSV_IMPORT_BATCH_SIZE
+    for chunk in chunked(sorted(identifiers), batch_size):
+        recompute_chunk(
+            Loan.objects.filter(identifier__in=chunk).order_by("pk"),
+            batch_size=batch_size,
+        )
+
+
+def _count(counts, batch_counts):
+    for key, value in batch_counts.items():
+        counts[key] += value
+
+
+def _notify(progress, **counts):
+    if progress is not None:
+        progress(**counts)
+
+
+def _report(
+        kind, started, rows_read=0, rows_inserted=0, rows_updated=0,
+        rows_rejected=0) -> Dict:
+    duration = time.monotonic() - started
+    rows_per_second = rows_read / duration if duration else 0.0
+    logger.info(
+        f"Imported {rows_inserted} new and {rows_updated} changed of "
+        f"{rows_read} {kind} in {duration:.2f}s "
+        f"({rows_per_second:.0f} rows/s)")
+    return {
+        "rows_read": rows_read,
+        "rows_inserted": rows_inserted,
+        "rows_updated": rows_updated,
+        "rows_rejected": rows_rejected,
+        "duration": duration,
+        "rows_per_second": rows_per_second,
+    }
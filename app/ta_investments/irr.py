@@ -0,0 +1,190 @@
+"""
+Internal rates of return: closed form for the two-flow expected cash flows
+and a memoised XIRR solver for the realized ones and for portfolio series
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import date
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, FloatField, Func, Value
+from django.db.models.functions import Cast, Power
+from pyxirr import InvalidPaymentsError, xirr
+
+# pyxirr's default day count convention (ACT/365F)
+DAYS_PER_YEAR = 365
+
+
+def expected_irr(
+        total_amount: Decimal, total_expected_interest_amount: Decimal,
+        investment_date: date, maturity_date: date) -> Optional[float]:
+    """
+    Return the XIRR of investing at ``investment_date`` and being repaid
+    with the expected interest at ``maturity_date``.
+
+    With only two flows the XIRR equation has the closed-form solution
+    ``(1 + interest / total) ** (365 / days) - 1``. The invested amount
+    cancels out since the expected interest is pro rata to it.
+    """
+    days = (_as_date(maturity_date) - _as_date(investment_date)).days
+    total_amount = float(total_amount)
+    if days <= 0 or total_amount <= 0:
+        return None
+    growth = 1 + float(total_expected_interest_amount) / total_amount
+    if growth <= 0:
+        return None
+    return growth ** (DAYS_PER_YEAR / days) - 1
+
+
+def _as_date(value) -> date:
+    # unsaved instances may still hold the ISO strings they were given
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+class DaysBetween(Func):
+    """Number of days from the first date expression to the second."""
+
+    template = "(%(expressions)s)"
+    arg_joiner = " - "
+    output_field = FloatField()
+
+    def __init__(self, start, end, **extra):
+        super().__init__(end, start, **extra)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(
+            compiler,
+            connection,
+            template="(julianday(%(expressions)s))",
+            arg_joiner=") - julianday(",
+            **extra_context,
+        )
+
+
+def expected_irr_expression():
+    """
+    ``expected_irr`` as a database expression over the loan columns, for
+    annotations and bulk ``UPDATE`` statements. Only valid for the loans
+    selected by ``EXPECTED_IRR_COMPUTABLE``.
+    """
+    growth = Value(1.0) + Cast(
+        F("total_expected_interest_amount"), FloatField()) / Cast(
+        F("total_amount"), FloatField())
+    return Power(
+        growth,
+        Value(float(DAYS_PER_YEAR)) / DaysBetween(
+            F("investment_date"), F("maturity_date")),
+        output_field=FloatField(),
+    ) - Value(1.0)
+
+
+# filter() keyword arguments selecting the loans expected_irr_expression()
+# is defined for
+EXPECTED_IRR_COMPUTABLE = {
+    "investment_date__isnull": False,
+    "maturity_date__gt": F("investment_date"),
+    "total_amount__gt": 0,
+    "total_expected_interest_amount__gt": -F("total_amount"),
+}
+
+
+class _LRU:
+    """A small thread-safe least recently used mapping."""
+
+    def __init__(self):
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value, maxsize):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_MISSING = object()
+_local_results = _LRU()
+_stats_lock = threading.Lock()
+_stats = {"local_hits": 0, "shared_hits": 0, "misses": 0}
+
+
+def fingerprint(dates: Iterable[date], amounts: Iterable) -> str:
+    """
+    Hash of a set of cash flows, independent of their order and of how the
+    amounts are written (``Decimal("100.00")`` and ``100`` are the same).
+    """
+    flows = sorted(
+        (_as_date(day).isoformat(),
+         format(Decimal(str(amount)).normalize(), "f"))
+        for day, amount in zip(dates, amounts))
+    payload = ";".join(f"{day}:{amount}" for day, amount in flows)
+    return hashlib.sha1(payload.encode("ascii")).hexdigest()
+
+
+def cached_xirr(dates: List[date], amounts: List) -> Optional[float]:
+    """
+    ``pyxirr.xirr`` memoised by the ``fingerprint`` of the cash flows, in a
+    bounded in-process LRU in front of the shared Django cache.
+    """
+    key = fingerprint(dates, amounts)
+    result = _local_results.get(key, _MISSING)
+    if result is not _MISSING:
+        _count("local_hits")
+        return result
+
+    cache_key = f"{settings.XIRR_CACHE_KEY_PREFIX}:{key}"
+    result = cache.get(cache_key, _MISSING)
+    if result is not _MISSING:
+        _count("shared_hits")
+    else:
+        _count("misses")
+        result = xirr(dates, amounts)
+        cache.set(cache_key, result, timeout=settings.XIRR_CACHE_TIMEOUT)
+    _local_results.set(key, result, settings.XIRR_CACHE_SIZE)
+    return result
+
+
+def series_xirr(series: Dict[date, Decimal]) -> Optional[float]:
+    """
+    ``cached_xirr`` of a series of net amounts by day, or None when it is
+    undefined for lack of both outgoing and incoming payments.
+    """
+    try:
+        return cached_xirr(list(series), list(series.values()))
+    except InvalidPaymentsError:
+        return None
+
+
+def xirr_cache_stats() -> Dict[str, int]:
+    """Hit and miss counters of ``cached_xirr`` in this process."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def clear_xirr_cache():
+    """Empty the in-process layer and reset the counters."""
+    _local_results.clear()
+    with _stats_lock:
+        for name in _stats:
+            _stats[name] = 0
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
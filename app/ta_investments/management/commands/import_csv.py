@@ -0,0 +1,61 @@
+"""
+Django command to import a loans or cash flows CSV file synchronously,
+optionally compressed as .gz, .bz2 or .zip, or a Parquet file
+"""
+from contextlib import ExitStack
+
+from django.core.management.base import BaseCommand, CommandError
+from ta_investments.columnar import (load_cashflows_parquet,
+                                     load_loans_parquet)
+from ta_investments.importers import (IMPORT_BACKENDS, IMPORT_MODES,
+                                      load_cashflows, load_loans)
+from ta_investments.uploads import is_parquet_upload, open_csv
+
+
+class Command(BaseCommand):
+    """Django command to import a CSV file"""
+
+    help = "Import a loans or cash flows CSV file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("kind", choices=["loans", "cashflows"])
+        parser.add_argument("path")
+        parser.add_argument(
+            "--backend",
+            choices=IMPORT_BACKENDS,
+            help="Import backend; COPY falls back to the ORM outside "
+                 "PostgreSQL.",
+        )
+        parser.add_argument(
+            "--mode",
+            choices=IMPORT_MODES,
+            help="Insert new rows only, or upsert and skip unchanged rows.",
+        )
+        parser.add_argument("--batch-size", type=int)
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        path = options["path"]
+        if is_parquet_upload(path):
+            load = (load_loans_parquet if options["kind"] == "loans"
+                    else load_cashflows_parquet)
+        else:
+            load = (load_loans if options["kind"] == "loans"
+                    else load_cashflows)
+        try:
+            with open(path, "rb") as f, ExitStack() as stack:
+                if not is_parquet_upload(path):
+                    f = stack.enter_context(open_csv(f, path))
+                result = load(
+                    f,
+                    backend=options["backend"],
+                    mode=options["mode"],
+                    batch_size=options["batch_size"],
+                )
+        except (OSError, ValueError) as exc:
+            raise CommandError(exc)
+
+        self.stdout.write(self.style.SUCCESS(
+            "Imported {rows_inserted} new and {rows_updated} changed rows "
+            "in {duration:.2f}s ({rows_per_second:.0f} rows/s)".format(
+                **result)))
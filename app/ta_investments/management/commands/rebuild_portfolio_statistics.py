@@ -0,0 +1,59 @@
+"""
+Django command to rebuild the materialised portfolio statistics and the
+statistics rollup
+"""
+from django.core.management.base import BaseCommand, CommandError
+from ta_investments.models import Loan, PortfolioStatistics, StatisticsRollup
+from ta_investments.utils import calculate_investment_statistics
+
+
+class Command(BaseCommand):
+    """Django command to rebuild the portfolio statistics"""
+
+    help = "Recompute the portfolio statistics and the statistics rollup " \
+           "from the loans and cash flows, reporting any drift of the " \
+           "incrementally maintained ones."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Only report the drift, without rebuilding.",
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        stored = PortfolioStatistics.current()
+        stored_cells = StatisticsRollup.cells()
+        if options["check"]:
+            actual = calculate_investment_statistics()
+        else:
+            actual = PortfolioStatistics.rebuild().totals()
+            StatisticsRollup.rebuild()
+        actual_cells = StatisticsRollup.of_loans(Loan.objects.all())
+
+        drifted = [
+            name for name in PortfolioStatistics.TOTALS
+            if stored[name] != actual[name]
+        ]
+        for name in drifted:
+            self.stdout.write(
+                f"{name} drifted: stored {stored[name]}, "
+                f"actual {actual[name]}")
+        drifted_cells = [
+            key for key in set(stored_cells) | set(actual_cells)
+            if stored_cells.get(key) != actual_cells.get(key)
+        ]
+        if drifted_cells:
+            drifted.extend(drifted_cells)
+            self.stdout.write(
+                f"{len(drifted_cells)} statistics rollup cells drifted")
+
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS(
+                "Portfolio statistics are consistent"))
+        elif options["check"]:
+            raise CommandError("Run without --check to rebuild them")
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                "Rebuilt the portfolio statistics"))
@@ -0,0 +1,65 @@
+"""
+Django command to recompute the calculated fields of the loans in bulk
+"""
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from ta_investments.metrics import (filter_loans, recompute_loan_metrics,
+                                    refresh_expected_irr)
+from ta_investments.utils import refresh_investment_statistics
+
+
+class Command(BaseCommand):
+    """Django command to recompute loan metrics"""
+
+    help = "Recompute the calculated fields (IRRs, closure) of the loans."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--since",
+            type=date.fromisoformat,
+            help="Only loans issued or with a cash flow on or after this "
+                 "date (YYYY-MM-DD).",
+        )
+        parser.add_argument(
+            "--rating", type=int, choices=range(1, 10))
+        parser.add_argument(
+            "--only-open",
+            action="store_true",
+            help="Only loans that are not closed yet.",
+        )
+        parser.add_argument("--chunk-size", type=int)
+        parser.add_argument(
+            "--expected-irr-only",
+            action="store_true",
+            help="Only refresh expected_irr, with a single UPDATE.",
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        if options["expected_irr_only"]:
+            updated = refresh_expected_irr(filter_loans(
+                since=options["since"],
+                rating=options["rating"],
+                only_open=options["only_open"],
+            ))
+            self.stdout.write(self.style.SUCCESS(
+                f"Refreshed the expected IRR of {updated} loans"))
+            return
+
+        result = recompute_loan_metrics(
+            since=options["since"],
+            rating=options["rating"],
+            only_open=options["only_open"],
+            chunk_size=options["chunk_size"],
+            progress=lambda count: self.stdout.write(
+                f"{count} loans recomputed..."),
+        )
+        refresh_investment_statistics()
+
+        self.stdout.write(self.style.SUCCESS(
+            "Recomputed {loans_recomputed} loans in {duration:.2f}s "
+            "({loans_per_second:.0f} loans/s)".format(**result)))
+        self.stdout.write(
+            "Realized IRR cache: {local_hits} local hits, {shared_hits} "
+            "shared hits, {misses} misses".format(**result["xirr_cache"]))
@@ -0,0 +1,41 @@
+"""
+Django command to detect and repair drift of the loan repayment totals
+"""
+from django.core.management.base import BaseCommand, CommandError
+from ta_investments.importers import recompute_loans
+from ta_investments.metrics import repayment_totals_drift
+
+
+class Command(BaseCommand):
+    """Django command to verify the loan repayment totals"""
+
+    help = "Compare the running repayment totals of the loans with their " \
+           "cash flows, and optionally rebuild the ones that drifted."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Rebuild the totals of the loans that drifted.",
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        drifted = list(
+            repayment_totals_drift().values_list("identifier", flat=True))
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS(
+                "Repayment totals are consistent"))
+            return
+
+        self.stdout.write(
+            f"Repayment totals drifted for {len(drifted)} loans: "
+            f"{', '.join(drifted[:20])}{'...' if len(drifted) > 20 else ''}")
+        if not options["rebuild"]:
+            raise CommandError("Run with --rebuild to repair them")
+
+        # Recomputed like any other loan change, so closure, realized IRR
+        # and the portfolio statistics follow the rebuilt totals
+        recompute_loans(drifted)
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt the repayment totals of {len(drifted)} loans"))
@@ -0,0 +1,173 @@
+"""
+Batch recompute of the calculated loan fields and repayment totals
+"""
+import logging
+import time
+from datetime import date
+from typing import Dict, List
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import (Count, DecimalField, Exists, F, OuterRef, Q,
+                              Subquery, Sum, Value)
+from django.db.models.functions import Coalesce
+
+from . import caching
+from .irr import (EXPECTED_IRR_COMPUTABLE, expected_irr_expression,
+                  xirr_cache_stats)
+from .models import Cashflow, Loan, record_loan_changes
+
+logger = logging.getLogger(__name__)
+
+
+def recompute_chunk(queryset, batch_size=None) -> List[Loan]:
+    """
+    Recompute the calculated fields of the loans of ``queryset`` and store
+    them with a single ``bulk_update``, along with the change of the
+    portfolio statistics and of the statistics rollup.
+
+    The loans are locked as they are loaded, before their cash flows are
+    prefetched, so a cash flow written concurrently either waits for the
+    chunk or is already counted in its running totals.
+    """
+    with transaction.atomic(savepoint=False):
+        loans = list(
+            queryset.select_for_update().prefetch_related("cashflows"))
+        before = [loan.saved_contributions() for loan in loans]
+        for loan in loans:
+            loan.calculate_fields()
+        after = [loan.contributions() for loan in loans]
+        Loan.objects.bulk_update(
+            loans, Loan.CALCULATED_FIELDS, batch_size=batch_size)
+        record_loan_changes(before, after)
+        caching.invalidate_responses()
+    for loan in loans:
+        loan.saved_values = loan.statistics_values()
+    return loans
+
+
+def filter_loans(since=None, rating=None, only_open=False):
+    """
+    Select the loans issued or with a cash flow on or after ``since``, with
+    the given ``rating``, and only the open ones with ``only_open``.
+    """
+    loans = Loan.objects.all()
+    if since is not None:
+        loans = loans.filter(
+            Exists(Cashflow.objects.filter(
+                loan_identifier=OuterRef("identifier"),
+                reference_date__gte=since))
+            | Q(issue_date__gte=since))
+    if rating is not None:
+        loans = loans.filter(rating=rating)
+    if only_open:
+        loans = loans.filter(is_closed=False)
+    return loans
+
+
+def refresh_expected_irr(queryset=None) -> int:
+    """
+    Recompute ``expected_irr`` of the loans of ``queryset`` (all loans by
+    default) with a single ``UPDATE`` using the closed-form expression.
+    """
+    if queryset is None:
+        queryset = Loan.objects.all()
+    updated = queryset.filter(**EXPECTED_IRR_COMPUTABLE).update(
+        expected_irr=expected_irr_expression())
+    caching.invalidate_responses()
+    return updated
+
+
+def recompute_loan_metrics(
+        since=None, rating=None, only_open=False, chunk_size=None,
+        progress=None) -> Dict:
+    """
+    Recompute the calculated fields of every loan selected by
+    ``filter_loans`` in chunks of ``chunk_size``.
+    """
+    chunk_size = chunk_size or settings.CSV_IMPORT_BATCH_SIZE
+    started = time.monotonic()
+    loans = filter_loans(since=since, rating=rating, only_open=only_open)
+
+    stats_before = xirr_cache_stats()
+    recomputed = 0
+    last_pk = 0
+    # paginated on the primary key, so every chunk is one cheap index
+    # range scan whatever the size of the portfolio
+    while True:
+        chunk = recompute_chunk(
+            loans.filter(pk__gt=last_pk).order_by("pk")[:chunk_size],
+            batch_size=chunk_size,
+        )
+        if not chunk:
+            break
+        recomputed += len(chunk)
+        last_pk = chunk[-1].pk
+        if progress is not None:
+            progress(recomputed)
+
+    duration = time.monotonic() - started
+    loans_per_second = recomputed / duration if duration else 0.0
+    logger.info(
+        f"Recomputed {recomputed} loans in {duration:.2f}s "
+        f"({loans_per_second:.0f} loans/s)")
+    return {
+        "loans_recomputed": recomputed,
+        "duration": duration,
+        "loans_per_second": loans_per_second,
+        "xirr_cache": {
+            name: count - stats_before[name]
+            for name, count in xirr_cache_stats().items()
+        },
+    }
+
+
+def repayment_totals():
+    """
+    Expressions computing the running repayment totals of a loan from its
+    cash flows, keyed by ``Loan`` field name.
+    """
+    repayments = (
+        Cashflow.objects.filter(
+            loan_identifier=OuterRef("identifier"), type="REPAYMENT")
+        .order_by()
+        .values("loan_identifier")
+    )
+    return {
+        "total_repaid": Coalesce(
+            Subquery(repayments.annotate(total=Sum("amount"))
+                     .values("total")),
+            Value(0),
+            output_field=DecimalField(max_digits=12, decimal_places=2),
+        ),
+        "repayment_count": Coalesce(
+            Subquery(repayments.annotate(count=Count("pk"))
+                     .values("count")),
+            Value(0),
+        ),
+        "last_repayment_date": Subquery(
+            repayments.order_by("-reference_date")
+            .values("reference_date")[:1]),
+    }
+
+
+def repayment_totals_drift(queryset=None):
+    """
+    Return the loans of ``queryset`` (all loans by default) whose stored
+    repayment totals differ from their cash flows.
+    """
+    if queryset is None:
+        queryset = Loan.objects.all()
+    actual = repayment_totals()
+    return queryset.annotate(
+        actual_total_repaid=actual["total_repaid"],
+        actual_repayment_count=actual["repayment_count"],
+        actual_last_repayment_date=Coalesce(
+            actual["last_repayment_date"], Value(date.min)),
+        stored_last_repayment_date=Coalesce(
+            "last_repayment_date", Value(date.min)),
+    ).exclude(
+        total_repaid=F("actual_total_repaid"),
+        repayment_count=F("actual_repayment_count"),
+        stored_last_repayment_date=F("actual_last_repayment_date"),
+    )
@@ -0,0 +1,22 @@
+# Generated by Django 3.2.25 on 2026-10-17 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ta_investments", "0008_importjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="importjob",
+            name="mode",
+            field=models.CharField(blank=True, max_length=20),
+        ),
+        migrations.AddField(
+            model_name="importjob",
+            name="rows_updated",
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-17 15:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ta_investments", "0009_importjob_mode_rows_updated"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="importjob",
+            name="rejected_file",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
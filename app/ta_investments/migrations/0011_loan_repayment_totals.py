@@ -0,0 +1,60 @@
+# Generated by Django 3.2.25 on 2026-10-17 15:59
+
+from django.db import migrations, models
+from django.db.models import Count, DecimalField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_repayment_totals(apps, schema_editor):
+    Cashflow = apps.get_model("ta_investments", "Cashflow")
+    Loan = apps.get_model("ta_investments", "Loan")
+    repayments = (
+        Cashflow.objects.filter(
+            loan_identifier=OuterRef("identifier"), type="REPAYMENT"
+        )
+        .order_by()
+        .values("loan_identifier")
+    )
+    Loan.objects.update(
+        total_repaid=Coalesce(
+            Subquery(repayments.annotate(total=Sum("amount")).values("total")),
+            0,
+            output_field=DecimalField(max_digits=12, decimal_places=2),
+        ),
+        repayment_count=Coalesce(
+            Subquery(repayments.annotate(count=Count("pk")).values("count")),
+            0,
+        ),
+        last_repayment_date=Subquery(
+            repayments.order_by("-reference_date").values("reference_date")[:1]
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ta_investments", "0010_importjob_rejected_file"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="loan",
+            name="last_repayment_date",
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="loan",
+            name="repayment_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="loan",
+            name="total_repaid",
+            field=models.DecimalField(
+                decimal_places=2, default=0, max_digits=12
+            ),
+        ),
+        migrations.RunPython(
+            backfill_repayment_totals, migrations.RunPython.noop
+        ),
+    ]
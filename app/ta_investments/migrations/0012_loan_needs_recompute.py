@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-17 16:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ta_investments", "0011_loan_repayment_totals"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="loan",
+            name="needs_recompute",
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 3.2.25 on 2026-10-17 17:10
+
+from django.db import migrations, models
+from django.db.models import DecimalField, F, Q, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def _total(expression, decimal_places, **filters):
+    return Coalesce(
+        Sum(expression, filter=Q(**filters)),
+        Value(0),
+        output_field=DecimalField(max_digits=20, decimal_places=decimal_places),
+    )
+
+
+def build_portfolio_statistics(apps, schema_editor):
+    Cashflow = apps.get_model("ta_investments", "Cashflow")
+    Loan = apps.get_model("ta_investments", "Loan")
+    PortfolioStatistics = apps.get_model("ta_investments", "PortfolioStatistics")
+    loans = Loan.objects.aggregate(
+        invested=_total("invested_amount", 2, is_closed=True),
+        returned=_total(
+            F("invested_amount") + F("realized_irr"), 6, is_closed=True
+        ),
+        interest_earned=_total("realized_irr", 6, is_closed=True),
+        expected_interest=_total("expected_interest_amount", 2, is_closed=True),
+    )
+    cashflows = Cashflow.objects.aggregate(
+        invested=_total("amount", 2, type="FUNDING"),
+        returned=_total("amount", 2, type="REPAYMENT"),
+    )
+    PortfolioStatistics.objects.create(
+        pk=1,
+        total_invested=loans["invested"] + cashflows["invested"],
+        total_returned=loans["returned"] + cashflows["returned"],
+        total_interest_earned=loans["interest_earned"],
+        total_expected_interest=loans["expected_interest"],
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ta_investments", "0012_loan_needs_recompute"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PortfolioStatistics",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "total_invested",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=20),
+                ),
+                (
+                    "total_returned",
+                    models.DecimalField(decimal_places=6, default=0, max_digits=20),
+                ),
+                (
+                    "total_interest_earned",
+                    models.DecimalField(decimal_places=6, default=0, max_digits=20),
+                ),
+                (
+                    "total_expected_interest",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=20),
+                ),
+            ],
+        ),
+        migrations.RunPython(
+            build_portfolio_statistics, migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 3.2.25 on 2026-10-17 17:23
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
+
+
+def build_statistics_rollup(apps, schema_editor):
+    Loan = apps.get_model("ta_investments", "Loan")
+    StatisticsRollup = apps.get_model("ta_investments", "StatisticsRollup")
+    rows = (
+        Loan.objects.order_by()
+        .annotate(month=TruncMonth("issue_date"))
+        .values("rating", "month", "is_closed")
+        .annotate(
+            count=Count("pk"),
+            invested=Sum("invested_amount"),
+            returned=Sum("total_repaid"),
+            expected_interest=Sum("expected_interest_amount"),
+        )
+    )
+    StatisticsRollup.objects.bulk_create(
+        [
+            StatisticsRollup(
+                rating=row["rating"],
+                issue_month=row["month"],
+                is_closed=row["is_closed"],
+                loan_count=row["count"],
+                invested_amount=row["invested"] or 0,
+                returned_amount=row["returned"] or 0,
+                expected_interest_amount=row["expected_interest"] or 0,
+            )
+            for row in rows
+        ]
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ta_investments", "0013_portfoliostatistics"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StatisticsRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("rating", models.IntegerField()),
+                ("issue_month", models.DateField()),
+                ("is_closed", models.BooleanField()),
+                ("loan_count", models.BigIntegerField(default=0)),
+                (
+                    "invested_amount",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=20),
+                ),
+                (
+                    "returned_amount",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=20),
+                ),
+                (
+                    "expected_interest_amount",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=20),
+                ),
+            ],
+            options={
+                "unique_together": {("rating", "issue_month", "is_closed")},
+            },
+        ),
+        migrations.RunPython(build_statistics_rollup, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.25 on 2026-10-17 17:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ta_investments", "0014_statisticsrollup"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StatisticsSnapshot",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField(unique=True)),
+                (
+                    "total_invested",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=20),
+                ),
+                (
+                    "total_returned",
+                    models.DecimalField(decimal_places=6, default=0, max_digits=20),
+                ),
+                (
+                    "total_interest_earned",
+                    models.DecimalField(decimal_places=6, default=0, max_digits=20),
+                ),
+                (
+                    "total_expected_interest",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=20),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="portfoliostatistics",
+            name="snapshots_stale_from",
+            field=models.DateField(blank=True, null=True),
+        ),
+    ]
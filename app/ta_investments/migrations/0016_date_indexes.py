@@ -0,0 +1,22 @@
+# Generated by Django 3.2.25 on 2026-10-17 18:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ta_investments", "0015_statisticssnapshot"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="cashflow",
+            name="reference_date",
+            field=models.DateField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name="loan",
+            name="last_repayment_date",
+            field=models.DateField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -1,15 +1,29 @@
 """
 Database models
 """
+import threading
+from collections import Counter
+from datetime import date, timedelta
 from decimal import Decimal
+from typing import Dict, Iterable, List
 
+from django.conf import settings
 from django.contrib.auth.models import (AbstractBaseUser, BaseUserManager,
                                         Group, PermissionsMixin)
 from django.core.cache import cache
-from django.db import models
-from django.db.models.signals import post_migrate, post_save
+from django.db import models, transaction
+from django.db.backends.utils import format_number
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import (Coalesce, Greatest, Least,
+                                        TruncMonth)
+from django.db.models.signals import (post_delete, post_migrate,
+                                      post_save, pre_delete)
 from django.dispatch import receiver
-from pyxirr import xirr
+from django.utils import timezone
+from pyxirr import InvalidPaymentsError
+
+from . import caching
+from .irr import cached_xirr, expected_irr
 
 
 @receiver(post_migrate)
@@ -88,6 +102,30 @@ class User(AbstractBaseUser, PermissionsMixin):
 
 
 class Loan(models.Model):
+    CALCULATED_FIELDS = [
+        "investment_date",
+        "invested_amount",
+        "expected_interest_amount",
+        "expected_irr",
+        "realized_irr",
+        "is_closed",
+        "total_repaid",
+        "repayment_count",
+        "last_repayment_date",
+    ]
+    # the fields the contributions of a loan to the portfolio statistics,
+    # their snapshots and the statistics rollup are derived from
+    STATISTICS_FIELDS = [
+        "rating",
+        "issue_date",
+        "invested_amount",
+        "expected_interest_amount",
+        "realized_irr",
+        "is_closed",
+        "total_repaid",
+        "last_repayment_date",
+    ]
+
     identifier = models.CharField(max_length=100, unique=True, editable=False)
     issue_date = models.DateField()
     total_amount = models.DecimalField(max_digits=10, decimal_places=2)
@@ -107,47 +145,194 @@ class Loan(models.Model):
         max_digits=10, decimal_places=6, blank=True, null=True)
     is_closed = models.BooleanField(default=False)
 
-    def calculate_fields(self):
-        funding_cash_flow = self.cashflows.filter(type="FUNDING").first()
+    # running repayment totals, maintained incrementally by Cashflow
+    total_repaid = models.DecimalField(
+        max_digits=12, decimal_places=2, default=0)
+    repayment_count = models.PositiveIntegerField(default=0)
+    last_repayment_date = models.DateField(
+        blank=True, null=True, db_index=True)
+
+    # set by cash flow writes when the recompute is deferred to a task
+    needs_recompute = models.BooleanField(default=False, db_index=True)
+
+    # values of the statistics fields as last loaded or saved, None when
+    # not known
+    saved_values = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        loan = super(Loan, cls).from_db(db, field_names, values)
+        if set(cls.STATISTICS_FIELDS).issubset(field_names):
+            loan.saved_values = loan.statistics_values()
+        return loan
+
+    def statistics_values(self) -> Dict:
+        """The values of the statistics fields of the loan."""
+        return {name: getattr(self, name) for name in self.STATISTICS_FIELDS}
+
+    def saved_contributions(self):
+        """
+        Contributions of the loan as last loaded or saved, None when not
+        known. They are only derived when written over, so that loading
+        loans stays cheap.
+        """
+        if self.saved_values is None:
+            return None
+        return Loan(**self.saved_values).contributions()
+
+    def calculate_fields(self, cashflows=None):
+        """
+        Derive the calculated fields from the cash flows of the loan,
+        rebuilding the running repayment totals on the way.
+
+        The cash flows are fetched with a single query (or taken from the
+        ``prefetch_related("cashflows")`` cache) unless already given as
+        ``cashflows``, so batch callers pay no extra query per loan.
+        """
+        if cashflows is None:
+            cashflows = list(self.cashflows.all())
+        cashflows = sorted(cashflows, key=lambda cf: cf.pk or 0)
+
+        repayments = [cf for cf in cashflows if cf.type == "REPAYMENT"]
+        self.total_repaid = sum(
+            (Decimal(cf.amount) for cf in repayments), Decimal(0))
+        self.repayment_count = len(repayments)
+        self.last_repayment_date = max(
+            (cf.reference_date for cf in repayments), default=None)
+
+        funding_cash_flow = next(
+            (cf for cf in cashflows if cf.type == "FUNDING"), None)
         if funding_cash_flow:
             self.investment_date = funding_cash_flow.reference_date
             self.invested_amount = funding_cash_flow.amount
-            self.expected_interest_amount = Decimal(self.total_expected_interest_amount) * (
+            self.expected_interest_amount = Decimal(
+                self.total_expected_interest_amount) * (
                 Decimal(self.invested_amount) / Decimal(self.total_amount))
-
-            dates = [self.investment_date, self.maturity_date]
-            amounts = [
-                -self.invested_amount,
-                self.invested_amount + self.expected_interest_amount,
-            ]
-            self.expected_irr = xirr(dates, amounts)
+            self.expected_irr = expected_irr(
+                self.total_amount,
+                self.total_expected_interest_amount,
+                self.investment_date,
+                self.maturity_date,
+            )
 
             self.is_closed = self.check_is_closed()
+            self.realized_irr = (
+                self._realized_irr(cashflows) if self.is_closed else None)
+        else:
+            # the funding cash flow was removed
+            self.investment_date = None
+            self.invested_amount = None
+            self.expected_interest_amount = None
+            self.expected_irr = None
+            self.is_closed = False
+            self.realized_irr = None
 
-            if self.is_closed:
-                realized_cashflows = [(cf.reference_date, cf.amount)
-                                      for cf in self.cashflows.all()]
-                realized_dates = [cf[0] for cf in realized_cashflows]
-                realized_amounts = [cf[1] for cf in realized_cashflows]
-                self.realized_irr = xirr(realized_dates, realized_amounts)
+    def refresh_closure(self):
+        """
+        Update ``is_closed`` and ``realized_irr`` after a repayment change,
+        from the running totals. The cash flows are only fetched to solve
+        the realized IRR of a closed loan.
+        """
+        self.is_closed = self.check_is_closed()
+        self.realized_irr = (
+            self._realized_irr(list(self.cashflows.all()))
+            if self.is_closed else None)
 
     def check_is_closed(self):
-        funding_cash_flow = self.cashflows.filter(type="Funding").first()
-        if not funding_cash_flow:
-            return False
-
-        repayment_cash_flow = self.cashflows.filter(type="Repayment").first()
-        if not repayment_cash_flow:
+        if self.invested_amount is None or not self.repayment_count:
             return False
 
-        total_repaid_amount = sum(
-            [cf.amount for cf in self.cashflows.filter(type="Repayment")])
         expected_amount = Decimal(
-            funding_cash_flow.amount) * -1 + self.expected_interest_amount
-        return total_repaid_amount >= expected_amount
+            self.invested_amount) * -1 + self.expected_interest_amount
+        return self.total_repaid >= expected_amount
+
+    @staticmethod
+    def _realized_irr(cashflows):
+        try:
+            return cached_xirr(
+                [cf.reference_date for cf in cashflows],
+                [cf.amount for cf in cashflows],
+            )
+        except InvalidPaymentsError:
+            # undefined without both outgoing and incoming payments
+            return None
+
+    def statistics(self) -> Dict[str, Decimal]:
+        """
+        Contribution of the loan to the portfolio statistics: closed loans
+        count their invested amount and their realized and expected
+        interest.
+        """
+        if not self.is_closed:
+            return {}
+        invested_amount = _stored(self, "invested_amount")
+        realized_irr = _stored(self, "realized_irr")
+        totals = {
+            "total_invested": invested_amount,
+            "total_returned": (
+                None if invested_amount is None or realized_irr is None
+                else invested_amount + realized_irr),
+            "total_interest_earned": realized_irr,
+            "total_expected_interest": _stored(
+                self, "expected_interest_amount"),
+        }
+        return {
+            name: value for name, value in totals.items() if value is not None
+        }
+
+    def rollup(self):
+        """
+        Cell of the statistics rollup the loan is counted in, and its
+        contribution to the totals of the cell.
+        """
+        key = (
+            self._meta.get_field("rating").to_python(self.rating),
+            self._meta.get_field("issue_date").to_python(
+                self.issue_date).replace(day=1),
+            self.is_closed,
+        )
+        return key, {
+            "loan_count": 1,
+            "invested_amount": _stored(self, "invested_amount") or 0,
+            "returned_amount": _stored(self, "total_repaid"),
+            "expected_interest_amount": _stored(
+                self, "expected_interest_amount") or 0,
+        }
+
+    def closed_on(self):
+        """
+        Day from which the loan counts in the portfolio statistics: that of
+        the repayment that closed it, its last one.
+        """
+        if not self.is_closed:
+            return None
+        return self._meta.get_field("last_repayment_date").to_python(
+            self.last_repayment_date)
+
+    def contributions(self):
+        """
+        Contributions of the loan to the portfolio statistics, from the day
+        it closed on, and to the statistics rollup, for
+        ``record_loan_changes``.
+        """
+        return self.statistics(), self.closed_on(), self.rollup()
 
     def save(self, *args, **kwargs):
-        super(Loan, self).save(*args, **kwargs)
+        update_fields = kwargs.get("update_fields")
+        if (update_fields is not None
+                and not set(update_fields) & set(self.STATISTICS_FIELDS)):
+            super(Loan, self).save(*args, **kwargs)
+            return
+
+        with transaction.atomic(savepoint=False):
+            before = self.saved_contributions()
+            if before is None and not self._state.adding:
+                previous = Loan.objects.filter(pk=self.pk).first()
+                before = previous.contributions() if previous else None
+            super(Loan, self).save(*args, **kwargs)
+            after = self.contributions()
+            record_loan_changes([before], [after])
+        self.saved_values = self.statistics_values()
 
 
 class Cashflow(models.Model):
@@ -162,23 +347,707 @@ class Cashflow(models.Model):
         to_field="identifier",
     )
     type = models.CharField(choices=TYPES, max_length=20)
-    reference_date = models.DateField()
+    reference_date = models.DateField(db_index=True)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
 
     def save(self, *args, **kwargs):
-        super(Cashflow, self).save(*args, **kwargs)
-        loan = self.loan_identifier
-        loan.calculate_fields()
-        loan.save()
+        with transaction.atomic():
+            previous = None
+            if self.pk is not None:
+                previous = Cashflow.objects.filter(pk=self.pk).first()
+            super(Cashflow, self).save(*args, **kwargs)
+
+            if previous is not None and not self.differs_from(previous):
+                # nothing the loan fields are derived from has changed
+                return
+
+            lock_loans({self.loan_identifier_id} | (
+                {previous.loan_identifier_id} if previous else set()))
+            PortfolioStatistics.add(
+                statistics_delta(
+                    [previous.statistics()] if previous is not None else [],
+                    [self.statistics()],
+                ),
+                since=min(
+                    cashflow.dated() for cashflow in (previous, self)
+                    if cashflow is not None),
+            )
+            if previous is None:
+                loan = self.apply_to_loan()
+            elif previous.loan_identifier_id != self.loan_identifier_id:
+                previous.apply_to_loan(removed=True)
+                loan = self.apply_to_loan()
+            else:
+                previous.update_repayment_totals(removed=True)
+                loan = self.apply_to_loan(previous=previous)
+        if loan is not None:
+            self.loan_identifier = loan
+
+    def statistics(self) -> Dict[str, Decimal]:
+        """
+        Contribution of the cash flow to the portfolio statistics.
+        """
+        name = {
+            "FUNDING": "total_invested",
+            "REPAYMENT": "total_returned",
+        }.get(self.type)
+        if name is None:
+            return {}
+        return {name: _stored(self, "amount")}
+
+    def dated(self):
+        return self._meta.get_field("reference_date").to_python(
+            self.reference_date)
+
+    def differs_from(self, other):
+        """
+        Whether this cash flow and ``other`` differ in any of the values
+        the calculated fields of their loan are derived from.
+        """
+        return any(
+            field.to_python(getattr(self, field.attname))
+            != field.to_python(getattr(other, field.attname))
+            for field in (
+                self._meta.get_field(name)
+                for name in ("loan_identifier", "type", "reference_date",
+                             "amount")
+            )
+        )
+
+    def apply_to_loan(self, removed=False, previous=None):
+        """
+        Apply the addition or removal of this cash flow to its loan, or its
+        change from ``previous`` once that has been removed from the
+        running totals, and return the loan.
+
+        Adding, removing or changing a repayment only updates the running
+        totals and the closure of the loan, and the realized IRR is only
+        solved again while the loan is closed. Any change to a funding
+        cash flow recomputes the loan from its cash flows. When the
+        recompute is deferred to a task the loan is only flagged and
+        ``None`` is returned.
+        """
+        if settings.LOAN_RECOMPUTE_ASYNC:
+            # only flag the loan; a debounced task recomputes it
+            self.update_repayment_totals(removed=removed, needs_recompute=True)
+            schedule_loan_recompute()
+            return None
+        self.update_repayment_totals(removed=removed)
+
+        loan = Loan.objects.get(identifier=self.loan_identifier_id)
+        if (self.type == "REPAYMENT" and loan.investment_date
+                and (previous is None or previous.type == "REPAYMENT")):
+            closure = (loan.is_closed, loan.realized_irr)
+            loan.refresh_closure()
+            if (loan.is_closed, loan.realized_irr) != closure:
+                loan.save(update_fields=["is_closed", "realized_irr"])
+        else:
+            loan.calculate_fields()
+            loan.save()
+        return loan
+
+    def update_repayment_totals(self, removed=False, **changes):
+        """
+        Add this repayment to, or remove it from, the running totals of its
+        loan with a single atomic ``UPDATE``, along with any other field
+        ``changes`` of the loan.
+        """
+        loans = Loan.objects.filter(identifier=self.loan_identifier_id)
+        if self.type != "REPAYMENT":
+            if changes:
+                loans.update(**changes)
+            return
+
+        amount = self._meta.get_field("amount").to_python(self.amount)
+        reference_date = self.dated()
+        StatisticsRollup.cell_of(loans).update(
+            returned_amount=F("returned_amount")
+            + (-amount if removed else amount))
+        if removed:
+            last_repayment_date = Subquery(
+                Cashflow.objects.filter(
+                    loan_identifier=OuterRef("identifier"),
+                    type="REPAYMENT",
+                ).order_by("-reference_date").values("reference_date")[:1])
+            loans.update(
+                total_repaid=F("total_repaid") - amount,
+                repayment_count=F("repayment_count") - 1,
+                last_repayment_date=last_repayment_date,
+                **changes,
+            )
+        else:
+            loans.update(
+                total_repaid=F("total_repaid") + amount,
+                repayment_count=F("repayment_count") + 1,
+                last_repayment_date=Greatest(
+                    Coalesce("last_repayment_date", Value(reference_date)),
+                    Value(reference_date),
+                ),
+                **changes,
+            )
+
+
+def lock_loans(identifiers):
+    """
+    Lock the rows of the loans with the given ``identifiers``, in primary
+    key order. Writes lock their loans before they update the portfolio
+    statistics and the rollup cells, as ``recompute_chunk`` does, so that
+    concurrent writers cannot deadlock each other.
+    """
+    list(Loan.objects.select_for_update()
+         .filter(identifier__in=identifiers)
+         .order_by("pk").values_list("pk", flat=True))
+
+
+def schedule_loan_recompute():
+    """
+    Schedule the recompute of the flagged loans at the end of the debounce
+    window, unless one is already scheduled for this window.
+    """
+    if not cache.add(
+            settings.LOAN_RECOMPUTE_SCHEDULED_CACHE_KEY,
+            True,
+            timeout=settings.LOAN_RECOMPUTE_DEBOUNCE):
+        return
+
+    from .tasks import recompute_flagged_loans
+    transaction.on_commit(lambda: recompute_flagged_loans.apply_async(
+        countdown=settings.LOAN_RECOMPUTE_DEBOUNCE))
+
+
+def _stored(instance, name):
+    # the value of a decimal field of instance as the database stores it
+    field = instance._meta.get_field(name)
+    value = field.to_python(getattr(instance, name))
+    if value is None:
+        return None
+    return Decimal(
+        format_number(value, field.max_digits, field.decimal_places))
+
+
+def statistics_delta(
+        before: Iterable[Dict] = (),
+        after: Iterable[Dict] = ()) -> Dict[str, Decimal]:
+    """
+    Change of the portfolio statistics when the contributions ``before``
+    are replaced by the contributions ``after``.
+    """
+    delta = dict.fromkeys(PortfolioStatistics.TOTALS, Decimal(0))
+    for contribution in before:
+        for name, value in contribution.items():
+            delta[name] -= value
+    for contribution in after:
+        for name, value in contribution.items():
+            delta[name] += value
+    return delta
+
+
+def rollup_delta(before=(), after=()) -> Dict[tuple, Dict]:
+    """
+    Change of the statistics rollup cells when the ``(key, totals)``
+    contributions ``before`` are replaced by the contributions ``after``.
+    """
+    delta = {}
+    for sign, contributions in ((-1, before), (1, after)):
+        for key, totals in contributions:
+            cell = delta.setdefault(
+                key, dict.fromkeys(StatisticsRollup.MEASURES, 0))
+            for name, value in totals.items():
+                cell[name] += sign * value
+    return {
+        key: totals for key, totals in delta.items() if any(totals.values())
+    }
+
+
+def record_loan_changes(before=(), after=()):
+    """
+    Apply to the portfolio statistics and to the statistics rollup the
+    replacement of the ``Loan.contributions()`` ``before`` by the ones
+    ``after``. Unknown contributions (of new loans) are given as None.
+
+    The statistics snapshots are stale from the earliest day a contribution
+    that is not replaced by an identical one counted from.
+    """
+    before = [contributions for contributions in before if contributions]
+    after = [contributions for contributions in after if contributions]
+
+    changed = Counter(
+        (tuple(sorted(statistics.items())), closed_on)
+        for statistics, closed_on, _ in before)
+    changed.subtract(
+        (tuple(sorted(statistics.items())), closed_on)
+        for statistics, closed_on, _ in after)
+    PortfolioStatistics.add(
+        statistics_delta(
+            [statistics for statistics, _, _ in before],
+            [statistics for statistics, _, _ in after],
+        ),
+        since=min(
+            (closed_on for (_, closed_on), count in changed.items()
+             if count and closed_on is not None),
+            default=None,
+        ),
+    )
+    StatisticsRollup.add(rollup_delta(
+        [rollup for _, _, rollup in before],
+        [rollup for _, _, rollup in after],
+    ))
+
+
+class PortfolioStatistics(models.Model):
+    """
+    The investment statistics of the whole portfolio, materialised in a
+    single row that every loan and cash flow write updates by delta in its
+    own transaction.
+    """
+
+    ROW = 1
+    TOTALS = [
+        "total_invested",
+        "total_returned",
+        "total_interest_earned",
+        "total_expected_interest",
+    ]
+
+    total_invested = models.DecimalField(
+        max_digits=20, decimal_places=2, default=0)
+    total_returned = models.DecimalField(
+        max_digits=20, decimal_places=6, default=0)
+    total_interest_earned = models.DecimalField(
+        max_digits=20, decimal_places=6, default=0)
+    total_expected_interest = models.DecimalField(
+        max_digits=20, decimal_places=2, default=0)
+
+    # earliest day whose statistics changed since the snapshots were taken
+    snapshots_stale_from = models.DateField(blank=True, null=True)
+
+    def totals(self) -> Dict[str, Decimal]:
+        return {name: getattr(self, name) for name in self.TOTALS}
+
+    @classmethod
+    def current(cls) -> Dict[str, Decimal]:
+        """
+        The portfolio statistics, read from the materialised row.
+        """
+        statistics = cls.objects.filter(pk=cls.ROW).first()
+        if statistics is None:
+            statistics = cls.rebuild()
+        return statistics.totals()
 
-    # stuff I don't have time to immplement: empty the Loan calculated fields
-    # if Cashflow object is deleted.
+    @classmethod
+    def add(cls, delta: Dict[str, Decimal], since: date = None):
+        """
+        Add ``delta`` to the portfolio statistics with a single atomic
+        ``UPDATE``, rebuilding them if the row is missing. The statistics
+        snapshots are marked stale from ``since``, the earliest day of the
+        change, in the same ``UPDATE``.
+        """
+        changes = {
+            name: F(name) + value for name, value in delta.items() if value
+        }
+        if since is not None:
+            changes["snapshots_stale_from"] = Least(
+                Coalesce("snapshots_stale_from", Value(since)), Value(since))
+        if changes and not cls.objects.filter(pk=cls.ROW).update(**changes):
+            cls.rebuild()
+            if since is not None:
+                cls.objects.filter(pk=cls.ROW).update(
+                    snapshots_stale_from=since)
+
+    @classmethod
+    def rebuild(cls) -> "PortfolioStatistics":
+        """
+        Recompute the portfolio statistics from the loans and cash flows.
+
+        The row is locked before the tables are read, so that the deltas of
+        concurrent writes are applied on top of the rebuilt totals.
+        """
+        from .utils import calculate_investment_statistics
+
+        with transaction.atomic():
+            statistics, _ = (
+                cls.objects.select_for_update().get_or_create(pk=cls.ROW))
+            for name, value in calculate_investment_statistics().items():
+                setattr(statistics, name, value)
+            statistics.save()
+        return statistics
+
+
+class StatisticsRollup(models.Model):
+    """
+    Totals of the loans per rating, issue month and closure, updated by
+    delta on every loan write. Statistics at any of these granularities
+    sum a few cells instead of scanning the loans.
+
+    The realized interest of the closed cells is their returned plus their
+    (negative) invested amount.
+    """
+
+    DIMENSIONS = ["rating", "issue_month", "is_closed"]
+    MEASURES = [
+        "loan_count",
+        "invested_amount",
+        "returned_amount",
+        "expected_interest_amount",
+    ]
+
+    rating = models.IntegerField()
+    issue_month = models.DateField()
+    is_closed = models.BooleanField()
+    loan_count = models.BigIntegerField(default=0)
+    invested_amount = models.DecimalField(
+        max_digits=20, decimal_places=2, default=0)
+    returned_amount = models.DecimalField(
+        max_digits=20, decimal_places=2, default=0)
+    expected_interest_amount = models.DecimalField(
+        max_digits=20, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = [("rating", "issue_month", "is_closed")]
+
+    @classmethod
+    def add(cls, delta: Dict[tuple, Dict]):
+        """
+        Add the ``delta`` totals to their cells with one atomic ``UPDATE``
+        per cell, creating the missing cells.
+
+        The cells are updated in key order, so concurrent writers lock them
+        in the same order and cannot deadlock each other.
+        """
+        missing = []
+        for key in sorted(delta):
+            if not cls._add_to_cell(key, delta[key]):
+                missing.append(key)
+        if not missing:
+            return
+
+        cls.objects.bulk_create(
+            [cls(**dict(zip(cls.DIMENSIONS, key))) for key in missing],
+            ignore_conflicts=True,
+        )
+        for key in missing:
+            cls._add_to_cell(key, delta[key])
+
+    @classmethod
+    def _add_to_cell(cls, key, totals) -> int:
+        return cls.objects.filter(**dict(zip(cls.DIMENSIONS, key))).update(
+            **{name: F(name) + value
+               for name, value in totals.items() if value})
+
+    @classmethod
+    def cell_of(cls, loans):
+        """
+        The cell the loan selected by the ``loans`` queryset is counted in,
+        for updates in a single statement.
+        """
+        return cls.objects.filter(
+            rating=Subquery(loans.values("rating")[:1]),
+            issue_month=Subquery(
+                loans.annotate(month=TruncMonth("issue_date"))
+                .values("month")[:1]),
+            is_closed=Subquery(loans.values("is_closed")[:1]),
+        )
+
+    @classmethod
+    def of_loans(cls, loans) -> Dict[tuple, Dict]:
+        """
+        Totals of the ``loans`` queryset per cell, aggregated in the
+        database.
+        """
+        rows = (
+            loans.order_by()
+            .annotate(month=TruncMonth("issue_date"))
+            .values("rating", "month", "is_closed")
+            .annotate(
+                count=Count("pk"),
+                invested=Sum("invested_amount"),
+                returned=Sum("total_repaid"),
+                expected_interest=Sum("expected_interest_amount"),
+            )
+        )
+        return {
+            (row["rating"], row["month"], row["is_closed"]): {
+                "loan_count": row["count"],
+                "invested_amount": row["invested"] or Decimal(0),
+                "returned_amount": row["returned"] or Decimal(0),
+                "expected_interest_amount": (
+                    row["expected_interest"] or Decimal(0)),
+            }
+            for row in rows
+        }
+
+    @classmethod
+    def cells(cls) -> Dict[tuple, Dict]:
+        """The totals of the non-empty cells."""
+        return {
+            tuple(cell[name] for name in cls.DIMENSIONS): {
+                name: cell[name] for name in cls.MEASURES
+            }
+            for cell in cls.objects.filter(loan_count__gt=0).values()
+        }
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Recompute every cell from the loans.
+        """
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create([
+                cls(**dict(zip(cls.DIMENSIONS, key)), **totals)
+                for key, totals in cls.of_loans(Loan.objects.all()).items()
+            ])
+
+    @classmethod
+    def totals(cls, cells, group_by=()) -> List[Dict]:
+        """
+        Sum the ``cells`` queryset, grouped by the ``group_by`` dimensions.
+        """
+        measures = {
+            f"sum_{name}": Coalesce(
+                Sum(name), Value(0),
+                output_field=cls._meta.get_field(name))
+            for name in cls.MEASURES
+        }
+        measures["sum_realized_interest_amount"] = Coalesce(
+            Sum(F("returned_amount") + F("invested_amount"),
+                filter=Q(is_closed=True)),
+            Value(0),
+            output_field=models.DecimalField(
+                max_digits=20, decimal_places=2),
+        )
+        cells = cells.filter(loan_count__gt=0).order_by(*group_by)
+        if group_by:
+            rows = list(cells.values(*group_by).annotate(**measures))
+        else:
+            rows = [cells.aggregate(**measures)]
+        return [
+            {name.replace("sum_", "", 1) if name in measures else name: value
+             for name, value in row.items()}
+            for row in rows
+        ]
+
+
+class StatisticsSnapshot(models.Model):
+    """
+    The investment statistics of the portfolio as of the end of a day, with
+    closed loans counted from the day they closed and cash flows from their
+    reference date. Each day is taken on top of the previous one, and the
+    statistics as of any day add the days since the nearest snapshot.
+    """
+
+    day = models.DateField(unique=True)
+    total_invested = models.DecimalField(
+        max_digits=20, decimal_places=2, default=0)
+    total_returned = models.DecimalField(
+        max_digits=20, decimal_places=6, default=0)
+    total_interest_earned = models.DecimalField(
+        max_digits=20, decimal_places=6, default=0)
+    total_expected_interest = models.DecimalField(
+        max_digits=20, decimal_places=2, default=0)
+
+    def totals(self) -> Dict[str, Decimal]:
+        return {
+            name: getattr(self, name) for name in PortfolioStatistics.TOTALS
+        }
+
+    @classmethod
+    def valid(cls):
+        """
+        The snapshots that no later write has made stale.
+        """
+        stale_from = (
+            PortfolioStatistics.objects.filter(pk=PortfolioStatistics.ROW)
+            .values_list("snapshots_stale_from", flat=True).first())
+        snapshots = cls.objects.all()
+        if stale_from is not None:
+            snapshots = snapshots.filter(day__lt=stale_from)
+        return snapshots
+
+    @classmethod
+    def as_of(cls, day: date) -> Dict[str, Decimal]:
+        """
+        The investment statistics as of the end of ``day``: the nearest
+        valid snapshot plus the days since.
+        """
+        from .utils import dated_investment_statistics
+
+        snapshot = cls.valid().filter(day__lte=day).order_by("-day").first()
+        if snapshot is None:
+            return dated_investment_statistics(until=day)
+        totals = snapshot.totals()
+        if snapshot.day < day:
+            delta = dated_investment_statistics(after=snapshot.day, until=day)
+            for name, value in delta.items():
+                totals[name] += value
+        return totals
+
+    @classmethod
+    def take(cls, until: date = None) -> int:
+        """
+        Take the missing snapshots up to ``until`` (yesterday by default),
+        each on top of the previous one, dropping first the ones stale
+        writes have changed. Return the number of snapshots taken.
+        """
+        from .utils import daily_investment_statistics
+
+        if until is None:
+            until = timezone.localdate() - timedelta(days=1)
+
+        with transaction.atomic():
+            statistics = (
+                PortfolioStatistics.objects.select_for_update()
+                .filter(pk=PortfolioStatistics.ROW).first())
+            if (statistics is not None
+                    and statistics.snapshots_stale_from is not None):
+                cls.objects.filter(
+                    day__gte=statistics.snapshots_stale_from).delete()
+                statistics.snapshots_stale_from = None
+                statistics.save(update_fields=["snapshots_stale_from"])
+
+        latest = cls.objects.order_by("-day").first()
+        after = latest.day if latest is not None else None
+        days = daily_investment_statistics(after=after, until=until)
+        if latest is not None:
+            day, totals = after + timedelta(days=1), latest.totals()
+        elif days:
+            day = min(days)
+            totals = dict.fromkeys(PortfolioStatistics.TOTALS, Decimal(0))
+        else:
+            return 0
+
+        snapshots = []
+        while day <= until:
+            for name, value in days.get(day, {}).items():
+                totals[name] += value
+            snapshots.append(cls(day=day, **totals))
+            day += timedelta(days=1)
+        # concurrent runs take the same snapshots
+        cls.objects.bulk_create(snapshots, ignore_conflicts=True)
+        return len(snapshots)
+
+
+class ImportJob(models.Model):
+    KINDS = (
+        ("LOANS", "Loans"),
+        ("CASHFLOWS", "Cash flows"),
+    )
+    STATUSES = (
+        ("PENDING", "Pending"),
+        ("RUNNING", "Running"),
+        ("SUCCEEDED", "Succeeded"),
+        ("FAILED", "Failed"),
+    )
+    kind = models.CharField(choices=KINDS, max_length=20)
+    status = models.CharField(
+        choices=STATUSES, max_length=20, default="PENDING")
+    file_name = models.CharField(max_length=255)
+    backend = models.CharField(max_length=20, blank=True)
+    mode = models.CharField(max_length=20, blank=True)
+    rows_read = models.BigIntegerField(default=0)
+    rows_inserted = models.BigIntegerField(default=0)
+    rows_updated = models.BigIntegerField(default=0)
+    rows_rejected = models.BigIntegerField(default=0)
+    error = models.TextField(blank=True)
+    rejected_file = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    @property
+    def duration(self):
+        if not self.started_at:
+            return None
+        finished_at = self.finished_at or timezone.now()
+        return (finished_at - self.started_at).total_seconds()
+
+    @property
+    def rows_per_second(self):
+        duration = self.duration
+        if not duration:
+            return None
+        return self.rows_read / duration
+
+    @classmethod
+    def mark_running(cls, pk):
+        cls.objects.filter(pk=pk, started_at__isnull=True).update(
+            started_at=timezone.now())
+        cls.objects.filter(pk=pk, status="PENDING").update(status="RUNNING")
+
+    @classmethod
+    def record_progress(
+            cls, pk, rows_read=0, rows_inserted=0, rows_updated=0,
+            rows_rejected=0):
+        # Chunks of one import run in parallel, so increment in the database
+        cls.objects.filter(pk=pk).update(
+            rows_read=F("rows_read") + rows_read,
+            rows_inserted=F("rows_inserted") + rows_inserted,
+            rows_updated=F("rows_updated") + rows_updated,
+            rows_rejected=F("rows_rejected") + rows_rejected,
+        )
+
+    @classmethod
+    def mark_finished(cls, pk, rejected_file=""):
+        cls.objects.filter(pk=pk).exclude(status="FAILED").update(
+            status="SUCCEEDED",
+            finished_at=timezone.now(),
+            rejected_file=rejected_file,
+        )
+
+    @classmethod
+    def mark_failed(cls, pk, error):
+        cls.objects.filter(pk=pk).update(
+            status="FAILED", error=str(error), finished_at=timezone.now())
+
+
+# identifiers of the loans being deleted by this thread, whose cash flows
+# are deleted along with them
+_deleting = threading.local()
+
+
+def _deleting_loans() -> set:
+    if not hasattr(_deleting, "loans"):
+        _deleting.loans = set()
+    return _deleting.loans
+
+
+@receiver(pre_delete, sender=Loan)
+def mark_loan_deleting(sender, instance, **kwargs):
+    lock_loans([instance.identifier])
+    _deleting_loans().add(instance.identifier)
+
+
+@receiver(post_delete, sender=Loan)
+def remove_loan_from_statistics(sender, instance, **kwargs):
+    _deleting_loans().discard(instance.identifier)
+    record_loan_changes(before=[instance.contributions()])
+
+
+@receiver(post_delete, sender=Cashflow)
+def remove_cashflow_from_statistics(sender, instance, **kwargs):
+    """
+    Remove a deleted cash flow from the portfolio statistics and from its
+    loan, however it was deleted. The loan is left alone when it is being
+    deleted too, as its contributions are removed as a whole.
+    """
+    deleting_loan = instance.loan_identifier_id in _deleting_loans()
+    if not deleting_loan:
+        lock_loans([instance.loan_identifier_id])
+    PortfolioStatistics.add(
+        statistics_delta(before=[instance.statistics()]),
+        since=instance.dated(),
+    )
+    if not deleting_loan:
+        instance.apply_to_loan(removed=True)
 
 
 @receiver(post_save, sender=Loan)
 @receiver(post_save, sender=Cashflow)
+@receiver(post_delete, sender=Loan)
+@receiver(post_delete, sender=Cashflow)
 def invalidate_cache(sender, instance, **kwargs):
-    from django.conf import settings
-    from django.core.cache import cache
-
-    cache.delete(settings.INVESTMENT_STATISTICS_CACHE_KEY)
+    caching.invalidate(
+        settings.INVESTMENT_STATISTICS_CACHE_KEY,
+        settings.INVESTMENT_STATISTICS_CACHE_HARD_TIMEOUT,
+    )
+    caching.invalidate_responses()
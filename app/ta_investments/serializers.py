@@ -1,6 +1,7 @@
 from rest_framework import serializers
 
-from .models import Cashflow, Loan
+from .importers import IMPORT_BACKENDS, IMPORT_MODES
+from .models import Cashflow, ImportJob, Loan, StatisticsRollup
 
 
 class CashflowSerializer(serializers.ModelSerializer):
@@ -13,6 +14,44 @@ class LoanSerializer(serializers.ModelSerializer):
     class Meta:
         model = Loan
         fields = "__all__"
+        # maintained by delta on every cash flow write
+        read_only_fields = [
+            "total_repaid",
+            "repayment_count",
+            "last_repayment_date",
+            "needs_recompute",
+        ]
+
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    duration = serializers.FloatField(read_only=True)
+    rows_per_second = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = ImportJob
+        fields = "__all__"
+
+
+class ImportOptionsSerializer(serializers.Serializer):
+    backend = serializers.ChoiceField(choices=IMPORT_BACKENDS, required=False)
+    mode = serializers.ChoiceField(choices=IMPORT_MODES, required=False)
+
+
+class RollupOptionsSerializer(serializers.Serializer):
+    group_by = serializers.CharField(required=False, default="")
+
+    def validate_group_by(self, value):
+        dimensions = [name for name in value.split(",") if name]
+        unknown = set(dimensions) - set(StatisticsRollup.DIMENSIONS)
+        if unknown:
+            raise serializers.ValidationError(
+                f"Unknown dimensions {', '.join(sorted(unknown))}; group "
+                f"by any of {', '.join(StatisticsRollup.DIMENSIONS)}.")
+        return list(dict.fromkeys(dimensions))
+
+
+class StatisticsOptionsSerializer(serializers.Serializer):
+    as_of = serializers.DateField(required=False)
 
 
 class LoanCsvUploadSerializer(serializers.Serializer):
@@ -33,3 +72,18 @@ class InvestmentStatisticsSerializer(serializers.Serializer):
         max_digits=10, decimal_places=2)
     realized_irr = serializers.DecimalField(max_digits=10, decimal_places=6)
     expected_irr = serializers.DecimalField(max_digits=10, decimal_places=6)
+
+
+class StatisticsRollupSerializer(serializers.Serializer):
+    rating = serializers.IntegerField(required=False)
+    issue_month = serializers.DateField(required=False)
+    is_closed = serializers.BooleanField(required=False)
+    loan_count = serializers.IntegerField()
+    invested_amount = serializers.DecimalField(
+        max_digits=20, decimal_places=2)
+    returned_amount = serializers.DecimalField(
+        max_digits=20, decimal_places=2)
+    expected_interest_amount = serializers.DecimalField(
+        max_digits=20, decimal_places=2)
+    realized_interest_amount = serializers.DecimalField(
+        max_digits=20, decimal_places=2)
@@ -1,58 +1,270 @@
-import csv
 import io
-import logging
-
-from celery import shared_task
-from ta_investments.models import Cashflow, Loan
-
-logger = logging.getLogger(__name__)
-
-
-@shared_task
-def process_loans_csv(csv_content):
-    csv_data = csv.DictReader(io.StringIO(csv_content))
-
-    for row in csv_data:
-        if list(row.keys()) == [
-            "identifier",
-            "issue_date",
-            "total_amount",
-            "rating",
-            "maturity_date",
-            "total_expected_interest_amount",
-        ]:
-            Loan.objects.create(
-                identifier=row["identifier"],
-                issue_date=row["issue_date"],
-                total_amount=row["total_amount"],
-                rating=row["rating"],
-                maturity_date=row["maturity_date"],
-                total_expected_interest_amount=row["total_expected_interest_amount"],
-            )
-
-
-@shared_task
-def process_cashflow_csv(csv_content):
-    csv_data = csv.DictReader(io.StringIO(csv_content))
-
-    for row in csv_data:
-        if list(row.keys()) == [
-            "loan_identifier",
-            "reference_date",
-            "type",
-            "amount",
-        ]:
-            loan = Loan.objects.filter(
-                identifier=row["loan_identifier"]).first()
-            if loan:
-                Cashflow.objects.create(
-                    loan_identifier=loan,
-                    reference_date=row["reference_date"],
-                    type=row["type"].upper(),
-                    amount=row["amount"],
+import uuid
+from contextlib import contextmanager
+from datetime import date
+from functools import partial
+
+from celery import chord, shared_task
+from django.conf import settings
+from django.core.cache import cache
+from ta_investments import metrics
+from ta_investments.columnar import (load_cashflows_parquet,
+                                     load_loans_parquet)
+from ta_investments.importers import (CASHFLOW_CSV_FIELDS, LOAN_CSV_FIELDS,
+                                      load_cashflows, load_loans,
+                                      recompute_loans)
+from ta_investments.models import ImportJob, Loan, StatisticsSnapshot
+from ta_investments.uploads import (delete_upload, is_parquet_upload,
+                                    open_upload, split_upload,
+                                    upload_storage)
+from ta_investments.utils import refresh_investment_statistics
+from ta_investments.validation import RejectedRowsWriter, merge_rejected_files
+
+
+@shared_task
+def process_loans_csv(csv_content, batch_size=None, backend=None, mode=None):
+    return load_loans(
+        io.StringIO(csv_content),
+        backend=backend,
+        batch_size=batch_size,
+        mode=mode,
+    )
+
+
+@shared_task
+def process_cashflow_csv(
+        csv_content, batch_size=None, backend=None, mode=None):
+    return load_cashflows(
+        io.StringIO(csv_content),
+        backend=backend,
+        batch_size=batch_size,
+        mode=mode,
+    )
+
+
+@shared_task
+def process_loans_file(
+        name, batch_size=None, backend=None, mode=None, job_id=None):
+    return _process_file(
+        name,
+        load_loans_parquet if is_parquet_upload(name) else load_loans,
+        LOAN_CSV_FIELDS,
+        job_id,
+        backend=backend,
+        batch_size=batch_size,
+        mode=mode,
+    )
+
+
+@shared_task
+def process_cashflow_file(
+        name, batch_size=None, recompute=True, backend=None, mode=None,
+        job_id=None):
+    return _process_file(
+        name,
+        load_cashflows_parquet if is_parquet_upload(name) else load_cashflows,
+        CASHFLOW_CSV_FIELDS,
+        job_id,
+        backend=backend,
+        batch_size=batch_size,
+        recompute=recompute,
+        mode=mode,
+    )
+
+
+@shared_task
+def process_loans_file_in_chunks(
+        name, rows_per_chunk=None, batch_size=None, backend=None, mode=None,
+        job_id=None):
+    """
+    Split a spooled loans file and import the chunks in parallel. Parquet
+    files are not split but streamed by record batch in a single task.
+    """
+    return _import_in_chunks(
+        name,
+        rows_per_chunk,
+        process_loans_file.s(
+            batch_size=batch_size, backend=backend, mode=mode, job_id=job_id),
+        finish_import.s(job_id=job_id),
+        job_id,
+    )
+
+
+@shared_task
+def process_cashflow_file_in_chunks(
+        name, rows_per_chunk=None, batch_size=None, backend=None, mode=None,
+        job_id=None):
+    """
+    Split a spooled cash flows file and import the chunks in parallel. The
+    touched loans are recomputed once, after every chunk has been written.
+    """
+    return _import_in_chunks(
+        name,
+        rows_per_chunk,
+        process_cashflow_file.s(
+            batch_size=batch_size,
+            recompute=False,
+            backend=backend,
+            mode=mode,
+            job_id=job_id,
+        ),
+        finish_import.s(
+            recompute=True, batch_size=batch_size, job_id=job_id),
+        job_id,
+    )
+
+
+@shared_task
+def finish_import(results, recompute=False, batch_size=None, job_id=None):
+    """
+    Chord callback: recompute the touched loans and warm the statistics
+    cache once all chunks of an import have finished.
+    """
+    with _tracked(job_id):
+        identifiers = set()
+        for result in results:
+            identifiers.update(result.get("loan_identifiers", []))
+
+        if recompute:
+            recompute_loans(identifiers, batch_size=batch_size)
+        refresh_investment_statistics()
+
+        rejected_file = merge_rejected_files(
+            [result.get("rejected_file") for result in results],
+            f"import-{job_id or uuid.uuid4().hex}-rejected.csv",
+        )
+
+    if job_id is not None:
+        ImportJob.mark_finished(job_id, rejected_file=rejected_file or "")
+
+    return {
+        "chunks": len(results),
+        "rows_inserted": sum(result["rows_inserted"] for result in results),
+        "loans_recomputed": len(identifiers) if recompute else 0,
+        "rejected_file": rejected_file,
+    }
+
+
+@shared_task
+def recompute_loan_metrics(
+        since=None, rating=None, only_open=False, chunk_size=None):
+    """
+    Recompute the calculated fields of the matching loans in chunks and
+    warm the statistics cache. ``since`` is an ISO date string.
+    """
+    result = metrics.recompute_loan_metrics(
+        since=date.fromisoformat(since) if since else None,
+        rating=rating,
+        only_open=only_open,
+        chunk_size=chunk_size,
+    )
+    refresh_investment_statistics()
+    return result
+
+
+@shared_task
+def refresh_statistics_cache():
+    """
+    Refresh the stale investment statistics in the cache, on behalf of the
+    request that claimed the refresh.
+    """
+    return refresh_investment_statistics()
+
+
+@shared_task
+def take_statistics_snapshots(until=None):
+    """
+    Snapshot the investment statistics of the days since the last snapshot,
+    up to ``until`` (an ISO date string, yesterday by default).
+    """
+    taken = StatisticsSnapshot.take(
+        until=date.fromisoformat(until) if until else None)
+    return {"snapshots_taken": taken}
+
+
+@shared_task
+def recompute_flagged_loans(batch_size=None):
+    """
+    Recompute, once each, the loans flagged by cash flow writes during the
+    debounce window.
+    """
+    cache.delete(settings.LOAN_RECOMPUTE_SCHEDULED_CACHE_KEY)
+    identifiers = list(
+        Loan.objects.filter(needs_recompute=True)
+        .values_list("identifier", flat=True))
+    # clear the flags first so that writes during the recompute flag the
+    # loan again and schedule another window
+    Loan.objects.filter(identifier__in=identifiers).update(
+        needs_recompute=False)
+    recompute_loans(identifiers, batch_size=batch_size)
+    return {"loans_recomputed": len(identifiers)}
+
+
+def _import_in_chunks(name, rows_per_chunk, chunk_task, callback, job_id):
+    rows_per_chunk = rows_per_chunk or settings.CSV_IMPORT_CHUNK_ROWS
+    if is_parquet_upload(name):
+        chunk_names = [name]
+    else:
+        with _tracked(job_id):
+            try:
+                chunk_names = split_upload(name, rows_per_chunk)
+            finally:
+                delete_upload(name)
+
+    if not chunk_names:
+        return callback.delay([]).id
+
+    header = [chunk_task.clone(args=(chunk_name,))
+              for chunk_name in chunk_names]
+    return chord(header)(callback).id
+
+
+def _process_file(name, load, fieldnames, job_id, **options):
+    """
+    Import a spooled upload, streaming rejected rows next to it, and delete
+    the upload afterwards. Parquet uploads are handed to the loader as
+    binary files, CSV uploads as text streams.
+    """
+    rejects = RejectedRowsWriter(f"{name}.rejected.csv", fieldnames)
+    opener = _open_binary if is_parquet_upload(name) else open_upload
+    with _tracked(job_id), rejects:
+        try:
+            with opener(name) as stream:
+                result = load(
+                    stream,
+                    progress=_progress(job_id),
+                    rejects=rejects,
+                    **options,
                 )
-            else:
-                logger.warning(
-                    f"Loan with identifier {row['loan_identifier']} not found")
-        else:
-            logger.warning("Wrong fields loans.csv file")
+        finally:
+            delete_upload(name)
+
+    result["rejected_file"] = rejects.written_name
+    return result
+
+
+def _open_binary(name):
+    return upload_storage().open(name, "rb")
+
+
+@contextmanager
+def _tracked(job_id):
+    """
+    Mark the import job as running and record any error that escapes.
+    """
+    if job_id is None:
+        yield
+        return
+
+    ImportJob.mark_running(job_id)
+    try:
+        yield
+    except Exception as exc:
+        ImportJob.mark_failed(job_id, exc)
+        raise
+
+
+def _progress(job_id):
+    if job_id is None:
+        return None
+    return partial(ImportJob.record_progress, job_id)
@@ -1,12 +1,19 @@
 """
 Test custom Django Management commands.
 """
+from datetime import date
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
 from unittest.mock import patch
 
-from django.core.management import call_command
+from django.core.management import CommandError, call_command
 from django.db.utils import OperationalError
-from django.test import SimpleTestCase
+from django.test import SimpleTestCase, TestCase
 from psycopg2 import OperationalError as Psycopg2Error
+from ta_investments.models import Cashflow, Loan, PortfolioStatistics
+
+RESOURCES = Path(__file__).parent / "resources"
 
 
 @patch("ta_investments.management.commands.wait_for_db.Command.check")
@@ -26,3 +33,153 @@ class CommandTest(SimpleTestCase):
         call_command("wait_for_db")
         self.assertEqual(patched_check.call_count, 6)
         patched_check.assert_called_with(databases=["default"])
+
+
+class ImportCsvCommandTests(TestCase):
+    """Test the import_csv command."""
+
+    def test_import_with_orm_backend(self):
+        """Test importing loans and cash flows through the ORM."""
+        call_command("import_csv", "loans", str(RESOURCES / "loans.csv"),
+                     "--backend", "orm", "--batch-size", "2")
+        call_command("import_csv", "cashflows",
+                     str(RESOURCES / "cash_flows.csv"), "--backend", "orm")
+
+        self.assertEqual(Loan.objects.count(), 3)
+        self.assertEqual(Cashflow.objects.count(), 5)
+        self.assertIsNotNone(
+            Loan.objects.get(identifier="L101").expected_irr)
+
+    def test_import_with_copy_backend(self):
+        """Test COPY imports, falling back to the ORM off PostgreSQL."""
+        call_command("import_csv", "loans", str(RESOURCES / "loans.csv"),
+                     "--backend", "copy")
+        call_command("import_csv", "cashflows",
+                     str(RESOURCES / "cash_flows.csv"), "--backend", "copy")
+
+        self.assertEqual(Loan.objects.count(), 3)
+        self.assertEqual(Cashflow.objects.count(), 5)
+        self.assertEqual(
+            Cashflow.objects.filter(type="REPAYMENT").count(), 2)
+
+    def test_upsert_with_copy_backend_is_idempotent(self):
+        """Test re-importing the same files in upsert mode."""
+        for _ in range(2):
+            call_command("import_csv", "loans", str(RESOURCES / "loans.csv"),
+                         "--backend", "copy", "--mode", "upsert")
+            call_command("import_csv", "cashflows",
+                         str(RESOURCES / "cash_flows.csv"),
+                         "--backend", "copy", "--mode", "upsert")
+
+        self.assertEqual(Loan.objects.count(), 3)
+        self.assertEqual(Cashflow.objects.count(), 5)
+
+
+class RecomputeLoanMetricsCommandTests(TestCase):
+    """Test the recompute_loan_metrics command."""
+
+    def setUp(self):
+        call_command("import_csv", "loans", str(RESOURCES / "loans.csv"))
+        call_command("import_csv", "cashflows",
+                     str(RESOURCES / "cash_flows.csv"))
+        Loan.objects.update(expected_irr=None, is_closed=False)
+
+    def test_recompute_all_loans(self):
+        """Test every loan is recomputed in chunks."""
+        call_command("recompute_loan_metrics", "--chunk-size", "2")
+
+        self.assertFalse(Loan.objects.filter(expected_irr=None).exists())
+        self.assertEqual(
+            set(Loan.objects.filter(is_closed=True)
+                .values_list("identifier", flat=True)),
+            {"L101", "L102"})
+
+    def test_recompute_with_filters(self):
+        """Test only the loans matching the filters are recomputed."""
+        def recomputed():
+            identifiers = set(
+                Loan.objects.exclude(expected_irr=None)
+                .values_list("identifier", flat=True))
+            Loan.objects.update(expected_irr=None)
+            return identifiers
+
+        call_command("recompute_loan_metrics", "--since", "2021-08-11")
+        self.assertEqual(recomputed(), {"L102"})
+
+        call_command("recompute_loan_metrics", "--rating", "2")
+        self.assertEqual(recomputed(), {"L103"})
+
+        Loan.objects.update(is_closed=False)
+        Loan.objects.filter(identifier="L101").update(is_closed=True)
+        call_command("recompute_loan_metrics", "--only-open")
+        self.assertEqual(recomputed(), {"L102", "L103"})
+
+
+class VerifyRepaymentTotalsCommandTests(TestCase):
+    """Test the verify_repayment_totals command."""
+
+    def setUp(self):
+        call_command("import_csv", "loans", str(RESOURCES / "loans.csv"))
+        call_command("import_csv", "cashflows",
+                     str(RESOURCES / "cash_flows.csv"))
+
+    def test_consistent_totals(self):
+        """Test imported loans have consistent repayment totals."""
+        out = StringIO()
+        call_command("verify_repayment_totals", stdout=out)
+
+        self.assertIn("consistent", out.getvalue())
+        self.assertEqual(
+            Loan.objects.get(identifier="L101").total_repaid,
+            Decimal("100050"))
+
+    def test_drift_detected_and_rebuilt(self):
+        """Test drifted totals are reported and rebuilt."""
+        Loan.objects.filter(identifier="L102").update(
+            total_repaid=0, repayment_count=0, last_repayment_date=None,
+            is_closed=False, realized_irr=None)
+        Loan.objects.filter(identifier="L103").update(repayment_count=2)
+
+        with self.assertRaises(CommandError):
+            call_command("verify_repayment_totals", stdout=StringIO())
+
+        call_command("verify_repayment_totals", "--rebuild",
+                     stdout=StringIO())
+        loan = Loan.objects.get(identifier="L102")
+        self.assertEqual(loan.total_repaid, Decimal("55030"))
+        self.assertEqual(loan.repayment_count, 1)
+        self.assertEqual(loan.last_repayment_date, date(2021, 10, 3))
+        self.assertTrue(loan.is_closed)
+        self.assertIsNotNone(loan.realized_irr)
+        self.assertEqual(
+            Loan.objects.get(identifier="L103").repayment_count, 0)
+
+
+class RebuildPortfolioStatisticsCommandTests(TestCase):
+    """Test the rebuild_portfolio_statistics command."""
+
+    def setUp(self):
+        call_command("import_csv", "loans", str(RESOURCES / "loans.csv"))
+        call_command("import_csv", "cashflows",
+                     str(RESOURCES / "cash_flows.csv"))
+
+    def test_imported_statistics_consistent(self):
+        """Test imports maintain the portfolio statistics."""
+        out = StringIO()
+        call_command("rebuild_portfolio_statistics", "--check", stdout=out)
+
+        self.assertIn("consistent", out.getvalue())
+
+    def test_drift_detected_and_rebuilt(self):
+        """Test drifted statistics are reported and rebuilt."""
+        expected = PortfolioStatistics.current()
+        PortfolioStatistics.objects.update(total_invested=0)
+
+        with self.assertRaises(CommandError):
+            call_command("rebuild_portfolio_statistics", "--check",
+                         stdout=StringIO())
+
+        out = StringIO()
+        call_command("rebuild_portfolio_statistics", stdout=out)
+        self.assertIn("total_invested drifted", out.getvalue())
+        self.assertEqual(PortfolioStatistics.current(), expected)
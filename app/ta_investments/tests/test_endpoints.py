@@ -1,16 +1,26 @@
+import gzip
 import tempfile
 from datetime import date
 from decimal import Decimal
 from pathlib import Path
+from unittest.mock import MagicMock, patch
 
+from django.contrib.auth.models import Group
 from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase, override_settings
 from django.urls import reverse
+from kombu.exceptions import OperationalError
 from rest_framework import status
 from rest_framework.test import APIClient
 
-from ..models import Cashflow, Loan, User
-from ..tasks import process_cashflow_csv, process_loans_csv
+from ..caching import (cache_stats, clear_cache_stats,
+                       clear_response_cache_stats, data_version, is_stale,
+                       response_cache_stats)
+from ..models import Cashflow, ImportJob, Loan, StatisticsSnapshot, User
+from ..tasks import (process_cashflow_csv, process_loans_csv,
+                     refresh_statistics_cache)
+from ..utils import calculate_investment_statistics, calculate_portfolio_irr
 
 
 class LoanAPITestCase(TestCase):
@@ -39,6 +49,16 @@ class LoanAPITestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(Loan.objects.count(), 1)
 
+    def test_running_totals_read_only(self):
+        response = self.client.post(
+            reverse("loan-list-create"),
+            {**self.loan_data, "total_repaid": 999, "repayment_count": 3},
+            format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        loan = Loan.objects.get()
+        self.assertEqual(loan.total_repaid, Decimal(0))
+        self.assertEqual(loan.repayment_count, 0)
+
     def test_list_loans(self):
         response = self.client.get(reverse("loan-list-create"))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -74,6 +94,90 @@ class LoanAPITestCase(TestCase):
         self.assertEqual(Loan.objects.count(), 0)
 
 
+class ResponseCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        clear_response_cache_stats()
+        self.client = APIClient()
+        self.test_user = User.objects.create_user(
+            email="testuser@example.com",
+            password="testpassword",
+            user_type="Investor",
+        )
+        self.client.force_authenticate(user=self.test_user)
+        Loan.objects.create(
+            identifier="L101",
+            issue_date=date(2023, 1, 1),
+            rating=6,
+            maturity_date=date(2023, 12, 31),
+            total_amount=Decimal("100000"),
+            total_expected_interest_amount=Decimal("5000"),
+        )
+
+    def test_list_served_from_cache_until_a_write(self):
+        url = reverse("loan-list-create")
+        response = self.client.get(url, {"rating": 6, "is_closed": False})
+        self.assertEqual(len(response.json()), 1)
+
+        with self.assertNumQueries(3):
+            # the permission checks and the groups of the user only
+            response = self.client.get(
+                url, {"is_closed": False, "rating": 6})
+        self.assertEqual(len(response.json()), 1)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(
+            response_cache_stats(), {"hits": 1, "misses": 1})
+
+        self.client.post(url, {
+            "identifier": "L102",
+            "issue_date": "2023-02-01",
+            "rating": 6,
+            "maturity_date": "2023-12-31",
+            "total_amount": 1000,
+            "total_expected_interest_amount": 50,
+        }, format="json")
+        response = self.client.get(url, {"rating": 6, "is_closed": False})
+        self.assertEqual(len(response.json()), 2)
+
+    def test_cached_per_user_group(self):
+        url = reverse("cashflow-list-create")
+        self.client.get(url)
+
+        auditor = User.objects.create_user(
+            email="auditor@example.com",
+            password="testpassword",
+            user_type="Investor",
+        )
+        auditor.groups.add(Group.objects.create(name="Auditor"))
+        self.client.force_authenticate(user=auditor)
+        self.client.get(url)
+        self.assertEqual(
+            response_cache_stats(), {"hits": 0, "misses": 2})
+
+    def test_browsable_api_pages_not_cached(self):
+        url = reverse("loan-list-create")
+        self.client.get(url, HTTP_ACCEPT="text/html")
+
+        other = User.objects.create_user(
+            email="other@example.com",
+            password="testpassword",
+            user_type="Investor",
+        )
+        self.client.force_authenticate(user=other)
+        response = self.client.get(url, HTTP_ACCEPT="text/html")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn(b"testuser@example.com", response.content)
+        self.assertIn(b"other@example.com", response.content)
+        self.assertEqual(
+            response_cache_stats(), {"hits": 0, "misses": 0})
+
+    def test_version_bumped_again_on_commit(self):
+        version = data_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            Loan.objects.get().delete()
+        self.assertEqual(data_version(), version + 2)
+
+
 class CashflowAPITestCase(TestCase):
     def setUp(self):
         self.client = APIClient()
@@ -239,8 +343,12 @@ class CsvUploadViewTestCase(TestCase):
         )
         self.client.force_authenticate(user=self.test_user)
 
-    @override_settings(MEDIA_ROOT=tempfile.gettempdir())
-    def test_upload_csv_files(self):
+    @override_settings(
+        MEDIA_ROOT=tempfile.gettempdir(),
+        CSV_UPLOAD_ROOT=tempfile.gettempdir())
+    @patch("ta_investments.views.process_cashflow_file_in_chunks.delay")
+    @patch("ta_investments.views.process_loans_file_in_chunks.delay")
+    def test_upload_csv_files(self, loans_delay, cashflows_delay):
         with open(self.loan_csv, "rb") as f:
             response = self.client.post(
                 "/api/ta_investments/upload/loan-csv/",
@@ -274,6 +382,9 @@ class CsvUploadViewTestCase(TestCase):
             csv_content = f.read().decode("utf-8")
             process_cashflow_csv(csv_content)
 
+        loans_delay.assert_called_once()
+        cashflows_delay.assert_called_once()
+
         # assert that a cashflow object was created with the expected values
         cashflow = Cashflow.objects.first()
 
@@ -290,6 +401,91 @@ class CsvUploadViewTestCase(TestCase):
         self.assertIsNotNone(loan.expected_interest_amount)
         self.assertIsNotNone(loan.expected_irr)
 
+    @override_settings(CSV_UPLOAD_ROOT=tempfile.gettempdir())
+    def test_upload_rejects_unknown_backend(self):
+        with open(self.loan_csv, "rb") as f:
+            response = self.client.post(
+                "/api/ta_investments/upload/loan-csv/",
+                {"file": f, "backend": "carrier-pigeon"},
+                format="multipart",
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @patch("ta_investments.views.parquet_available", return_value=False)
+    def test_upload_rejects_parquet_without_pyarrow(self, _):
+        for url in ("/api/ta_investments/upload/loan-csv/",
+                    "/api/ta_investments/upload/cashflow-csv/"):
+            response = self.client.post(
+                url,
+                {"file": SimpleUploadedFile("loans.parquet", b"PAR1")},
+                format="multipart",
+            )
+            self.assertEqual(
+                response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn("Parquet", response.data["error"])
+
+    @override_settings(CSV_UPLOAD_ROOT=tempfile.gettempdir())
+    @patch("ta_investments.views.process_loans_file_in_chunks.delay")
+    def test_upload_creates_import_job(self, delay):
+        with open(self.loan_csv, "rb") as f:
+            response = self.client.post(
+                "/api/ta_investments/upload/loan-csv/",
+                {"file": f},
+                format="multipart",
+            )
+
+        job = ImportJob.objects.get(pk=response.data["job"])
+        self.assertEqual(job.kind, "LOANS")
+        self.assertEqual(job.file_name, "loans.csv")
+        self.assertEqual(delay.call_args.kwargs["job_id"], job.pk)
+
+        response = self.client.get(
+            reverse("import-job-detail", kwargs={"pk": job.pk}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["status"], "PENDING")
+        self.assertIn("rows_per_second", response.data)
+
+    @override_settings(CSV_UPLOAD_ROOT=tempfile.gettempdir())
+    @patch("ta_investments.views.process_loans_file_in_chunks.delay")
+    def test_upload_accepts_compressed_files(self, delay):
+        with open(self.loan_csv, "rb") as f:
+            content = gzip.compress(f.read())
+
+        response = self.client.post(
+            "/api/ta_investments/upload/loan-csv/",
+            {"file": SimpleUploadedFile("loans.csv.gz", content)},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        delay.assert_called_once()
+
+        response = self.client.post(
+            "/api/ta_investments/upload/loan-csv/",
+            {"file": SimpleUploadedFile("loans.tar", content)},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_download_rejected_rows(self):
+        with tempfile.TemporaryDirectory() as upload_root, override_settings(
+                CSV_UPLOAD_ROOT=upload_root):
+            job = ImportJob.objects.create(kind="LOANS", file_name="l.csv")
+            url = reverse("import-job-rejected", kwargs={"pk": job.pk})
+            self.assertEqual(
+                self.client.get(url).status_code,
+                status.HTTP_404_NOT_FOUND)
+
+            with open(Path(upload_root) / "rejected.csv", "w") as f:
+                f.write("identifier,reason\nL1,invalid rating: '0'\n")
+            job.rejected_file = "rejected.csv"
+            job.save()
+
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertIn(
+                b"invalid rating", b"".join(response.streaming_content))
+
 
 class RepaymentAPITestCase(TestCase):
     def setUp(self):
@@ -371,19 +567,21 @@ class InvestmentStatisticsViewTestCase(TestCase):
         }
         self.cashflow = Cashflow.objects.create(**self.cashflow_data)
 
+    @override_settings(RESPONSE_CACHE_TIMEOUT=0)
     def test_investment_statistics_view(self):
-        # Ensure that the cache is empty
-        self.assertIsNone(cache.get("investment_statistics"))
+        cache.clear()
+        clear_cache_stats()
 
         url = reverse("investment_statistics")
         response = self.client.get(url)
 
         # Assert that the response is successful and the data is correct
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data["total_invested"], Decimal("10000.00"))
 
         # Ensure that the cache has been set
-        cached_data = cache.get("investment_statistics")
-        self.assertIsNotNone(cached_data)
+        self.assertFalse(is_stale("investment_statistics", 300))
 
         # Create a new Loan and Cashflow
         loan_data = {
@@ -405,4 +603,191 @@ class InvestmentStatisticsViewTestCase(TestCase):
         Cashflow.objects.create(**cashflow_data)
 
         # Ensure that the cache has been invalidated
-        self.assertIsNone(cache.get("investment_statistics"))
+        self.assertTrue(is_stale("investment_statistics", 300))
+
+        # The stale statistics are served while a single refresh runs,
+        # without solving the portfolio IRRs inline
+        with patch(
+                "ta_investments.tasks.refresh_statistics_cache.delay"
+        ) as delay, patch(
+                "ta_investments.utils.calculate_portfolio_irr") as irr:
+            for _ in range(3):
+                response = self.client.get(url)
+                self.assertEqual(
+                    response.data["total_invested"], Decimal("10000.00"))
+        delay.assert_called_once_with()
+        irr.assert_not_called()
+        self.assertIn("expected_irr", response.data)
+
+        # the worker stores the refreshed statistics
+        refresh_statistics_cache()
+        response = self.client.get(url)
+        self.assertEqual(
+            response.data["total_invested"], Decimal("20000.00"))
+        self.assertEqual(
+            cache_stats(), {"hits": 1, "stale_hits": 3, "misses": 1})
+
+    @override_settings(RESPONSE_CACHE_TIMEOUT=0)
+    def test_stale_statistics_served_when_broker_down(self):
+        cache.clear()
+        url = reverse("investment_statistics")
+        self.client.get(url)
+        Cashflow.objects.create(**self.cashflow_data)
+
+        with patch(
+                "ta_investments.tasks.refresh_statistics_cache.delay",
+                side_effect=OperationalError("broker down"),
+        ), self.assertLogs("ta_investments.caching", "ERROR"):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data["total_invested"], Decimal("10000.00"))
+
+        # the refresh lock was released, so the next request tries again
+        with patch(
+                "ta_investments.tasks.refresh_statistics_cache.delay"
+        ) as delay:
+            self.client.get(url)
+        delay.assert_called_once_with()
+
+    def test_investment_statistics_as_of(self):
+        Cashflow.objects.create(
+            loan_identifier=self.loan,
+            type="FUNDING",
+            reference_date=date(2022, 3, 1),
+            amount=Decimal("500"),
+        )
+        StatisticsSnapshot.take(until=date(2022, 1, 31))
+
+        url = reverse("investment_statistics")
+        response = self.client.get(url, {"as_of": "2022-02-15"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data["total_invested"], Decimal("10000.00"))
+
+        response = self.client.get(url, {"as_of": "2022-03-01"})
+        self.assertEqual(
+            response.data["total_invested"], Decimal("10500.00"))
+
+        response = self.client.get(url, {"as_of": "yesterday"})
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(RESPONSE_CACHE_TIMEOUT=0)
+    def test_portfolio_irr_cached_per_filter(self):
+        cache.clear()
+        url = reverse("investment_statistics")
+        with patch(
+                "ta_investments.utils.calculate_portfolio_irr",
+                wraps=calculate_portfolio_irr) as calculate:
+            for _ in range(2):
+                response = self.client.get(url, {"rating": 5})
+            self.assertEqual(calculate.call_count, 1)
+            self.assertIsNone(response.data["realized_irr"])
+            self.assertAlmostEqual(
+                response.data["expected_irr"],
+                float(Loan.objects.get().expected_irr), places=6)
+            self.assertEqual(
+                response.data["total_invested"], Decimal("10000"))
+
+            response = self.client.get(url, {"vintage": 2023})
+            self.assertEqual(calculate.call_count, 2)
+            self.assertEqual(response.data["total_invested"], 0)
+            self.assertIsNone(response.data["expected_irr"])
+
+            # writes invalidate the IRRs of every filter
+            Cashflow.objects.create(
+                loan_identifier=self.loan,
+                type="REPAYMENT",
+                reference_date=date(2022, 6, 1),
+                amount=Decimal("250"),
+            )
+            self.client.get(url, {"rating": 5})
+            self.assertEqual(calculate.call_count, 3)
+
+        response = self.client.get(url, {"vintage": "recent"})
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_statistics_served_while_cache_down(self):
+        # a cache whose errors are ignored misses every read and drops
+        # every write
+        down = MagicMock()
+        down.get.side_effect = lambda key, default=None: default
+        down.get_many.return_value = None
+        down.add.return_value = None
+        down.incr.return_value = None
+        with patch("ta_investments.caching.cache", down), \
+                patch("ta_investments.irr.cache", down):
+            response = self.client.get(reverse("investment_statistics"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data["total_invested"], Decimal("10000.00"))
+
+    def test_investment_statistics_aggregated_in_database(self):
+        Cashflow.objects.create(
+            loan_identifier=self.loan,
+            type="REPAYMENT",
+            reference_date=date(2022, 6, 1),
+            amount=Decimal("250"),
+        )
+        Loan.objects.filter(pk=self.loan.pk).update(
+            is_closed=True, realized_irr=Decimal("0.05"))
+
+        with self.assertNumQueries(2):
+            statistics = calculate_investment_statistics()
+
+        self.assertEqual(statistics, {
+            "total_invested": Decimal("20000"),
+            "total_returned": Decimal("10250.05"),
+            "total_interest_earned": Decimal("0.05"),
+            "total_expected_interest": Decimal("1000"),
+        })
+
+    def test_investment_statistics_rollup(self):
+        loan = Loan.objects.create(
+            identifier="L002",
+            issue_date=date(2022, 3, 15),
+            total_amount=Decimal("5000"),
+            rating=3,
+            maturity_date=date(2023, 3, 15),
+            total_expected_interest_amount=Decimal("500"),
+        )
+        Cashflow.objects.create(
+            loan_identifier=loan,
+            type="FUNDING",
+            reference_date=date(2022, 3, 15),
+            amount=Decimal("-5000"),
+        )
+        Cashflow.objects.create(
+            loan_identifier=loan,
+            type="REPAYMENT",
+            reference_date=date(2023, 3, 15),
+            amount=Decimal("5500"),
+        )
+
+        url = reverse("investment_statistics_rollup")
+        with self.assertNumQueries(4):
+            # two permission checks, the groups of the user for the response
+            # cache and a single query over the cells
+            response = self.client.get(url, {"group_by": "rating"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(row["rating"], row["loan_count"], row["invested_amount"])
+             for row in response.data],
+            [(3, 1, "-5000.00"), (5, 1, "10000.00")],
+        )
+
+        response = self.client.get(
+            url, {"is_closed": "true", "issue_month__gte": "2022-02-01"})
+        self.assertEqual(response.data, [{
+            "loan_count": 1,
+            "invested_amount": "-5000.00",
+            "returned_amount": "5500.00",
+            "expected_interest_amount": "-500.00",
+            "realized_interest_amount": "500.00",
+        }])
+
+        response = self.client.get(url, {"group_by": "vintage"})
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST)
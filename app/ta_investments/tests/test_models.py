@@ -1,10 +1,20 @@
 from datetime import date, timedelta
 from decimal import Decimal
+from unittest.mock import patch
 
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.test import TestCase
 from django.utils import timezone
-from ta_investments.models import Cashflow, Loan, User
+from pyxirr import xirr
+from ta_investments.irr import (cached_xirr, clear_xirr_cache, expected_irr,
+                                expected_irr_expression, xirr_cache_stats)
+from ta_investments.metrics import refresh_expected_irr
+from ta_investments.models import (Cashflow, Loan, PortfolioStatistics,
+                                   StatisticsRollup, StatisticsSnapshot, User)
+from ta_investments.utils import (calculate_investment_statistics,
+                                  calculate_portfolio_irr,
+                                  dated_investment_statistics)
 
 
 class UserModelTests(TestCase):
@@ -64,3 +74,482 @@ class UserModelTests(TestCase):
             user_type="Investor",
         )
         self.assertEqual(str(user), user.email)
+
+
+class LoanModelTests(TestCase):
+    """
+    Test the calculated fields of the Loan model.
+    """
+
+    def setUp(self):
+        self.loan = Loan.objects.create(
+            identifier="L101",
+            issue_date=date(2021, 5, 1),
+            total_amount=Decimal("200000"),
+            rating=1,
+            maturity_date=date(2021, 8, 1),
+            total_expected_interest_amount=Decimal("80"),
+        )
+        Cashflow.objects.bulk_create([
+            Cashflow(loan_identifier=self.loan, type="FUNDING",
+                     reference_date=date(2021, 5, 1),
+                     amount=Decimal("-100000")),
+            Cashflow(loan_identifier=self.loan, type="REPAYMENT",
+                     reference_date=date(2021, 8, 10),
+                     amount=Decimal("100050")),
+        ])
+
+    def test_calculate_fields_in_one_query(self):
+        """
+        Test the calculated fields are derived from a single query.
+        """
+        with self.assertNumQueries(1):
+            self.loan.calculate_fields()
+
+        self.assertEqual(self.loan.investment_date, date(2021, 5, 1))
+        self.assertEqual(self.loan.invested_amount, Decimal("-100000"))
+        self.assertIsNotNone(self.loan.expected_irr)
+        self.assertTrue(self.loan.is_closed)
+        self.assertIsNotNone(self.loan.realized_irr)
+
+    def test_calculate_fields_with_prefetched_cashflows(self):
+        """
+        Test prefetched cash flows are used without extra queries.
+        """
+        loan = Loan.objects.prefetch_related("cashflows").get(pk=self.loan.pk)
+        with self.assertNumQueries(0):
+            loan.calculate_fields()
+        self.assertTrue(loan.is_closed)
+
+        cashflows = list(self.loan.cashflows.filter(type="FUNDING"))
+        with self.assertNumQueries(0):
+            self.loan.calculate_fields(cashflows)
+        self.assertFalse(self.loan.is_closed)
+
+    def test_closed_form_expected_irr_matches_xirr(self):
+        """
+        Test the closed-form expected IRR agrees with the XIRR solver.
+        """
+        for days, interest in [(92, "80"), (1, "0.01"), (3650, "90000")]:
+            invested = Decimal("-1234.56")
+            expected_interest = Decimal(interest) * (
+                invested / Decimal("200000"))
+            start = date(2021, 5, 1)
+            end = start + timedelta(days=days)
+            self.assertAlmostEqual(
+                expected_irr(Decimal("200000"), Decimal(interest), start, end),
+                xirr([start, end],
+                     [-invested, invested + expected_interest]),
+                places=9)
+
+    def test_expected_irr_refreshed_in_one_update(self):
+        """
+        Test expected IRR is computed by the database for a loan set.
+        """
+        self.loan.calculate_fields()
+        self.loan.save()
+        self.loan.refresh_from_db()
+        computed = self.loan.expected_irr
+        annotated = Loan.objects.annotate(
+            irr=expected_irr_expression()).get(pk=self.loan.pk).irr
+        self.assertAlmostEqual(annotated, float(computed), places=6)
+
+        Loan.objects.update(expected_irr=None)
+        with self.assertNumQueries(1):
+            self.assertEqual(refresh_expected_irr(), 1)
+        self.loan.refresh_from_db()
+        self.assertEqual(self.loan.expected_irr, computed)
+
+    def test_repayment_totals_maintained_on_write(self):
+        """
+        Test cash flow create, update and delete maintain the totals.
+        """
+        self.loan.calculate_fields()
+        self.loan.save()
+        self.assertEqual(self.loan.total_repaid, Decimal("100050"))
+        self.assertEqual(self.loan.repayment_count, 1)
+
+        repayment = Cashflow.objects.create(
+            loan_identifier=self.loan, type="REPAYMENT",
+            reference_date=date(2021, 9, 1), amount=Decimal("10"))
+        self.loan.refresh_from_db()
+        self.assertEqual(self.loan.total_repaid, Decimal("100060"))
+        self.assertEqual(self.loan.repayment_count, 2)
+        self.assertEqual(self.loan.last_repayment_date, date(2021, 9, 1))
+
+        repayment.amount = Decimal("25")
+        repayment.reference_date = date(2021, 8, 1)
+        repayment.save()
+        self.loan.refresh_from_db()
+        self.assertEqual(self.loan.total_repaid, Decimal("100075"))
+        self.assertEqual(self.loan.repayment_count, 2)
+        self.assertEqual(self.loan.last_repayment_date, date(2021, 8, 10))
+
+        repayment.delete()
+        self.loan.refresh_from_db()
+        self.assertEqual(self.loan.total_repaid, Decimal("100050"))
+        self.assertEqual(self.loan.repayment_count, 1)
+        self.assertEqual(self.loan.last_repayment_date, date(2021, 8, 10))
+
+    def test_closure_checked_from_totals(self):
+        """
+        Test a repayment of an open loan does not re-read its cash flows.
+        """
+        self.loan.calculate_fields()
+        self.loan.save()
+        Cashflow.objects.filter(type="REPAYMENT").delete()
+
+        with self.assertNumQueries(8):
+            # in a savepoint: insert, lock the loan, add it to the portfolio
+            # statistics and to the rollup cell of the loan, update the
+            # totals and get the loan, which stays open so is not saved
+            Cashflow.objects.create(
+                loan_identifier=self.loan, type="REPAYMENT",
+                reference_date=date(2021, 8, 10), amount=Decimal("50"))
+        self.loan.refresh_from_db()
+        self.assertFalse(self.loan.is_closed)
+
+    def test_repayment_delete_reopens_loan(self):
+        """
+        Test deleting a repayment of a closed loan reopens it.
+        """
+        self.loan.calculate_fields()
+        self.loan.save()
+        self.assertTrue(self.loan.is_closed)
+
+        Cashflow.objects.get(type="REPAYMENT").delete()
+        self.loan.refresh_from_db()
+        self.assertFalse(self.loan.is_closed)
+        self.assertIsNone(self.loan.realized_irr)
+        self.assertEqual(self.loan.invested_amount, Decimal("-100000"))
+
+    def test_funding_delete_empties_calculated_fields(self):
+        """
+        Test deleting the funding cash flow empties the calculated fields.
+        """
+        self.loan.calculate_fields()
+        self.loan.save()
+
+        Cashflow.objects.get(type="FUNDING").delete()
+        self.loan.refresh_from_db()
+        self.assertIsNone(self.loan.investment_date)
+        self.assertIsNone(self.loan.invested_amount)
+        self.assertIsNone(self.loan.expected_irr)
+        self.assertFalse(self.loan.is_closed)
+        self.assertIsNone(self.loan.realized_irr)
+        self.assertEqual(self.loan.total_repaid, Decimal("100050"))
+
+    def test_unchanged_cashflow_save_skips_loan(self):
+        """
+        Test saving a cash flow without changes does not touch its loan.
+        """
+        repayment = Cashflow.objects.get(type="REPAYMENT")
+        repayment.amount = "100050.00"
+        with self.assertNumQueries(4):
+            # in a savepoint: read the previous version and update the row
+            repayment.save()
+
+    def test_cashflow_moved_to_another_loan(self):
+        """
+        Test moving a repayment to another loan updates both loans.
+        """
+        self.loan.calculate_fields()
+        self.loan.save()
+        other = Loan.objects.create(
+            identifier="L102",
+            issue_date=date(2021, 5, 1),
+            total_amount=Decimal("1000"),
+            rating=2,
+            maturity_date=date(2021, 8, 1),
+            total_expected_interest_amount=Decimal("10"),
+        )
+
+        repayment = Cashflow.objects.get(type="REPAYMENT")
+        repayment.loan_identifier = other
+        repayment.save()
+        self.loan.refresh_from_db()
+        other.refresh_from_db()
+        self.assertFalse(self.loan.is_closed)
+        self.assertEqual(self.loan.repayment_count, 0)
+        self.assertEqual(other.total_repaid, Decimal("100050"))
+        self.assertEqual(other.repayment_count, 1)
+
+    def test_portfolio_statistics_maintained_on_write(self):
+        """
+        Test loan and cash flow writes keep the portfolio statistics equal
+        to a recompute from scratch.
+        """
+        def assert_consistent():
+            self.assertEqual(
+                PortfolioStatistics.current(),
+                calculate_investment_statistics())
+
+        # the cash flows of setUp were bulk created behind the model's back
+        PortfolioStatistics.rebuild()
+        self.loan.calculate_fields()
+        self.loan.save()
+        assert_consistent()
+
+        repayment = Cashflow.objects.create(
+            loan_identifier=self.loan, type="REPAYMENT",
+            reference_date=date(2021, 9, 1), amount="12.34")
+        assert_consistent()
+
+        repayment.amount = Decimal("20")
+        repayment.save()
+        assert_consistent()
+
+        Cashflow.objects.get(amount=Decimal("100050")).delete()
+        assert_consistent()
+
+        Cashflow.objects.get(type="FUNDING").delete()
+        assert_consistent()
+
+        Loan.objects.get(pk=self.loan.pk).delete()
+        assert_consistent()
+        self.assertEqual(
+            set(PortfolioStatistics.current().values()), {Decimal(0)})
+
+    def test_queryset_delete_maintains_loan(self):
+        """
+        Test cash flows deleted in bulk are removed from their loan.
+        """
+        self.loan.calculate_fields()
+        self.loan.save()
+        self.assertTrue(self.loan.is_closed)
+
+        Cashflow.objects.filter(type="REPAYMENT").delete()
+        self.loan.refresh_from_db()
+        self.assertFalse(self.loan.is_closed)
+        self.assertEqual(self.loan.total_repaid, Decimal(0))
+        self.assertEqual(self.loan.repayment_count, 0)
+        self.assertEqual(
+            StatisticsRollup.cells(),
+            StatisticsRollup.of_loans(Loan.objects.all()))
+
+    def test_loan_delete_removes_its_cash_flows_once(self):
+        """
+        Test the cash flows deleted along with their loan are not removed
+        from it again.
+        """
+        PortfolioStatistics.rebuild()
+        self.loan.calculate_fields()
+        self.loan.save()
+
+        Loan.objects.filter(pk=self.loan.pk).delete()
+        self.assertEqual(
+            set(PortfolioStatistics.current().values()), {Decimal(0)})
+        self.assertFalse(
+            StatisticsRollup.objects.exclude(
+                loan_count=0, invested_amount=0, returned_amount=0,
+                expected_interest_amount=0).exists())
+
+
+class StatisticsSnapshotTests(TestCase):
+    """
+    Test the daily snapshots of the investment statistics.
+    """
+
+    def setUp(self):
+        closed = Loan.objects.create(
+            identifier="L101",
+            issue_date=date(2021, 5, 1),
+            total_amount=Decimal("200000"),
+            rating=1,
+            maturity_date=date(2021, 8, 1),
+            total_expected_interest_amount=Decimal("80"),
+        )
+        self.open = Loan.objects.create(
+            identifier="L102",
+            issue_date=date(2021, 6, 1),
+            total_amount=Decimal("55000"),
+            rating=3,
+            maturity_date=date(2021, 10, 1),
+            total_expected_interest_amount=Decimal("30"),
+        )
+        for loan, kind, day, amount in [
+                (closed, "FUNDING", date(2021, 5, 1), "-100000"),
+                (self.open, "FUNDING", date(2021, 6, 3), "-55000"),
+                (closed, "REPAYMENT", date(2021, 8, 10), "100050")]:
+            Cashflow.objects.create(
+                loan_identifier=loan, type=kind, reference_date=day,
+                amount=amount)
+
+    def assert_as_of(self, *days):
+        for day in days:
+            self.assertEqual(
+                StatisticsSnapshot.as_of(day),
+                dated_investment_statistics(until=day))
+
+    def test_snapshots_taken_daily_on_top_of_the_previous_one(self):
+        self.assertEqual(
+            StatisticsSnapshot.take(until=date(2021, 8, 31)), 123)
+        self.assert_as_of(
+            date(2021, 4, 30), date(2021, 5, 1), date(2021, 8, 10),
+            date(2021, 9, 15))
+        self.assertEqual(
+            StatisticsSnapshot.objects.get(day=date(2021, 8, 10)).totals(),
+            calculate_investment_statistics())
+
+        with self.assertNumQueries(7):
+            # the lock of the stale marker in a savepoint, the latest
+            # snapshot, the totals of the new days and one INSERT
+            taken = StatisticsSnapshot.take(until=date(2021, 9, 2))
+        self.assertEqual(taken, 2)
+
+    def test_backdated_write_makes_later_snapshots_stale(self):
+        StatisticsSnapshot.take(until=date(2021, 8, 31))
+
+        Cashflow.objects.create(
+            loan_identifier=self.open, type="REPAYMENT",
+            reference_date=date(2021, 7, 1), amount="1000")
+        self.assertEqual(
+            PortfolioStatistics.objects.get().snapshots_stale_from,
+            date(2021, 7, 1))
+        self.assert_as_of(date(2021, 6, 30), date(2021, 7, 1),
+                          date(2021, 8, 31))
+
+        # the stale days are taken again
+        self.assertEqual(
+            StatisticsSnapshot.take(until=date(2021, 8, 31)), 62)
+        self.assertIsNone(
+            PortfolioStatistics.objects.get().snapshots_stale_from)
+        self.assert_as_of(date(2021, 7, 1), date(2021, 8, 31))
+
+
+class StatisticsRollupTests(TestCase):
+    """
+    Test the statistics rollup cells.
+    """
+
+    def test_cells_updated_in_key_order(self):
+        StatisticsRollup.objects.create(
+            rating=2, issue_month=date(2021, 5, 1), is_closed=False)
+        delta = {
+            (3, date(2021, 6, 1), False): {"loan_count": 1},
+            (2, date(2021, 5, 1), False): {"loan_count": 1},
+            (1, date(2021, 7, 1), True): {"loan_count": 1},
+            (2, date(2021, 5, 1), True): {"loan_count": 1},
+        }
+        add_to_cell = StatisticsRollup._add_to_cell
+        with patch.object(StatisticsRollup, "_add_to_cell",
+                          side_effect=add_to_cell) as updated:
+            StatisticsRollup.add(delta)
+
+        # the existing cell, then the missing ones once created, each pass
+        # in key order
+        missing = sorted(delta)
+        missing.remove((2, date(2021, 5, 1), False))
+        self.assertEqual(
+            [call.args[0] for call in updated.call_args_list],
+            sorted(delta) + missing)
+        self.assertEqual(
+            set(StatisticsRollup.objects.values_list("loan_count", flat=True)),
+            {1})
+
+
+class PortfolioIrrTests(TestCase):
+    """
+    Test the portfolio XIRRs solved over cash flows netted by day.
+    """
+
+    def setUp(self):
+        for identifier, rating, issue_date, flows in [
+                ("L101", 1, date(2021, 5, 1), [
+                    ("FUNDING", date(2021, 5, 1), "-100000"),
+                    ("REPAYMENT", date(2021, 8, 10), "100050")]),
+                ("L102", 3, date(2021, 5, 1), [
+                    ("FUNDING", date(2021, 5, 1), "-50000"),
+                    ("REPAYMENT", date(2021, 8, 10), "25000"),
+                    ("REPAYMENT", date(2021, 9, 1), "25100")]),
+                ("L103", 3, date(2022, 1, 1), [
+                    ("FUNDING", date(2022, 1, 3), "-20000")])]:
+            loan = Loan.objects.create(
+                identifier=identifier,
+                issue_date=issue_date,
+                total_amount=Decimal("200000"),
+                rating=rating,
+                maturity_date=issue_date + timedelta(days=100),
+                total_expected_interest_amount=Decimal("80"),
+            )
+            for kind, day, amount in flows:
+                Cashflow.objects.create(
+                    loan_identifier=loan, type=kind, reference_date=day,
+                    amount=amount)
+
+    def test_one_xirr_over_the_daily_net_amounts(self):
+        with self.assertNumQueries(3):
+            # the realized cash flows by day, and the expected ones by
+            # investment and by maturity date
+            irr = calculate_portfolio_irr()
+
+        self.assertAlmostEqual(irr["realized_irr"], xirr(
+            [date(2021, 5, 1), date(2021, 8, 10), date(2021, 9, 1)],
+            [-150000, 125050, 25100]))
+        self.assertAlmostEqual(irr["expected_irr"], xirr(
+            [date(2021, 5, 1), date(2021, 8, 9), date(2022, 1, 3),
+             date(2022, 4, 11)],
+            [-150000, 150060, -20000, 20008]))
+
+    def test_subsets_and_point_in_time(self):
+        rated_3 = calculate_portfolio_irr(Loan.objects.filter(rating=3))
+        self.assertAlmostEqual(rated_3["realized_irr"], xirr(
+            [date(2021, 5, 1), date(2021, 8, 10), date(2021, 9, 1)],
+            [-50000, 25000, 25100]))
+
+        vintage_2022 = calculate_portfolio_irr(
+            Loan.objects.filter(issue_date__year=2022))
+        self.assertIsNone(vintage_2022["realized_irr"])
+        self.assertAlmostEqual(
+            vintage_2022["expected_irr"],
+            float(Loan.objects.get(identifier="L103").expected_irr),
+            places=6)
+
+        # L102 closed after the end of August
+        self.assertAlmostEqual(
+            calculate_portfolio_irr(until=date(2021, 8, 31))["realized_irr"],
+            float(Loan.objects.get(identifier="L101").realized_irr),
+            places=6)
+
+
+class CachedXirrTests(TestCase):
+    """
+    Test the memoised XIRR solver.
+    """
+
+    def setUp(self):
+        clear_xirr_cache()
+        cache.clear()
+        self.addCleanup(clear_xirr_cache)
+
+    def test_results_memoised_in_both_layers(self):
+        """
+        Test a cash flow set is solved once, whatever its order or format.
+        """
+        dates = [date(2021, 5, 1), date(2021, 8, 10)]
+        with patch("ta_investments.irr.xirr", wraps=xirr) as solver:
+            first = cached_xirr(dates, [Decimal("-100000"), 100050])
+            local = cached_xirr(
+                dates[::-1], [Decimal("100050.00"), Decimal("-100000.00")])
+            clear_xirr_cache()
+            shared = cached_xirr(dates, [-100000, 100050])
+
+        solver.assert_called_once()
+        self.assertEqual(first, local)
+        self.assertEqual(first, shared)
+        self.assertEqual(
+            xirr_cache_stats(),
+            {"local_hits": 0, "shared_hits": 1, "misses": 0})
+
+    def test_local_layer_bounded(self):
+        """
+        Test the in-process layer evicts the least recently used results.
+        """
+        with self.settings(XIRR_CACHE_SIZE=1):
+            cached_xirr([date(2021, 1, 1), date(2022, 1, 1)], [-100, 110])
+            cached_xirr([date(2021, 1, 1), date(2022, 1, 1)], [-100, 120])
+            cached_xirr([date(2021, 1, 1), date(2022, 1, 1)], [-100, 110])
+
+        self.assertEqual(
+            xirr_cache_stats(),
+            {"local_hits": 0, "shared_hits": 1, "misses": 2})
@@ -0,0 +1,534 @@
+"""
+Tests for the CSV import tasks.
+"""
+import bz2
+import gzip
+import io
+import tempfile
+import time
+import zipfile
+from datetime import date
+from decimal import Decimal
+from unittest import skipIf
+from unittest.mock import patch
+
+from app.celery import app as celery_app
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+
+from ..caching import is_stale, store
+from ..columnar import pa
+from ..models import (Cashflow, ImportJob, Loan, PortfolioStatistics,
+                      StatisticsSnapshot)
+from ..tasks import (process_cashflow_csv, process_cashflow_file,
+                     process_cashflow_file_in_chunks, process_loans_csv,
+                     process_loans_file, process_loans_file_in_chunks,
+                     recompute_flagged_loans, recompute_loan_metrics,
+                     take_statistics_snapshots)
+from ..uploads import spool_upload, split_upload, upload_storage
+from ..utils import calculate_investment_statistics
+
+LOANS_CSV = (
+    "identifier,issue_date,total_amount,rating,maturity_date,"
+    "total_expected_interest_amount\n"
+    "L101,2021-05-01,200000,1,2021-08-01,80\n"
+    "L102,2021-06-01,55000,3,2021-10-01,30\n"
+    "L103,2021-07-01,100000,2,2021-12-01,50\n"
+)
+
+CASHFLOWS_CSV = (
+    "loan_identifier,reference_date,type,amount\n"
+    "L101,2021-05-01,Funding,-100000\n"
+    "L102,2021-06-03,Funding,-55000\n"
+    "L999,2021-06-03,Funding,-1000\n"
+    "L101,2021-08-10,Repayment,100050\n"
+)
+
+
+class ProcessLoansCsvTests(TestCase):
+    def test_loans_inserted_in_batches(self):
+        with self.assertNumQueries(16):
+            # the existing identifiers, one savepoint, INSERT and release per
+            # batch, and the rollup cells of the new loans: an UPDATE each,
+            # and as they are missing one INSERT per batch and an UPDATE each
+            # again
+            result = process_loans_csv(LOANS_CSV, batch_size=2)
+
+        self.assertEqual(Loan.objects.count(), 3)
+        self.assertEqual(result["rows_inserted"], 3)
+        self.assertIn("rows_per_second", result)
+
+    def test_statistics_cache_invalidated_once(self):
+        store("investment_statistics", {"total_invested": 1}, time.time(), 60)
+        process_loans_csv(LOANS_CSV)
+        self.assertTrue(is_stale("investment_statistics", 300))
+
+    def test_reimport_rejects_existing_loans(self):
+        process_loans_csv(LOANS_CSV)
+        result = process_loans_csv(
+            LOANS_CSV + "L104,2021-08-01,1000,5,2022-08-01,10\n"
+            "L104,2021-08-01,2000,5,2022-08-01,10\n")
+
+        self.assertEqual(result["rows_inserted"], 1)
+        self.assertEqual(result["rows_rejected"], 4)
+        self.assertEqual(Loan.objects.count(), 4)
+        self.assertEqual(
+            Loan.objects.get(identifier="L104").total_amount, Decimal("1000"))
+
+    def test_wrong_header_skips_import(self):
+        result = process_loans_csv("foo,bar\n1,2\n")
+        self.assertEqual(result["rows_inserted"], 0)
+        self.assertEqual(Loan.objects.count(), 0)
+
+
+class ProcessCashflowCsvTests(TestCase):
+    def setUp(self):
+        process_loans_csv(LOANS_CSV)
+
+    def test_cashflows_inserted_for_known_loans(self):
+        result = process_cashflow_csv(CASHFLOWS_CSV, batch_size=2)
+
+        self.assertEqual(result["rows_inserted"], 3)
+        self.assertEqual(Cashflow.objects.count(), 3)
+        self.assertEqual(
+            Cashflow.objects.filter(loan_identifier="L101").count(), 2)
+
+    def test_loan_fields_recomputed_once_per_loan(self):
+        with patch.object(
+                Loan, "calculate_fields",
+                autospec=True) as calculate_fields:
+            process_cashflow_csv(CASHFLOWS_CSV)
+
+        recomputed = sorted(
+            call.args[0].identifier
+            for call in calculate_fields.call_args_list)
+        self.assertEqual(recomputed, ["L101", "L102"])
+
+    def test_loan_calculated_fields_populated(self):
+        process_cashflow_csv(CASHFLOWS_CSV)
+
+        loan = Loan.objects.get(identifier="L102")
+        self.assertEqual(loan.invested_amount, Decimal("-55000"))
+        self.assertIsNotNone(loan.investment_date)
+        self.assertIsNotNone(loan.expected_irr)
+
+
+class ProcessUploadedFileTests(TestCase):
+    def setUp(self):
+        self.upload_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.upload_root.cleanup)
+        override = override_settings(CSV_UPLOAD_ROOT=self.upload_root.name)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_spooled_files_imported_and_removed(self):
+        loans = spool_upload(
+            SimpleUploadedFile("loans.csv", LOANS_CSV.encode("utf-8")))
+        cashflows = spool_upload(
+            SimpleUploadedFile(
+                "cash_flows.csv",
+                CASHFLOWS_CSV.encode("utf-8")))
+
+        process_loans_file(loans)
+        process_cashflow_file(cashflows)
+
+        self.assertEqual(Loan.objects.count(), 3)
+        self.assertEqual(Cashflow.objects.count(), 3)
+        self.assertFalse(upload_storage().exists(loans))
+        self.assertFalse(upload_storage().exists(cashflows))
+
+    def test_compressed_files_imported(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w") as f:
+            f.writestr("export/cash_flows.csv", CASHFLOWS_CSV)
+        uploads = [
+            ("loans.csv.gz", gzip.compress(LOANS_CSV.encode("utf-8"))),
+            ("loans.csv.bz2", bz2.compress(LOANS_CSV.encode("utf-8"))),
+        ]
+
+        for name, content in uploads:
+            with self.subTest(name=name):
+                Loan.objects.all().delete()
+                process_loans_file(
+                    spool_upload(SimpleUploadedFile(name, content)))
+                self.assertEqual(Loan.objects.count(), 3)
+
+        process_cashflow_file(
+            spool_upload(
+                SimpleUploadedFile("cash_flows.zip", archive.getvalue())))
+        self.assertEqual(Cashflow.objects.count(), 3)
+
+    def test_zip_without_single_csv_rejected(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w") as f:
+            f.writestr("a.csv", LOANS_CSV)
+            f.writestr("b.csv", LOANS_CSV)
+        name = spool_upload(
+            SimpleUploadedFile("loans.zip", archive.getvalue()))
+
+        with self.assertRaises(ValueError):
+            process_loans_file(name)
+        self.assertFalse(upload_storage().exists(name))
+
+
+class ChunkedImportTests(TestCase):
+    def setUp(self):
+        self.upload_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.upload_root.cleanup)
+        override = override_settings(CSV_UPLOAD_ROOT=self.upload_root.name)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(
+            setattr, celery_app.conf, "task_always_eager", False)
+
+    def test_split_upload_repeats_header(self):
+        name = spool_upload(
+            SimpleUploadedFile("loans.csv", LOANS_CSV.encode("utf-8")))
+
+        chunk_names = split_upload(name, 2)
+
+        self.assertEqual(len(chunk_names), 2)
+        with upload_storage().open(chunk_names[1], "rb") as f:
+            lines = f.read().decode("utf-8").splitlines()
+        self.assertEqual(lines[0], LOANS_CSV.splitlines()[0])
+        self.assertEqual(len(lines), 2)
+
+    def test_split_compressed_upload(self):
+        name = spool_upload(
+            SimpleUploadedFile(
+                "loans.csv.gz", gzip.compress(LOANS_CSV.encode("utf-8"))))
+
+        chunk_names = split_upload(name, 2)
+
+        with upload_storage().open(chunk_names[0], "rb") as f:
+            lines = f.read().decode("utf-8").splitlines()
+        self.assertEqual(lines, LOANS_CSV.splitlines()[:3])
+
+    def test_chunks_imported_and_loans_recomputed_once(self):
+        process_loans_file_in_chunks(
+            spool_upload(
+                SimpleUploadedFile("loans.csv", LOANS_CSV.encode("utf-8"))),
+            rows_per_chunk=1,
+        )
+        with patch.object(
+                Loan, "calculate_fields",
+                autospec=True) as calculate_fields:
+            process_cashflow_file_in_chunks(
+                spool_upload(
+                    SimpleUploadedFile(
+                        "cash_flows.csv",
+                        CASHFLOWS_CSV.encode("utf-8"))),
+                rows_per_chunk=1,
+            )
+
+        self.assertEqual(Loan.objects.count(), 3)
+        self.assertEqual(Cashflow.objects.count(), 3)
+        self.assertEqual(calculate_fields.call_count, 2)
+        self.assertIsNotNone(cache.get("investment_statistics"))
+        # only the merged rejected rows report (unknown loan L999) is left
+        remaining = upload_storage().listdir("")[1]
+        self.assertEqual(len(remaining), 1)
+        self.assertTrue(remaining[0].endswith("-rejected.csv"))
+
+    def test_import_job_progress_tracked(self):
+        job = ImportJob.objects.create(kind="CASHFLOWS", file_name="cf.csv")
+        process_loans_csv(LOANS_CSV)
+
+        process_cashflow_file_in_chunks(
+            spool_upload(
+                SimpleUploadedFile(
+                    "cash_flows.csv", CASHFLOWS_CSV.encode("utf-8"))),
+            rows_per_chunk=2,
+            job_id=job.pk,
+        )
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, "SUCCEEDED")
+        self.assertEqual(job.rows_read, 4)
+        self.assertEqual(job.rows_inserted, 3)
+        self.assertEqual(job.rows_rejected, 1)
+        self.assertIsNotNone(job.duration)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_import_job_marked_failed(self):
+        job = ImportJob.objects.create(kind="LOANS", file_name="loans.csv")
+        name = spool_upload(
+            SimpleUploadedFile("loans.csv", LOANS_CSV.encode("utf-8")))
+
+        with patch(
+                "ta_investments.tasks.load_loans",
+                side_effect=ValueError("boom")):
+            with self.assertRaises(ValueError):
+                process_loans_file(name, job_id=job.pk)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, "FAILED")
+        self.assertEqual(job.error, "boom")
+
+
+class RecomputeLoanMetricsTests(TestCase):
+    def setUp(self):
+        process_loans_csv(LOANS_CSV)
+        process_cashflow_csv(CASHFLOWS_CSV)
+        Loan.objects.update(expected_irr=None)
+
+    def test_matching_loans_recomputed_in_chunks(self):
+        with self.assertNumQueries(8):
+            # loans, their cash flows and the bulk update for the one chunk,
+            # the final empty chunk, then the materialised statistics and
+            # the daily cash flows the portfolio IRRs are solved over
+            result = recompute_loan_metrics(
+                since="2021-06-01", only_open=True, chunk_size=2)
+
+        self.assertEqual(result["loans_recomputed"], 2)
+        # L101 is closed; L103 has no cash flows to compute from
+        self.assertEqual(
+            list(Loan.objects.exclude(expected_irr=None)
+                 .values_list("identifier", flat=True)),
+            ["L102"])
+
+
+class TakeStatisticsSnapshotsTests(TestCase):
+    def setUp(self):
+        process_loans_csv(LOANS_CSV)
+        process_cashflow_csv(CASHFLOWS_CSV)
+
+    def test_imported_cash_flows_make_snapshots_stale(self):
+        result = take_statistics_snapshots(until="2021-08-31")
+        self.assertEqual(result, {"snapshots_taken": 123})
+
+        process_cashflow_csv(
+            "loan_identifier,reference_date,type,amount\n"
+            "L102,2021-07-01,Repayment,1000\n")
+        self.assertEqual(
+            PortfolioStatistics.objects.get().snapshots_stale_from,
+            date(2021, 7, 1))
+
+        result = take_statistics_snapshots(until="2021-08-31")
+        self.assertEqual(result, {"snapshots_taken": 62})
+        self.assertEqual(
+            StatisticsSnapshot.objects.get(day=date(2021, 8, 31)).totals(),
+            calculate_investment_statistics())
+
+
+@override_settings(LOAN_RECOMPUTE_ASYNC=True)
+class DeferredRecomputeTests(TestCase):
+    def setUp(self):
+        process_loans_csv(LOANS_CSV)
+        process_cashflow_csv(CASHFLOWS_CSV)
+        cache.clear()
+
+    def test_burst_of_repayments_recomputed_once(self):
+        loan = Loan.objects.get(identifier="L102")
+        with patch(
+                "ta_investments.tasks.recompute_flagged_loans.apply_async"
+        ) as apply_async, self.captureOnCommitCallbacks(execute=True):
+            for day in range(1, 4):
+                Cashflow.objects.create(
+                    loan_identifier=loan,
+                    type="REPAYMENT",
+                    reference_date=date(2021, 10, day),
+                    amount=Decimal("20000"),
+                )
+
+        apply_async.assert_called_once_with(countdown=5)
+        loan.refresh_from_db()
+        self.assertTrue(loan.needs_recompute)
+        self.assertFalse(loan.is_closed)
+        self.assertEqual(loan.total_repaid, Decimal("60000"))
+
+        with patch.object(
+                Loan, "calculate_fields",
+                autospec=True,
+                side_effect=Loan.calculate_fields) as calculate_fields:
+            result = recompute_flagged_loans()
+
+        self.assertEqual(result["loans_recomputed"], 1)
+        self.assertEqual(calculate_fields.call_count, 1)
+        loan.refresh_from_db()
+        self.assertFalse(loan.needs_recompute)
+        self.assertTrue(loan.is_closed)
+        self.assertIsNone(cache.get("loan_recompute_scheduled"))
+
+
+class UpsertImportTests(TestCase):
+    def setUp(self):
+        process_loans_csv(LOANS_CSV)
+        process_cashflow_csv(CASHFLOWS_CSV)
+
+    def test_reimport_unchanged_files_writes_nothing(self):
+        with patch.object(
+                Loan, "calculate_fields",
+                autospec=True) as calculate_fields:
+            loans = process_loans_csv(LOANS_CSV, mode="upsert")
+            cashflows = process_cashflow_csv(CASHFLOWS_CSV, mode="upsert")
+
+        self.assertEqual(loans["rows_inserted"], 0)
+        self.assertEqual(loans["rows_updated"], 0)
+        self.assertEqual(cashflows["rows_inserted"], 0)
+        self.assertEqual(cashflows["rows_updated"], 0)
+        self.assertEqual(Cashflow.objects.count(), 3)
+        calculate_fields.assert_not_called()
+
+    def test_reimport_corrected_files_applies_diff(self):
+        loans = process_loans_csv(
+            LOANS_CSV.replace(
+                "L103,2021-07-01,100000,2", "L103,2021-07-01,100000,4")
+            + "L104,2021-08-01,1000,5,2022-08-01,10\n",
+            mode="upsert",
+        )
+        cashflows = process_cashflow_csv(
+            CASHFLOWS_CSV.replace("-55000", "-50000")
+            + "L103,2021-07-04,Funding,-76000\n",
+            mode="upsert",
+        )
+
+        self.assertEqual(loans["rows_inserted"], 1)
+        self.assertEqual(loans["rows_updated"], 1)
+        self.assertEqual(Loan.objects.get(identifier="L103").rating, 4)
+        self.assertEqual(cashflows["rows_inserted"], 1)
+        self.assertEqual(cashflows["rows_updated"], 1)
+        self.assertEqual(Cashflow.objects.count(), 4)
+        self.assertEqual(
+            Loan.objects.get(identifier="L102").invested_amount,
+            Decimal("-50000"))
+
+    def test_same_day_cash_flows_rejected(self):
+        cashflows = process_cashflow_csv(
+            "loan_identifier,reference_date,type,amount\n"
+            "L102,2021-10-03,Repayment,30000\n"
+            "L102,2021-10-03,REPAYMENT,25030\n",
+            mode="upsert",
+        )
+
+        # the second repayment would silently replace the first one
+        self.assertEqual(cashflows["rows_inserted"], 1)
+        self.assertEqual(cashflows["rows_rejected"], 1)
+        self.assertEqual(
+            Loan.objects.get(identifier="L102").total_repaid,
+            Decimal("30000"))
+
+
+class ValidationTests(TestCase):
+    def setUp(self):
+        self.upload_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.upload_root.cleanup)
+        override = override_settings(CSV_UPLOAD_ROOT=self.upload_root.name)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_invalid_rows_rejected_with_reasons(self):
+        name = spool_upload(
+            SimpleUploadedFile(
+                "loans.csv",
+                (LOANS_CSV
+                 + "L104,2021-02-30,1000,5,2022-08-01,10\n"
+                 + "L105,2021-08-01,1000,10,2022-08-01,10\n"
+                 + "L106,2021-08-01,abc,5,2022-08-01,10\n").encode("utf-8")))
+
+        result = process_loans_file(name)
+
+        self.assertEqual(result["rows_read"], 6)
+        self.assertEqual(result["rows_inserted"], 3)
+        self.assertEqual(result["rows_rejected"], 3)
+        with upload_storage().open(result["rejected_file"], "rb") as f:
+            report = f.read().decode("utf-8").splitlines()
+        self.assertEqual(
+            report[0], LOANS_CSV.splitlines()[0] + ",reason")
+        self.assertEqual(
+            [line.rsplit(",", 1)[1] for line in report[1:]],
+            [
+                "invalid issue_date: '2021-02-30'",
+                "invalid rating: '10'",
+                "invalid total_amount: 'abc'",
+            ],
+        )
+
+    def test_no_report_without_rejected_rows(self):
+        name = spool_upload(
+            SimpleUploadedFile("loans.csv", LOANS_CSV.encode("utf-8")))
+
+        result = process_loans_file(name)
+
+        self.assertIsNone(result["rejected_file"])
+
+
+@skipIf(pa is None, "pyarrow is not installed")
+class ParquetImportTests(TestCase):
+    def setUp(self):
+        self.upload_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.upload_root.cleanup)
+        override = override_settings(CSV_UPLOAD_ROOT=self.upload_root.name)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def spool_parquet(self, name, columns):
+        import pyarrow.parquet as pq
+
+        buffer = io.BytesIO()
+        pq.write_table(pa.table(columns), buffer)
+        return spool_upload(SimpleUploadedFile(name, buffer.getvalue()))
+
+    def test_typed_columns_imported(self):
+        loans = self.spool_parquet("loans.parquet", {
+            "identifier": ["L101", "L102", "L103"],
+            "issue_date": [date(2021, 5, 1), date(2021, 6, 1), None],
+            "total_amount": pa.array(
+                [Decimal("200000"), Decimal("55000"), Decimal("1")],
+                type=pa.decimal128(12, 2)),
+            "rating": pa.array([1, 12, 2], type=pa.int64()),
+            "maturity_date": [date(2021, 8, 1)] * 3,
+            "total_expected_interest_amount": [80.0, 30.0, 50.0],
+        })
+        cashflows = self.spool_parquet("cash_flows.parquet", {
+            "loan_identifier": ["L101", "L999", "L101"],
+            "reference_date": [
+                date(2021, 5, 1), date(2021, 5, 1), date(2021, 8, 10)],
+            "type": ["Funding", "Funding", "Repayment"],
+            "amount": ["-100000", "-1", "100050.00"],
+        })
+
+        loans_result = process_loans_file(loans)
+        cashflows_result = process_cashflow_file(cashflows)
+
+        self.assertEqual(loans_result["rows_inserted"], 1)
+        self.assertEqual(loans_result["rows_rejected"], 2)
+        with upload_storage().open(loans_result["rejected_file"], "rb") as f:
+            report = f.read().decode("utf-8").splitlines()
+        self.assertEqual(
+            [line.rsplit(",", 1)[1] for line in report[1:]],
+            ["invalid rating: 12", "invalid issue_date: None"])
+        self.assertEqual(cashflows_result["rows_inserted"], 2)
+        self.assertEqual(cashflows_result["rows_rejected"], 1)
+
+        loan = Loan.objects.get(identifier="L101")
+        self.assertEqual(loan.total_expected_interest_amount, Decimal("80"))
+        self.assertEqual(loan.invested_amount, Decimal("-100000"))
+        self.assertFalse(upload_storage().exists(loans))
+
+    def test_parquet_upload_not_split(self):
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(
+            setattr, celery_app.conf, "task_always_eager", False)
+        job = ImportJob.objects.create(kind="LOANS", file_name="l.parquet")
+
+        process_loans_file_in_chunks(
+            self.spool_parquet("loans.parquet", {
+                "identifier": ["L101", "L102"],
+                "issue_date": ["2021-05-01", "2021-06-01"],
+                "total_amount": ["200000", "55000"],
+                "rating": ["1", "3"],
+                "maturity_date": ["2021-08-01", "2021-10-01"],
+                "total_expected_interest_amount": ["80", "30"],
+            }),
+            rows_per_chunk=1,
+            job_id=job.pk,
+        )
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, "SUCCEEDED")
+        self.assertEqual(job.rows_inserted, 2)
+        self.assertEqual(upload_storage().listdir("")[1], [])
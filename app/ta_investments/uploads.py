@@ -0,0 +1,115 @@
+"""
+Spooling of uploaded import files to the shared upload area
+"""
+import bz2
+import csv
+import gzip
+import io
+import uuid
+import zipfile
+from contextlib import contextmanager
+from itertools import islice
+from typing import List
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+
+# file extensions accepted for imports: CSV, optionally compressed, and
+# Parquet
+UPLOAD_SUFFIXES = (".csv", ".csv.gz", ".csv.bz2", ".zip", ".parquet")
+
+
+def upload_storage() -> FileSystemStorage:
+    return FileSystemStorage(location=settings.CSV_UPLOAD_ROOT)
+
+
+def is_supported_upload(name) -> bool:
+    return name.lower().endswith(UPLOAD_SUFFIXES)
+
+
+def is_parquet_upload(name) -> bool:
+    return name.lower().endswith(".parquet")
+
+
+def spool_upload(uploaded_file) -> str:
+    """
+    Write an uploaded file to the upload area chunk by chunk and return
+    the name the import tasks should be given to read it back.
+    """
+    name = f"{uuid.uuid4().hex}-{uploaded_file.name}"
+    return upload_storage().save(name, uploaded_file)
+
+
+@contextmanager
+def open_upload(name):
+    """
+    Open a spooled upload as a text stream, read lazily line by line.
+    Compressed uploads are decompressed incrementally while reading.
+    """
+    with upload_storage().open(name, "rb") as f:
+        with open_csv(f, name) as stream:
+            yield stream
+
+
+@contextmanager
+def open_csv(f, name):
+    """
+    Wrap a binary file in a text stream, decompressing it on the fly
+    according to the extension of ``name``.
+    """
+    lower_name = name.lower()
+    if lower_name.endswith(".gz"):
+        raw = gzip.GzipFile(fileobj=f, mode="rb")
+    elif lower_name.endswith(".bz2"):
+        raw = bz2.BZ2File(f, mode="rb")
+    elif lower_name.endswith(".zip"):
+        raw = _open_zip_member(f)
+    else:
+        raw = f
+
+    try:
+        yield io.TextIOWrapper(raw, encoding="utf-8", newline="")
+    finally:
+        if raw is not f:
+            raw.close()
+
+
+def _open_zip_member(f):
+    archive = zipfile.ZipFile(f)
+    members = [info for info in archive.infolist()
+               if not info.is_dir() and info.filename.lower().endswith(".csv")]
+    if len(members) != 1:
+        archive.close()
+        raise ValueError("A zip upload must contain exactly one CSV file")
+    return archive.open(members[0])
+
+
+def delete_upload(name):
+    upload_storage().delete(name)
+
+
+def split_upload(name, rows_per_chunk) -> List[str]:
+    """
+    Split a spooled CSV upload into files of at most ``rows_per_chunk``
+    rows, each repeating the header, and return their names.
+    """
+    storage = upload_storage()
+    chunk_names = []
+    with open_upload(name) as stream:
+        reader = csv.reader(stream)
+        header = next(reader, None)
+        if header is None:
+            return chunk_names
+        while True:
+            rows = list(islice(reader, rows_per_chunk))
+            if not rows:
+                break
+            chunk_name = storage.get_available_name(
+                f"{name}.part{len(chunk_names):05d}.csv")
+            with open(storage.path(chunk_name), "w", encoding="utf-8",
+                      newline="") as f:
+                writer = csv.writer(f, lineterminator="\n")
+                writer.writerow(header)
+                writer.writerows(rows)
+            chunk_names.append(chunk_name)
+    return chunk_names
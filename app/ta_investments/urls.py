@@ -2,8 +2,9 @@ from django.urls import path
 
 from .views import (CashflowCSVUploadView, CashflowDetailView,
                     CashflowListCreateView, CreateRepaymentView,
-                    InvestmentStatisticsView, LoanDetailView,
-                    LoanListCreateView, LoansCSVUploadView)
+                    ImportJobDetailView, ImportJobRejectedRowsView,
+                    InvestmentStatisticsRollupView, InvestmentStatisticsView,
+                    LoanDetailView, LoanListCreateView, LoansCSVUploadView)
 
 urlpatterns = [
     path(
@@ -34,6 +35,16 @@ urlpatterns = [
         CashflowCSVUploadView.as_view(),
         name="cashflow_csv_upload",
     ),
+    path(
+        "imports/<int:pk>/",
+        ImportJobDetailView.as_view(),
+        name="import-job-detail",
+    ),
+    path(
+        "imports/<int:pk>/rejected/",
+        ImportJobRejectedRowsView.as_view(),
+        name="import-job-rejected",
+    ),
     path(
         "repayments/",
         CreateRepaymentView.as_view(),
@@ -43,4 +54,9 @@ urlpatterns = [
         InvestmentStatisticsView.as_view(),
         name="investment_statistics",
     ),
+    path(
+        "investment-statistics/rollup/",
+        InvestmentStatisticsRollupView.as_view(),
+        name="investment_statistics_rollup",
+    ),
 ]
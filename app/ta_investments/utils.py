@@ -1,34 +1,277 @@
+import hashlib
+import json
+import time
+from collections import defaultdict
+from datetime import date
 from decimal import Decimal
-from typing import Dict, List
+from functools import partial
+from typing import Dict, Optional
 
-from .models import Cashflow, Loan
+from django.conf import settings
+from django.db.models import DecimalField, F, Q, QuerySet, Sum, Value
+from django.db.models.functions import Coalesce
+
+from . import caching
+from .irr import series_xirr
+from .models import Cashflow, Loan, PortfolioStatistics
+
+
+def _total(expression, decimal_places=2, **filters):
+    # SUM of expression over the matching rows, 0 when there are none
+    return Coalesce(
+        Sum(expression, filter=Q(**filters)),
+        Value(0),
+        output_field=DecimalField(
+            max_digits=20, decimal_places=decimal_places),
+    )
+
+
+def _closed_loan_totals():
+    return {
+        "invested": _total("invested_amount", is_closed=True),
+        "returned": _total(
+            F("invested_amount") + F("realized_irr"),
+            decimal_places=6,
+            is_closed=True,
+        ),
+        "interest_earned": _total(
+            "realized_irr", decimal_places=6, is_closed=True),
+        "expected_interest": _total(
+            "expected_interest_amount", is_closed=True),
+    }
+
+
+def _cashflow_totals():
+    return {
+        "invested": _total("amount", type="FUNDING"),
+        "returned": _total("amount", type="REPAYMENT"),
+    }
+
+
+def _investment_statistics(closed_loans, cashflow_totals):
+    return {
+        "total_invested": (
+            closed_loans["invested"] + cashflow_totals["invested"]),
+        "total_returned": (
+            closed_loans["returned"] + cashflow_totals["returned"]),
+        "total_interest_earned": closed_loans["interest_earned"],
+        "total_expected_interest": closed_loans["expected_interest"],
+    }
+
+
+def _dated(after: date = None, until: date = None, loans: QuerySet = None):
+    # the closed loans and the cash flows dated in (after, until], of loans
+    # or of all loans; a closed loan is dated by its last repayment, which
+    # closed it
+    if loans is None:
+        cashflows = Cashflow.objects.all()
+        loans = Loan.objects.all()
+    else:
+        cashflows = Cashflow.objects.filter(
+            loan_identifier__in=loans.values("identifier"))
+    loans = loans.filter(is_closed=True)
+    if after is not None:
+        loans = loans.filter(last_repayment_date__gt=after)
+        cashflows = cashflows.filter(reference_date__gt=after)
+    if until is not None:
+        loans = loans.filter(last_repayment_date__lte=until)
+        cashflows = cashflows.filter(reference_date__lte=until)
+    return loans, cashflows
 
 
 def calculate_investment_statistics(
-        loans: List[Loan], cashflows: List[Cashflow]) -> Dict[str, Decimal]:
-    total_invested = Decimal(0)
-    total_returned = Decimal(0)
-    total_interest_earned = Decimal(0)
-    total_expected_interest = Decimal(0)
-
-    for loan in loans:
-        if loan.is_closed:
-            total_invested += loan.invested_amount
-            total_returned += loan.invested_amount + loan.realized_irr
-            total_interest_earned += loan.realized_irr
-            total_expected_interest += loan.expected_interest_amount
-
-    for cashflow in cashflows:
-        if cashflow.type == "FUNDING":
-            total_invested += cashflow.amount
-        elif cashflow.type == "REPAYMENT":
-            total_returned += cashflow.amount
-
-    investment_statistics = {
-        "total_invested": total_invested,
-        "total_returned": total_returned,
-        "total_interest_earned": total_interest_earned,
-        "total_expected_interest": total_expected_interest,
+        loans: QuerySet = None,
+        cashflows: QuerySet = None) -> Dict[str, Decimal]:
+    """
+    Total the investment statistics of ``loans`` and ``cashflows`` (all of
+    them by default) in the database, with one aggregate query per table.
+    """
+    if loans is None:
+        loans = Loan.objects.all()
+    if cashflows is None:
+        cashflows = Cashflow.objects.all()
+
+    return _investment_statistics(
+        loans.aggregate(**_closed_loan_totals()),
+        cashflows.aggregate(**_cashflow_totals()),
+    )
+
+
+def dated_investment_statistics(
+        after: date = None, until: date = None,
+        loans: QuerySet = None) -> Dict[str, Decimal]:
+    """
+    Total the investment statistics of the days in ``(after, until]``, of
+    ``loans`` and their cash flows or of the whole portfolio.
+    """
+    return calculate_investment_statistics(*_dated(after, until, loans))
+
+
+def daily_investment_statistics(
+        after: date = None,
+        until: date = None) -> Dict[date, Dict[str, Decimal]]:
+    """
+    Total the investment statistics of each day in ``(after, until]`` with
+    any, with one aggregate query per table.
+    """
+    loans, cashflows = _dated(after, until)
+    closed_loans = {
+        row.pop("last_repayment_date"): row
+        for row in loans.order_by().values("last_repayment_date")
+        .annotate(**_closed_loan_totals())
+    }
+    cashflow_totals = {
+        row.pop("reference_date"): row
+        for row in cashflows.order_by().values("reference_date")
+        .annotate(**_cashflow_totals())
+    }
+
+    no_loans = dict.fromkeys(_closed_loan_totals(), Decimal(0))
+    no_cashflows = dict.fromkeys(_cashflow_totals(), Decimal(0))
+    return {
+        day: _investment_statistics(
+            closed_loans.get(day, no_loans),
+            cashflow_totals.get(day, no_cashflows),
+        )
+        for day in sorted(closed_loans.keys() | cashflow_totals.keys())
     }
 
+
+def portfolio_statistics() -> Dict:
+    """
+    The materialised investment statistics, with the portfolio IRRs.
+    """
+    return {**PortfolioStatistics.current(), **calculate_portfolio_irr()}
+
+
+def cached_investment_statistics() -> Dict:
+    """
+    Return the investment statistics and portfolio IRRs from the cache.
+    Stale statistics are served while a single Celery task refreshes them.
+    """
+    from .tasks import refresh_statistics_cache
+
+    return caching.get_or_refresh(
+        settings.INVESTMENT_STATISTICS_CACHE_KEY,
+        compute=portfolio_statistics,
+        refresh=refresh_statistics_cache.delay,
+        soft_timeout=settings.INVESTMENT_STATISTICS_CACHE_SOFT_TIMEOUT,
+        hard_timeout=settings.INVESTMENT_STATISTICS_CACHE_HARD_TIMEOUT,
+        lock_timeout=settings.INVESTMENT_STATISTICS_CACHE_LOCK_TIMEOUT,
+    )
+
+
+def refresh_investment_statistics() -> Dict:
+    """
+    Read the materialised investment statistics, solve the portfolio IRRs
+    and store them in the cache.
+    """
+    computed_at = time.time()
+    investment_statistics = portfolio_statistics()
+    caching.store(
+        settings.INVESTMENT_STATISTICS_CACHE_KEY,
+        investment_statistics,
+        computed_at,
+        settings.INVESTMENT_STATISTICS_CACHE_HARD_TIMEOUT,
+    )
+    # responses that served the stale statistics
+    caching.invalidate_responses()
+
     return investment_statistics
+
+
+def _net_by_day(*rows) -> Dict[date, Decimal]:
+    # the (day, amount) rows netted by day, in date order
+    net = defaultdict(Decimal)
+    for day, amount in (row for day_rows in rows for row in day_rows):
+        net[day] += amount
+    return {day: net[day] for day in sorted(net) if net[day]}
+
+
+def realized_cashflows(
+        loans: QuerySet, until: date = None) -> Dict[date, Decimal]:
+    """
+    Net amount by day of the cash flows of the closed ``loans`` (closed by
+    ``until`` if given), summed in the database.
+    """
+    loans = loans.filter(is_closed=True)
+    if until is not None:
+        loans = loans.filter(last_repayment_date__lte=until)
+    return _net_by_day(
+        Cashflow.objects.filter(loan_identifier__in=loans.values("identifier"))
+        .order_by().values("reference_date").annotate(net=Sum("amount"))
+        .values_list("reference_date", "net")
+    )
+
+
+def expected_cashflows(
+        loans: QuerySet, until: date = None) -> Dict[date, Decimal]:
+    """
+    Net amount by day of the expected cash flows of the funded ``loans``
+    (funded by ``until`` if given): the investment, then its repayment with
+    the expected interest at maturity. The expected interest amount has the
+    sign of the invested amount. Summed in the database.
+    """
+    loans = loans.filter(investment_date__isnull=False).order_by()
+    if until is not None:
+        loans = loans.filter(investment_date__lte=until)
+    return _net_by_day(
+        loans.values("investment_date")
+        .annotate(net=Sum("invested_amount"))
+        .values_list("investment_date", "net"),
+        loans.values("maturity_date")
+        .annotate(net=-Sum(
+            F("invested_amount") + F("expected_interest_amount")))
+        .values_list("maturity_date", "net"),
+    )
+
+
+def calculate_portfolio_irr(
+        loans: QuerySet = None,
+        until: date = None) -> Dict[str, Optional[float]]:
+    """
+    Realized and expected XIRR of ``loans`` (all of them by default) as of
+    ``until``, each solved once over the cash flows of every loan netted by
+    day in the database.
+    """
+    if loans is None:
+        loans = Loan.objects.all()
+    return {
+        "realized_irr": series_xirr(realized_cashflows(loans, until)),
+        "expected_irr": series_xirr(expected_cashflows(loans, until)),
+    }
+
+
+def filter_hash(filters: Dict) -> str:
+    """
+    Hash of filter values, independent of their order and of the order of
+    the values of multiple value filters.
+    """
+    normalised = {
+        name: sorted(map(str, value)) if isinstance(value, list)
+        else str(value)
+        for name, value in filters.items()
+        if value not in (None, "", [])
+    }
+    payload = json.dumps(normalised, sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def cached_portfolio_irr(
+        filters: Dict = None, loans: QuerySet = None,
+        until: date = None) -> Dict[str, Optional[float]]:
+    """
+    ``calculate_portfolio_irr`` of the ``loans`` selected by ``filters``,
+    cached per filter hash until the next loan or cash flow write. The IRRs
+    of the whole portfolio today are served by
+    ``cached_investment_statistics`` instead.
+    """
+    key = (
+        f"{settings.PORTFOLIO_IRR_CACHE_KEY_PREFIX}:"
+        f"{filter_hash(dict(filters or {}, as_of=until))}")
+    return caching.get_or_compute(
+        key,
+        partial(calculate_portfolio_irr, loans, until),
+        timeout=settings.INVESTMENT_STATISTICS_CACHE_HARD_TIMEOUT,
+        invalidated_by=settings.INVESTMENT_STATISTICS_CACHE_KEY,
+    )
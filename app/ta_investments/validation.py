@@ -0,0 +1,179 @@
+"""
+Validation of imported rows and the rejected rows report
+"""
+import csv
+from datetime import date
+from decimal import Decimal, InvalidOperation
+from typing import Dict, List, Tuple
+
+from .models import Cashflow, Loan
+from .uploads import upload_storage
+
+REJECTED_REASON_FIELD = "reason"
+
+
+def identifier(max_length):
+    def validate(value):
+        value = (value or "").strip()
+        if not value or len(value) > max_length:
+            raise ValueError
+        return value
+    return validate
+
+
+def iso_date(value):
+    return date.fromisoformat(value)
+
+
+def decimal(max_digits, decimal_places):
+    exponent = Decimal(1).scaleb(-decimal_places)
+    limit = Decimal(10) ** (max_digits - decimal_places)
+
+    def validate(value):
+        value = Decimal(value).quantize(exponent)
+        if abs(value) >= limit:
+            raise ValueError
+        return value
+    return validate
+
+
+def integer_between(low, high):
+    def validate(value):
+        value = int(value)
+        if not low <= value <= high:
+            raise ValueError
+        return value
+    return validate
+
+
+def choice(choices):
+    def validate(value):
+        value = (value or "").upper()
+        if value not in choices:
+            raise ValueError
+        return value
+    return validate
+
+
+def _decimal_field(model, name):
+    field = model._meta.get_field(name)
+    return decimal(field.max_digits, field.decimal_places)
+
+
+LOAN_VALIDATORS = {
+    "identifier": identifier(Loan._meta.get_field("identifier").max_length),
+    "issue_date": iso_date,
+    "total_amount": _decimal_field(Loan, "total_amount"),
+    "rating": integer_between(1, 9),
+    "maturity_date": iso_date,
+    "total_expected_interest_amount": _decimal_field(
+        Loan, "total_expected_interest_amount"),
+}
+
+CASHFLOW_VALIDATORS = {
+    "loan_identifier": identifier(
+        Loan._meta.get_field("identifier").max_length),
+    "reference_date": iso_date,
+    "type": choice({key for key, _ in Cashflow.TYPES}),
+    "amount": _decimal_field(Cashflow, "amount"),
+}
+
+
+def validate_rows(
+        rows: List[Dict], validators) -> Tuple[List[Dict], List[Tuple]]:
+    """
+    Validate a batch of CSV rows one column at a time.
+
+    Returns the cleaned (typed) valid rows and the rejected rows paired with
+    the reason of their first failing column.
+    """
+    cleaned = [{} for _ in rows]
+    reasons = [None] * len(rows)
+    for field, validator in validators.items():
+        column = [row.get(field) for row in rows]
+        for index, value in enumerate(column):
+            if reasons[index] is not None:
+                continue
+            try:
+                cleaned[index][field] = validator(value)
+            except (ValueError, TypeError, InvalidOperation):
+                reasons[index] = f"invalid {field}: {value!r}"
+
+    valid = [
+        values for values, reason in zip(cleaned, reasons) if reason is None]
+    rejected = [
+        (row, reason) for row, reason in zip(rows, reasons) if reason]
+    return valid, rejected
+
+
+class RejectedRowsWriter:
+    """
+    Stream rejected rows and their reason to a CSV file in the upload area.
+
+    The file is only created when the first rejected row is written.
+    """
+
+    def __init__(self, name, fieldnames):
+        self.name = name
+        self.fieldnames = list(fieldnames) + [REJECTED_REASON_FIELD]
+        self.count = 0
+        self._file = None
+        self._writer = None
+
+    def write(self, rejected):
+        for row, reason in rejected:
+            if self._writer is None:
+                storage = upload_storage()
+                self.name = storage.get_available_name(self.name)
+                path = storage.path(self.name)
+                self._file = open(path, "w", encoding="utf-8", newline="")
+                self._writer = csv.DictWriter(
+                    self._file,
+                    fieldnames=self.fieldnames,
+                    extrasaction="ignore",
+                    lineterminator="\n",
+                )
+                self._writer.writeheader()
+            self._writer.writerow({**row, REJECTED_REASON_FIELD: reason})
+            self.count += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    @property
+    def written_name(self):
+        """Name of the report, or None if no row was rejected."""
+        return self.name if self._file is not None else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def merge_rejected_files(names, target_name) -> str:
+    """
+    Concatenate the rejected rows reports of the chunks of one import into
+    a single report and delete the parts. Returns the name of the report,
+    or None if there were no rejected rows.
+    """
+    names = [name for name in names if name]
+    if not names:
+        return None
+
+    storage = upload_storage()
+    target_name = storage.get_available_name(target_name)
+    with open(storage.path(target_name), "w", encoding="utf-8",
+              newline="") as target:
+        for index, name in enumerate(names):
+            with open(storage.path(name), encoding="utf-8",
+                      newline="") as part:
+                header = part.readline()
+                if index == 0:
+                    target.write(header)
+                for line in part:
+                    target.write(line)
+            storage.delete(name)
+    return target_name
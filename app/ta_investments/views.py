@@ -1,5 +1,4 @@
-from django.conf import settings
-from django.core.cache import cache
+from django.http import FileResponse
 from django_filters.rest_framework import DjangoFilterBackend
 from drf_spectacular.utils import OpenApiParameter, OpenApiTypes, extend_schema
 from rest_framework import generics, status
@@ -8,13 +7,24 @@ from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .filters import CashFlowFilter, LoanFilter
-from .models import Cashflow, Loan
+from .caching import cache_response
+from .columnar import parquet_available
+from .filters import (CashFlowFilter, LoanFilter, PortfolioFilter,
+                      StatisticsRollupFilter)
+from .models import (Cashflow, ImportJob, Loan, StatisticsRollup,
+                     StatisticsSnapshot)
 from .permissions import IsAnalyst, IsInvestor
-from .serializers import (CashflowSerializer, InvestmentStatisticsSerializer,
-                          LoanSerializer)
-from .tasks import process_cashflow_csv, process_loans_csv
-from .utils import calculate_investment_statistics
+from .serializers import (CashflowSerializer, ImportJobSerializer,
+                          ImportOptionsSerializer,
+                          InvestmentStatisticsSerializer, LoanSerializer,
+                          RollupOptionsSerializer, StatisticsOptionsSerializer,
+                          StatisticsRollupSerializer)
+from .tasks import (process_cashflow_file_in_chunks,
+                    process_loans_file_in_chunks)
+from .uploads import (is_parquet_upload, is_supported_upload, spool_upload,
+                      upload_storage)
+from .utils import (cached_investment_statistics, cached_portfolio_irr,
+                    dated_investment_statistics)
 
 
 class LoanListCreateView(generics.ListCreateAPIView):
@@ -45,6 +55,7 @@ class LoanListCreateView(generics.ListCreateAPIView):
             ),
         ],
     )
+    @cache_response
     def get(self, request, *args, **kwargs):
         return super().get(request, *args, **kwargs)
 
@@ -87,6 +98,7 @@ class CashflowListCreateView(generics.ListCreateAPIView):
             ),
         ],
     )
+    @cache_response
     def get(self, request, *args, **kwargs):
         return super().get(request, *args, **kwargs)
 
@@ -121,17 +133,49 @@ class LoansCSVUploadView(APIView):
             )
 
         # check if file extension is valid
-        if not csv_file.name.endswith(".csv"):
+        if not is_supported_upload(csv_file.name):
             return Response(
-                {"error": "Invalid file format. Please upload a CSV file."},
+                {"error": "Invalid file format. Please upload a CSV file, "
+                          "optionally compressed as .gz, .bz2 or .zip, "
+                          "or a Parquet file."},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # process the CSV file
-        process_loans_csv.delay(csv_file.read().decode("utf-8"))
+        # check if Parquet files can be read
+        if is_parquet_upload(csv_file.name) and not parquet_available():
+            return Response(
+                {"error": "Parquet files are not supported on this server. "
+                          "Please upload a CSV file."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # check if the requested import options are valid
+        options = ImportOptionsSerializer(data=request.data)
+        if not options.is_valid():
+            return Response(
+                {"error": options.errors},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        backend = options.validated_data.get("backend")
+        mode = options.validated_data.get("mode")
+
+        job = ImportJob.objects.create(
+            kind="LOANS",
+            file_name=csv_file.name,
+            backend=backend or "",
+            mode=mode or "",
+        )
+
+        # spool the CSV file to disk and import it in parallel chunks
+        process_loans_file_in_chunks.delay(
+            spool_upload(csv_file),
+            backend=backend,
+            mode=mode,
+            job_id=job.pk,
+        )
 
         return Response(
-            {"message": "Loans CSV file is being processed"},
+            {"message": "Loans CSV file is being processed", "job": job.pk},
             status=status.HTTP_202_ACCEPTED,
         )
 
@@ -156,24 +200,88 @@ class CashflowCSVUploadView(APIView):
             )
 
         # check if file extension is valid
-        if not csv_file.name.endswith(".csv"):
+        if not is_supported_upload(csv_file.name):
             return Response(
-                {"error": "Invalid file format. Please upload a CSV file."},
+                {"error": "Invalid file format. Please upload a CSV file, "
+                          "optionally compressed as .gz, .bz2 or .zip, "
+                          "or a Parquet file."},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # read the CSV file
-        csv_content = csv_file.read().decode("utf-8")
+        # check if Parquet files can be read
+        if is_parquet_upload(csv_file.name) and not parquet_available():
+            return Response(
+                {"error": "Parquet files are not supported on this server. "
+                          "Please upload a CSV file."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-        # process the CSV file asynchronously using Celery
-        process_cashflow_csv.delay(csv_content)
+        # check if the requested import options are valid
+        options = ImportOptionsSerializer(data=request.data)
+        if not options.is_valid():
+            return Response(
+                {"error": options.errors},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        backend = options.validated_data.get("backend")
+        mode = options.validated_data.get("mode")
+
+        job = ImportJob.objects.create(
+            kind="CASHFLOWS",
+            file_name=csv_file.name,
+            backend=backend or "",
+            mode=mode or "",
+        )
+
+        # spool the CSV file to disk and import it in parallel chunks
+        process_cashflow_file_in_chunks.delay(
+            spool_upload(csv_file),
+            backend=backend,
+            mode=mode,
+            job_id=job.pk,
+        )
 
         return Response(
-            {"message": "Cashflow CSV file uploaded successfully"},
+            {"message": "Cashflow CSV file uploaded successfully",
+             "job": job.pk},
             status=status.HTTP_201_CREATED,
         )
 
 
+class ImportJobDetailView(generics.RetrieveAPIView):
+    queryset = ImportJob.objects.all()
+    serializer_class = ImportJobSerializer
+    permission_classes = [IsInvestor, IsAnalyst]
+
+    @extend_schema(summary="Retrieve the status and progress of an import")
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+
+class ImportJobRejectedRowsView(generics.RetrieveAPIView):
+    queryset = ImportJob.objects.all()
+    permission_classes = [IsInvestor, IsAnalyst]
+
+    @extend_schema(
+        summary="Download the rejected rows of an import as CSV",
+        responses={200: OpenApiTypes.BINARY},
+    )
+    def get(self, request, *args, **kwargs):
+        job = self.get_object()
+        if not job.rejected_file:
+            return Response(
+                {"error": "This import has no rejected rows"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        return FileResponse(
+            upload_storage().open(job.rejected_file, "rb"),
+            as_attachment=True,
+            filename=f"import-{job.pk}-rejected.csv",
+            content_type="text/csv",
+        )
+
+
 class CreateRepaymentView(generics.CreateAPIView):
     queryset = Cashflow.objects.all()
     serializer_class = CashflowSerializer
@@ -207,28 +315,105 @@ class InvestmentStatisticsView(generics.ListAPIView):
 
     @extend_schema(
         description="Returns investment statistics for all loans and cashflows",
+        parameters=[
+            OpenApiParameter(
+                name="as_of",
+                description="Statistics as of the end of this day \
+                    (YYYY-MM-DD), from the nearest daily snapshot",
+                required=False,
+                type=OpenApiTypes.DATE,
+            ),
+            OpenApiParameter(
+                name="rating",
+                description="Only the loans with this rating",
+                required=False,
+                type=int,
+            ),
+            OpenApiParameter(
+                name="rating__in",
+                description="Only the loans with one of these comma \
+                    separated ratings",
+                required=False,
+                type=str,
+            ),
+            OpenApiParameter(
+                name="vintage",
+                description="Only the loans issued in this year",
+                required=False,
+                type=int,
+            ),
+        ],
         responses={
             200: InvestmentStatisticsSerializer},
     )
+    @cache_response
     def get(self, request, *args, **kwargs):
-        # Try to get investment statistics from cache
-        investment_statistics = cache.get(
-            settings.INVESTMENT_STATISTICS_CACHE_KEY)
-
-        if investment_statistics is not None:
-            return Response(investment_statistics, status=status.HTTP_200_OK)
-
-        # If the cache is empty, calculate investment statistics
-        loans = Loan.objects.all()
-        cashflows = Cashflow.objects.all()
-        investment_statistics = calculate_investment_statistics(
-            loans, cashflows)
-
-        # Store the statistics in the cache for 5 minutes
-        cache.set(
-            settings.INVESTMENT_STATISTICS_CACHE_KEY,
-            investment_statistics,
-            300,
-        )
+        options = StatisticsOptionsSerializer(data=request.query_params)
+        loans = PortfolioFilter(
+            request.query_params, queryset=Loan.objects.all())
+        if not options.is_valid() or not loans.is_valid():
+            return Response(
+                {"error": {**options.errors, **loans.errors}},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        as_of = options.validated_data.get("as_of")
+        filters = {
+            name: value for name, value in loans.form.cleaned_data.items()
+            if value not in (None, "", [])
+        }
+        if filters:
+            # subsets are totalled in the database
+            investment_statistics = dated_investment_statistics(
+                until=as_of, loans=loans.qs)
+        elif as_of is not None:
+            investment_statistics = StatisticsSnapshot.as_of(as_of)
+        else:
+            # Served from the cache with the portfolio IRRs, stale while a
+            # single worker refreshes them
+            investment_statistics = cached_investment_statistics()
+        if filters or as_of is not None:
+            investment_statistics = {
+                **investment_statistics,
+                **cached_portfolio_irr(
+                    filters, loans.qs if filters else None, until=as_of),
+            }
 
         return Response(investment_statistics, status=status.HTTP_200_OK)
+
+
+class InvestmentStatisticsRollupView(generics.ListAPIView):
+    queryset = StatisticsRollup.objects.all()
+    serializer_class = StatisticsRollupSerializer
+    permission_classes = [IsInvestor, IsAnalyst]
+    filter_backends = [DjangoFilterBackend]
+    filterset_class = StatisticsRollupFilter
+
+    @extend_schema(
+        summary="Investment statistics by rating, issue month and closure",
+        parameters=[
+            OpenApiParameter(
+                name="group_by",
+                description="Comma separated dimensions to group the \
+                    statistics by: rating, issue_month, is_closed",
+                required=False,
+                type=str,
+            ),
+        ],
+    )
+    @cache_response
+    def get(self, request, *args, **kwargs):
+        options = RollupOptionsSerializer(data=request.query_params)
+        if not options.is_valid():
+            return Response(
+                {"error": options.errors},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # sum the pre-aggregated cells instead of scanning the loans
+        rows = StatisticsRollup.totals(
+            self.filter_queryset(self.get_queryset()),
+            options.validated_data["group_by"],
+        )
+        serializer = self.get_serializer(rows, many=True)
+        return Response(serializer.data, status=status.HTTP_200_OK)